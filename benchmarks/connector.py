@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Compare in-process egress through Connector with going through the SOCKS server
+
+    python benchmarks/connector.py [--connections 2000] [--concurrency 32]
+
+Each connection leaves from a random address in 127.41.0.0/16 (no root or routes needed),
+sends a 64-byte request and reads a 512-byte reply over loopback. Modes:
+
+    direct           socket.create_connection(), no source address: the floor
+    socks            SOCKS5 greeting + CONNECT to a SocksProxy in the same process
+    connector        Connector.connect() in a thread pool
+    connector-async  Connector.open_connection() on one event loop
+"""
+
+import sys
+import time
+import struct
+import socket
+import asyncio
+import argparse
+import threading
+import statistics
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from trevorproxy.lib.socks import SocksProxy, ThreadingTCPServer
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.connector import Connector
+from trevorproxy.lib.pool import socks5_greeting, socks5_connect
+
+from tuning import Source
+
+request = struct.pack("!Q56x", 512)
+
+
+def exchange(sock):
+    with sock:
+        sock.sendall(request)
+        received = 0
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            received += len(chunk)
+    return received
+
+
+def timed(connect):
+    start = time.perf_counter()
+    received = exchange(connect())
+    return time.perf_counter() - start, received
+
+
+def run_threads(connect, options):
+    with ThreadPoolExecutor(options.concurrency) as pool:
+        return list(pool.map(lambda _: timed(connect), range(options.connections)))
+
+
+async def run_async(connector, port, options):
+    semaphore = asyncio.Semaphore(options.concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            reader, writer = await connector.open_connection("127.0.0.1", port)
+            writer.write(request)
+            received = len(await reader.read())
+            writer.close()
+            return time.perf_counter() - start, received
+
+    return await asyncio.gather(*[one() for _ in range(options.connections)])
+
+
+def report(name, results, elapsed):
+    latencies = sorted(r[0] * 1000 for r in results)
+    short = sum(1 for r in results if r[1] != 512)
+    print(
+        f"{name:<16} {len(results) / elapsed:9.0f} {statistics.median(latencies):8.2f} "
+        f"{latencies[int(len(latencies) * 0.99) - 1]:8.2f} {short:6d}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    options = parser.parse_args()
+
+    source = Source()
+    proxy = SubnetProxy(subnet="127.41.0.0/16", interface="lo", version=4)
+    connector = Connector(proxy, timeout=30)
+    server = ThreadingTCPServer(("127.0.0.1", 0), SocksProxy, proxy=proxy)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    proxy_port = server.server_address[1]
+
+    def direct():
+        return socket.create_connection(("127.0.0.1", source.port), timeout=30)
+
+    def socks():
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=30)
+        try:
+            socks5_greeting(sock)
+            socks5_connect(sock, "127.0.0.1", source.port)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def via_connector():
+        return connector.connect("127.0.0.1", source.port)
+
+    print(f"{'':<16} {'conn/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'short':>6}")
+    try:
+        for name, connect in (("direct", direct), ("socks", socks), ("connector", via_connector)):
+            start = time.perf_counter()
+            results = run_threads(connect, options)
+            report(name, results, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        results = asyncio.run(run_async(connector, source.port, options))
+        report("connector-async", results, time.perf_counter() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Startup regression guard: time `trevorproxy --help` and check that parsing arguments
+doesn't import subsystems or touch ~/.trevorproxy
+
+    python benchmarks/startup.py [--runs 20] [--max-ms 300]
+
+Exits non-zero if the median startup time exceeds --max-ms or a check fails.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+cli = Path(__file__).resolve().parent.parent / "trevorproxy" / "cli.py"
+
+# modules that should only be imported once a subcommand needs them
+lazy = ["sh", "sqlite3", "lib.ssh", "lib.socks", "lib.subnet", "lib.netlink", "lib.upstream"]
+
+probe = f"""
+import sys, json, runpy
+sys.argv = ["trevorproxy", "--help"]
+try:
+    runpy.run_path({str(cli)!r}, run_name="__main__")
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def run(cmd, env):
+    start = time.perf_counter()
+    subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--max-ms", type=float, default=300, help="Fail if the median is slower (default: 300)"
+    )
+    options = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+
+        baseline = [run([sys.executable, "-c", "pass"], env) for _ in range(options.runs)]
+        times = [run([sys.executable, str(cli), "--help"], env) for _ in range(options.runs)]
+        interpreter = statistics.median(baseline)
+        median = statistics.median(times)
+        print(f"python -c pass:      {interpreter:7.1f} ms (median of {options.runs})")
+        print(f"trevorproxy --help:  {median:7.1f} ms (median of {options.runs})")
+        print(f"trevorproxy itself:  {median - interpreter:7.1f} ms")
+        if median > options.max_ms:
+            print(f"FAIL: startup is slower than {options.max_ms:.0f} ms")
+            failed = True
+
+        output = subprocess.run(
+            [sys.executable, "-c", probe], env=env, capture_output=True, check=True, text=True
+        ).stdout
+        modules = set(json.loads(output.splitlines()[-1]))
+        eager = [m for m in lazy if m in modules]
+        if eager:
+            print(f"FAIL: --help imported {', '.join(eager)}")
+            failed = True
+
+        if (Path(home) / ".trevorproxy").exists():
+            print("FAIL: --help created ~/.trevorproxy")
+            failed = True
+
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Measure what each socket tuning option does to connections relayed over loopback
+
+    python benchmarks/tuning.py [--connections 2000] [--concurrency 32] [--bulk-mb 64]
+
+Every option is run on its own, then each preset, through a SOCKS server egressing from
+127.40.0.0/16 (no root or routes needed). For each we report short-connection rate and
+latency (CONNECT, 64-byte request, 512-byte reply, close), one bulk transfer, and how many
+replies came back short.
+"""
+
+import sys
+import time
+import struct
+import socket
+import argparse
+import threading
+import statistics
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from trevorproxy.lib.socks import SocksProxy, ThreadingTCPServer
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.tuning import SocketTuning, presets
+from trevorproxy.lib.pool import socks5_greeting, socks5_connect
+
+single_options = {
+    "nodelay": dict(nodelay=True),
+    "bind_no_port": dict(bind_no_port=True),
+    "linger": dict(linger=True),
+    "fastopen": dict(fastopen=256),
+    "buffer": dict(buffer=64 * 1024),
+    "backlog": dict(backlog=4096),
+    "relay_buffer": dict(relay_buffer=64 * 1024),
+}
+
+
+class Source:
+    """
+    Reads a 64-byte request starting with a length, sends that many bytes back and closes
+    """
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(4096)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.reply, args=(conn,), daemon=True).start()
+
+    def reply(self, conn):
+        with conn:
+            try:
+                (size,) = struct.unpack("!Q", recv_exactly(conn, 64)[:8])
+                chunk = b"x" * min(size, 1024 * 1024)
+                while size > 0:
+                    conn.sendall(chunk[:size])
+                    size -= len(chunk)
+            except OSError:
+                pass
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def fetch(proxy_port, port, size):
+    """
+    One connection through the proxy; returns (seconds, bytes received)
+    """
+    start = time.perf_counter()
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=30)
+    with sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        socks5_greeting(sock)
+        socks5_connect(sock, "127.0.0.1", port)
+        sock.sendall(struct.pack("!Q56x", size))
+        received = 0
+        while True:
+            chunk = sock.recv(1024 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+    return time.perf_counter() - start, received
+
+
+def measure(name, tuning, source, options):
+    proxy = SubnetProxy(subnet="127.40.0.0/16", interface="lo", version=4)
+    server = ThreadingTCPServer(("127.0.0.1", 0), SocksProxy, proxy=proxy, tuning=tuning)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    proxy_port = server.server_address[1]
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            results = list(
+                pool.map(
+                    lambda _: fetch(proxy_port, source.port, 512),
+                    range(options.connections),
+                )
+            )
+        elapsed = time.perf_counter() - start
+        latencies = sorted(r[0] * 1000 for r in results)
+        short = sum(1 for r in results if r[1] != 512)
+
+        size = options.bulk_mb * 1024 * 1024
+        seconds, received = fetch(proxy_port, source.port, size)
+        if received != size:
+            short += 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(
+        f"{name:<14} {len(results) / elapsed:9.0f} {statistics.median(latencies):8.2f} "
+        f"{latencies[int(len(latencies) * 0.99) - 1]:8.2f} {received / seconds / 1e6:9.0f} {short:6d}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--bulk-mb", type=int, default=64)
+    parser.add_argument(
+        "--only", nargs="+", metavar="NAME", help="Only run these options/presets"
+    )
+    options = parser.parse_args()
+
+    runs = [(name, SocketTuning(**kwargs)) for name, kwargs in options_and_presets()]
+    if options.only:
+        runs = [(name, tuning) for name, tuning in runs if name in options.only]
+
+    source = Source()
+    print(f"{'':<14} {'conn/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'bulk MB/s':>9} {'short':>6}")
+    for name, tuning in runs:
+        measure(name, tuning, source, options)
+
+
+def options_and_presets():
+    yield "default", {}
+    yield from single_options.items()
+    for name, kwargs in presets.items():
+        if name != "default":
+            yield f"preset:{name}", kwargs
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+import socket
+import struct
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from trevorproxy.lib.pool import socks5_greeting, socks5_connect
+
+
+@contextmanager
+def running(server):
+    """
+    Run a socketserver in a background thread for the duration of the block
+    """
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def socks_server(handler, **kwargs):
+    from trevorproxy.lib.socks import ThreadingTCPServer
+
+    with running(ThreadingTCPServer(("127.0.0.1", 0), handler, **kwargs)) as server:
+        yield server
+
+
+def socks_client(port, username=None, password=None):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    socks5_greeting(sock, username, password)
+    return sock
+
+
+def socks_get(port, address, dport, payload=b"ping"):
+    """
+    CONNECT through a SOCKS server on `port`, send `payload` and return the reply
+    """
+    sock = socks_client(port)
+    try:
+        socks5_connect(sock, address, dport)
+        sock.sendall(payload)
+        return sock.recv(4096)
+    finally:
+        sock.close()
+
+
+class EchoServer:
+    """
+    TCP and UDP echo on loopback that records where each connection/datagram came from
+    """
+
+    def __init__(self, host="127.0.0.1"):
+        self.peers = []
+        self.tcp = socket.socket()
+        self.tcp.bind((host, 0))
+        self.tcp.listen(100)
+        self.port = self.tcp.getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, 0))
+        self.udp_port = self.udp.getsockname()[1]
+        self._stop = False
+        for target in (self._serve_tcp, self._serve_udp):
+            threading.Thread(target=target, daemon=True).start()
+
+    def _serve_tcp(self):
+        while not self._stop:
+            try:
+                conn, peer = self.tcp.accept()
+            except OSError:
+                return
+            self.peers.append(peer[0])
+            threading.Thread(target=self._echo, args=(conn,), daemon=True).start()
+
+    def _echo(self, conn):
+        with conn:
+            while 1:
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def _serve_udp(self):
+        while not self._stop:
+            try:
+                data, peer = self.udp.recvfrom(65535)
+            except OSError:
+                return
+            self.peers.append(peer[0])
+            self.udp.sendto(data, peer)
+
+    def close(self):
+        self._stop = True
+        self.tcp.close()
+        self.udp.close()
+
+
+@pytest.fixture
+def echo():
+    server = EchoServer()
+    yield server
+    server.close()
+
+
+class StubSocksServer:
+    """
+    Minimal upstream SOCKS5 proxy: optional username/password, CONNECT only
+    Set `refuse` to answer every CONNECT with "connection refused", or `hang_up` to close
+    the connection instead of answering; `reply` is what a successful CONNECT gets
+    """
+
+    def __init__(self, username=None, password=None):
+        self.username = username
+        self.password = password
+        self.refuse = False
+        self.hang_up = False
+        self.reply = b"\x05\x00\x00\x01" + b"\x00" * 6
+        self.connections = 0
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(100)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while 1:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _recv(self, conn, n):
+        data = b""
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def _handle(self, conn):
+        try:
+            _, nmethods = self._recv(conn, 2)
+            methods = self._recv(conn, nmethods)
+            if self.username is None:
+                conn.sendall(b"\x05\x00")
+            elif 2 in methods:
+                conn.sendall(b"\x05\x02")
+                self._recv(conn, 1)
+                username = self._recv(conn, self._recv(conn, 1)[0]).decode()
+                password = self._recv(conn, self._recv(conn, 1)[0]).decode()
+                ok = (username, password) == (self.username, self.password)
+                conn.sendall(b"\x01\x00" if ok else b"\x01\x01")
+                if not ok:
+                    return conn.close()
+            else:
+                conn.sendall(b"\x05\xff")
+                return conn.close()
+
+            _, _, _, address_type = self._recv(conn, 4)
+            if address_type == 1:
+                address = socket.inet_ntoa(self._recv(conn, 4))
+            elif address_type == 3:
+                address = self._recv(conn, self._recv(conn, 1)[0]).decode()
+            else:
+                address = socket.inet_ntop(socket.AF_INET6, self._recv(conn, 16))
+            port = struct.unpack("!H", self._recv(conn, 2))[0]
+            self.connections += 1
+            if self.hang_up:
+                return conn.close()
+            if self.refuse:
+                conn.sendall(b"\x05\x05\x00\x01" + b"\x00" * 6)
+                return conn.close()
+            remote = socket.create_connection((address, port), timeout=5)
+            conn.sendall(self.reply)
+            relay(conn, remote)
+        except Exception:
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class StubHTTPProxy:
+    """
+    Minimal upstream HTTP proxy: CONNECT only, optional Proxy-Authorization
+    Set `refuse` to answer every CONNECT with a 502, or `hang_up` to close the connection instead
+    """
+
+    def __init__(self, auth=None):
+        self.auth = auth
+        self.refuse = False
+        self.hang_up = False
+        self.connections = 0
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(100)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while 1:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            head = b""
+            while b"\r\n\r\n" not in head:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return conn.close()
+                head += chunk
+            lines = head.split(b"\r\n")
+            method, target, _ = lines[0].split(b" ", 2)
+            headers = dict(
+                line.split(b": ", 1) for line in lines[1:] if b": " in line
+            )
+            if self.auth is not None and headers.get(b"Proxy-Authorization") != self.auth:
+                conn.sendall(b"HTTP/1.1 407 Proxy Authentication Required\r\n\r\n")
+                return conn.close()
+            host, port = target.decode().rsplit(":", 1)
+            self.connections += 1
+            if self.hang_up:
+                return conn.close()
+            if self.refuse:
+                conn.sendall(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
+                return conn.close()
+            remote = socket.create_connection((host, int(port)), timeout=5)
+            conn.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            relay(conn, remote)
+        except Exception:
+            conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+def relay(a, b):
+    def pipe(src, dst):
+        try:
+            while 1:
+                data = src.recv(4096)
+                if not data:
+                    break
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for s in (src, dst):
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    threading.Thread(target=pipe, args=(b, a), daemon=True).start()
+    pipe(a, b)
+
+
+@pytest.fixture
+def stub_socks():
+    servers = []
+
+    def factory(**kwargs):
+        server = StubSocksServer(**kwargs)
+        servers.append(server)
+        return server
+
+    yield factory
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def stub_http():
+    servers = []
+
+    def factory(**kwargs):
+        server = StubHTTPProxy(**kwargs)
+        servers.append(server)
+        return server
+
+    yield factory
+    for server in servers:
+        server.close()
@@ -0,0 +1,123 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from trevorproxy.lib import accounting as accounting_module
+from trevorproxy.lib.accounting import Accounting, query, parse_duration
+from trevorproxy.lib.errors import TrevorProxyError
+
+DAY = 86400
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Wall clock used for row timestamps, settable by the test
+    """
+    clock = SimpleNamespace(now=1_700_000_000)
+    monkeypatch.setattr(
+        accounting_module, "time", SimpleNamespace(time=lambda: clock.now)
+    )
+    return clock
+
+
+def rows(path):
+    with sqlite3.connect(str(path)) as db:
+        return db.execute("SELECT * FROM usage ORDER BY kind, key").fetchall()
+
+
+def test_flush_writes_upstream_and_prefix_rows(tmp_path, clock):
+    path = tmp_path / "usage.db"
+    accounting = Accounting(path=path, interval=3600)
+    accounting.start()
+    try:
+        accounting.record(upstream="socks5://a:1080", source="192.0.2.10", bytes_out=10, bytes_in=100)
+        accounting.record(upstream="socks5://a:1080", source="192.0.2.20", bytes_out=5, bytes_in=50)
+        accounting.record(upstream="socks5://a:1080", failed=True)
+        accounting.record(source="2001:db8::1", bytes_out=1, bytes_in=2)
+        accounting.flush()
+    finally:
+        accounting.stop()
+
+    now = clock.now
+    assert rows(path) == [
+        (now, "prefix", "192.0.2.0/24", 2, 0, 15, 150),
+        (now, "prefix", "2001:db8::/64", 1, 0, 1, 2),
+        (now, "upstream", "socks5://a:1080", 2, 1, 15, 150),
+    ]
+    # counters start over after a flush, and empty intervals write nothing
+    assert accounting.usage == {"upstream": {}, "prefix": {}}
+    accounting.flush()
+    assert len(rows(path)) == 3
+
+
+def test_stop_flushes(tmp_path, clock):
+    path = tmp_path / "usage.db"
+    accounting = Accounting(path=path, interval=3600, source_prefix=16)
+    accounting.start()
+    accounting.record(source="192.0.2.10", bytes_out=1)
+    accounting.stop()
+    assert [r[2] for r in rows(path)] == ["192.0.0.0/16"]
+
+
+def test_without_a_path_nothing_is_written(tmp_path):
+    accounting = Accounting()
+    accounting.start()
+    accounting.record(upstream="u", bytes_out=1)
+    accounting.flush()
+    accounting.stop()
+    assert accounting.top("upstream") == ["u: 1 connections, 0 failures, 1/0 bytes out/in"]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_query(tmp_path, clock):
+    path = tmp_path / "usage.db"
+    accounting = Accounting(path=path)
+    accounting.start()
+    # three intervals: two days ago, and two recent ones
+    for age, records in (
+        (2 * DAY, [("old", 1000, False)] * 5),
+        (3600, [("a", 100, False), ("b", 10, False), ("b", 10, False), ("c", 0, True)]),
+        (60, [("a", 100, False), ("b", 10, False), ("c", 0, True), ("c", 0, True)]),
+    ):
+        clock.now = 1_700_000_000 - age
+        for upstream, size, failed in records:
+            accounting.record(upstream=upstream, bytes_out=size, bytes_in=size, failed=failed)
+        accounting.flush()
+    accounting.stop()
+
+    now = 1_700_000_000
+    # every interval is summed per key
+    assert query(path, since=now - 7 * DAY) == [
+        ("old", 5, 0, 5000, 5000),
+        ("a", 2, 0, 200, 200),
+        ("b", 3, 0, 30, 30),
+        ("c", 0, 3, 0, 0),
+    ]
+    # --since leaves out older intervals
+    assert [r[0] for r in query(path, since=now - DAY)] == ["a", "b", "c"]
+    assert query(path, since=now - 120) == [
+        ("a", 1, 0, 100, 100),
+        ("b", 1, 0, 10, 10),
+        ("c", 0, 2, 0, 0),
+    ]
+    # --sort and --top
+    assert [r[0] for r in query(path, since=now - DAY, order="connections")] == ["b", "a", "c"]
+    assert [r[0] for r in query(path, since=now - DAY, order="failures", top=1)] == ["c"]
+    assert query(path, kind="prefix") == []
+
+
+def test_query_needs_a_database(tmp_path):
+    with pytest.raises(TrevorProxyError):
+        query(tmp_path / "missing.db")
+
+
+def test_parse_duration():
+    assert parse_duration("90") == 90
+    assert parse_duration("30m") == 1800
+    assert parse_duration(" 12H ") == 12 * 3600
+    assert parse_duration("1.5d") == 1.5 * DAY
+    for bad in ("", "h", "abc", "5x", "-1h", "nan", "inf", "1e999d"):
+        with pytest.raises(TrevorProxyError):
+            parse_duration(bad)
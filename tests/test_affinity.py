@@ -0,0 +1,95 @@
+import time
+from itertools import count
+
+import pytest
+
+from trevorproxy.lib.affinity import AffinityCache
+from trevorproxy.lib.socks import SocksProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.pool import socks5_connect
+
+from conftest import socks_server, socks_client
+
+
+def test_entries_are_pinned_until_they_expire():
+    cache = AffinityCache(ttl=0.3)
+    values = count()
+    first = cache.get("key", lambda: next(values))
+    # each access pushes the expiry back
+    for _ in range(3):
+        time.sleep(0.15)
+        assert cache.get("key", lambda: next(values)) == first
+    time.sleep(0.4)
+    assert cache.get("key", lambda: next(values)) != first
+
+
+def test_size_bound_evicts_least_recently_used():
+    cache = AffinityCache(maxsize=2)
+    values = count()
+    a = cache.get("a", lambda: next(values))
+    b = cache.get("b", lambda: next(values))
+    cache.get("a", lambda: next(values))
+    cache.get("c", lambda: next(values))
+    assert len(cache) == 2
+    assert cache.get("a", lambda: next(values)) == a
+    assert cache.get("b", lambda: next(values)) != b
+
+
+def test_discard_and_clear():
+    cache = AffinityCache()
+    values = count()
+    a = cache.get("a", lambda: next(values))
+    cache.discard("a")
+    cache.discard("missing")
+    assert cache.get("a", lambda: next(values)) != a
+    cache.clear()
+    assert len(cache) == 0
+
+
+def sources(port, echo, requests):
+    """
+    Source address each (username, destination) request left from
+    """
+    result = []
+    for username, destination in requests:
+        sock = socks_client(port, username, username and "secret")
+        with sock:
+            socks5_connect(sock, destination, echo.port)
+            sock.sendall(b"ping")
+            assert sock.recv(4096) == b"ping"
+        result.append(echo.peers[-1])
+    return result
+
+
+@pytest.fixture
+def sticky_server():
+    def server(sticky):
+        proxy = SubnetProxy(subnet="127.48.0.0/16", interface="lo", version=4, sticky_ttl=60)
+        return socks_server(SocksProxy, proxy=proxy, sticky=sticky)
+
+    return server
+
+
+def test_username_keying(sticky_server, echo):
+    with sticky_server("username") as server:
+        port = server.server_address[1]
+        alice = sources(port, echo, [("alice", "127.0.0.1"), ("alice", "localhost")] * 2)
+        bob = sources(port, echo, [("bob", "127.0.0.1")] * 3)
+        anonymous = sources(port, echo, [(None, "127.0.0.1")] * 5)
+    # one source per user, whatever the destination
+    assert len(set(alice)) == 1
+    assert len(set(bob)) == 1
+    assert alice[0] != bob[0]
+    # connections without a username rotate
+    assert len(set(anonymous)) > 1
+
+
+def test_destination_keying(sticky_server, echo):
+    with sticky_server("destination") as server:
+        port = server.server_address[1]
+        by_address = sources(port, echo, [("alice", "127.0.0.1"), ("bob", "127.0.0.1")] * 2)
+        by_name = sources(port, echo, [(None, "localhost")] * 3)
+    # one source per destination, whoever connects
+    assert len(set(by_address)) == 1
+    assert len(set(by_name)) == 1
+    assert by_address[0] != by_name[0]
@@ -0,0 +1,100 @@
+import asyncio
+import ipaddress
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.connector import Connector
+
+subnet = ipaddress.ip_network("127.51.0.0/16")
+
+
+def connector(**kwargs):
+    return Connector(SubnetProxy(subnet=str(subnet), interface="lo", version=4), **kwargs)
+
+
+class Hello(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.client_address[0].encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def web():
+    server = HTTPServer(("127.0.0.1", 0), Hello)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_connect(echo):
+    conn = connector(timeout=5)
+    for _ in range(3):
+        sock = conn.connect("127.0.0.1", echo.port)
+        with sock:
+            assert sock.gettimeout() == 5
+            sock.sendall(b"ping")
+            assert sock.recv(4096) == b"ping"
+    assert len(echo.peers) == 3
+    assert all(ipaddress.ip_address(peer) in subnet for peer in echo.peers)
+
+
+def test_connect_refused():
+    conn = connector(timeout=5)
+    with pytest.raises(OSError):
+        # nothing listens on port 1
+        conn.connect("127.0.0.1", 1)
+
+
+def test_open_connection(echo):
+    conn = connector()
+
+    async def exchange():
+        reader, writer = await conn.open_connection("127.0.0.1", echo.port)
+        writer.write(b"ping")
+        data = await reader.read(4096)
+        writer.close()
+        await writer.wait_closed()
+        return data
+
+    async def main():
+        return await asyncio.gather(*[exchange() for _ in range(5)])
+
+    assert asyncio.run(main()) == [b"ping"] * 5
+    assert all(ipaddress.ip_address(peer) in subnet for peer in echo.peers)
+
+
+def test_http_connection(web):
+    http = connector(timeout=5).http_connection("127.0.0.1", web)
+    try:
+        http.request("GET", "/")
+        response = http.getresponse()
+        assert response.status == 200
+        assert ipaddress.ip_address(response.read().decode()) in subnet
+    finally:
+        http.close()
+
+
+def test_urllib_opener(web):
+    opener = connector(timeout=5).urllib_opener()
+    with opener.open(f"http://127.0.0.1:{web}/", timeout=5) as response:
+        assert ipaddress.ip_address(response.read().decode()) in subnet
+
+
+def test_without_a_subnet(echo):
+    # SSHLoadBalancer yields None for the current IP: a plain connection
+    conn = Connector(iter([None]), timeout=5)
+    sock = conn.connect("127.0.0.1", echo.port)
+    with sock:
+        sock.sendall(b"ping")
+        assert sock.recv(4096) == b"ping"
+    assert echo.peers == ["127.0.0.1"]
@@ -0,0 +1,90 @@
+import time
+import threading
+import ipaddress
+from contextlib import ExitStack
+
+import pytest
+
+from trevorproxy.lib.socks import SocksProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.registry import ConnectionRegistry
+from trevorproxy.lib.errors import TrevorProxyError
+from trevorproxy.lib.coordinator import (
+    Coordinator,
+    CoordinatorClient,
+    parse_shard,
+    parse_address,
+    take_shard,
+    DEFAULT_PORT,
+)
+
+from conftest import socks_server, socks_get
+
+SUBNET = ipaddress.ip_network("127.36.0.0/16")
+
+
+@pytest.fixture
+def coordinator():
+    coordinator = Coordinator(address="127.0.0.1", port=0, nodes=3, interval=0.2)
+    threading.Thread(target=coordinator.serve_forever, daemon=True).start()
+    # wait until it's bound
+    for _ in range(100):
+        if coordinator.sock is not None and coordinator.sock.getsockname()[1]:
+            break
+        time.sleep(0.01)
+    yield coordinator
+    coordinator.stop()
+
+
+def test_parse():
+    assert parse_shard("1/3") == (0, 3)
+    with pytest.raises(TrevorProxyError):
+        parse_shard("4/3")
+    assert parse_address("10.0.0.5") == ("10.0.0.5", DEFAULT_PORT)
+    assert parse_address("[::1]:1234") == ("::1", 1234)
+    assert take_shard(list("abcdefg"), (1, 3)) == ["b", "e"]
+
+
+def test_nodes_share_a_subnet_without_overlap(coordinator, echo):
+    port = coordinator.sock.getsockname()[1]
+    clients = [
+        CoordinatorClient("127.0.0.1", port, node=f"node{i}", interval=0.1)
+        for i in range(3)
+    ]
+    shards = [c.join(timeout=5) for c in clients]
+    assert sorted(shards) == [(0, 3), (1, 3), (2, 3)]
+    # joining again gets the same shard
+    assert clients[0].join(timeout=5) == shards[0]
+    # there are only three shards
+    with pytest.raises(TrevorProxyError):
+        CoordinatorClient("127.0.0.1", port, node="node3").join(timeout=5)
+
+    with ExitStack() as stack:
+        nodes = []
+        for client, shard in zip(clients, shards):
+            registry = ConnectionRegistry()
+            proxy = SubnetProxy(subnet=str(SUBNET), interface="lo", version=4, shard=shard)
+            server = stack.enter_context(
+                socks_server(SocksProxy, proxy=proxy, registry=registry)
+            )
+            client.start_reporting(registry.totals)
+            nodes.append((server, shard))
+
+        for server, shard in nodes:
+            peers = len(echo.peers)
+            for _ in range(10):
+                assert socks_get(server.server_address[1], "127.0.0.1", echo.port) == b"ping"
+            sources = [ipaddress.ip_address(p) for p in echo.peers[peers:]]
+            assert all(s in SUBNET for s in sources)
+            # each node only uses its own slice of the address space
+            assert {int(s) % shard[1] for s in sources} == {shard[0]}
+
+        # the coordinator adds up every node's usage
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            summary = coordinator.summary()
+            if summary and summary[0].startswith("All nodes: 0 active, 30 total"):
+                break
+            time.sleep(0.05)
+        assert summary[0].startswith("All nodes: 0 active, 30 total")
+        assert len(summary) == 4
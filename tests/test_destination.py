@@ -0,0 +1,89 @@
+import time
+import socket
+
+from trevorproxy.lib.destination import DestinationCache
+
+
+def fake_resolver(cache, answers):
+    """
+    Replace the cache's getaddrinfo lookups with `answers` (host --> address or None)
+    Returns the list of hosts looked up
+    """
+    lookups = []
+
+    def lookup(host, family):
+        lookups.append(host)
+        address = answers.get(host, None)
+        return None if address is None else (family, address)
+
+    cache._lookup = lookup
+    return lookups
+
+
+def test_hits_are_cached():
+    cache = DestinationCache()
+    lookups = fake_resolver(cache, {"example.com": "192.0.2.1"})
+    for host in ("example.com", "EXAMPLE.com", b"example.com"):
+        assert cache.resolve(host) == (socket.AF_INET, "192.0.2.1")
+    assert lookups == ["example.com"]
+    # the preferred family is part of the key
+    cache.resolve("example.com", socket.AF_INET6)
+    assert len(lookups) == 2
+
+
+def test_entries_expire():
+    cache = DestinationCache(ttl=0.1)
+    lookups = fake_resolver(cache, {"example.com": "192.0.2.1"})
+    cache.resolve("example.com")
+    cache.resolve("example.com")
+    assert len(lookups) == 1
+    time.sleep(0.15)
+    cache.resolve("example.com")
+    assert len(lookups) == 2
+
+
+def test_failures_are_cached_briefly():
+    cache = DestinationCache(ttl=60, negative_ttl=0.1)
+    answers = {}
+    lookups = fake_resolver(cache, answers)
+    assert cache.resolve("new.example") is None
+    assert cache.resolve("new.example") is None
+    assert len(lookups) == 1
+    # once the negative entry expires, a fixed record is picked up
+    answers["new.example"] = "192.0.2.7"
+    time.sleep(0.15)
+    assert cache.resolve("new.example") == (socket.AF_INET, "192.0.2.7")
+    assert len(lookups) == 2
+
+
+def test_lru_bound():
+    cache = DestinationCache(maxsize=2)
+    lookups = fake_resolver(cache, {"a": "192.0.2.1", "b": "192.0.2.2", "c": "192.0.2.3"})
+    cache.resolve("a")
+    cache.resolve("b")
+    # "a" is now the most recently used, so "b" goes when "c" comes in
+    cache.resolve("a")
+    cache.resolve("c")
+    assert len(cache) == 2
+    cache.resolve("a")
+    assert lookups == ["a", "b", "c"]
+    cache.resolve("b")
+    assert lookups == ["a", "b", "c", "b"]
+
+
+def test_hit_rate():
+    cache = DestinationCache()
+    fake_resolver(cache, {"a": "192.0.2.1"})
+    assert cache.summary() == "0 cached, 0 hits, 0 misses (0.0% hit rate)"
+    for _ in range(4):
+        cache.resolve("a")
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.summary() == "1 cached, 3 hits, 1 misses (75.0% hit rate)"
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_falls_back_to_the_other_family():
+    cache = DestinationCache()
+    assert cache.resolve("127.0.0.1", socket.AF_INET6) == (socket.AF_INET, "127.0.0.1")
+    assert cache.resolve("does-not-exist.invalid") is None
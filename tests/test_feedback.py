@@ -0,0 +1,210 @@
+import time
+import socket
+import ipaddress
+import threading
+
+import pytest
+
+from trevorproxy.lib.socks import SocksProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.feedback import Feedback, FailureScores
+from trevorproxy.lib.pool import SocksReplyError, socks5_connect
+from trevorproxy.lib.errors import UpstreamError
+from trevorproxy.lib.upstream import LocalUpstream, SocksUpstream, UpstreamBalancer
+
+from conftest import socks_server, socks_client, socks_get
+
+SUBNET = ipaddress.ip_network("127.44.0.0/22")
+BURNED = ipaddress.ip_network("127.44.1.0/24")
+
+
+def subnet_proxy(feedback, subnet=SUBNET):
+    return SubnetProxy(subnet=str(subnet), interface="lo", version=4, feedback=feedback)
+
+
+def test_scores_are_per_destination():
+    scores = FailureScores(threshold=2)
+    scores.failure("egress", "a:443")
+    assert not scores.is_quarantined("egress", "a:443")
+    scores.failure("egress", "a:443")
+    assert scores.is_quarantined("egress", "a:443")
+    assert not scores.is_quarantined("egress", "b:443")
+    assert set(scores.quarantined_for("a:443")) == {"egress"}
+    assert scores.quarantined_for("b:443") == {}
+
+    # failures not tied to a destination quarantine it everywhere
+    scores.failure("other")
+    scores.failure("other")
+    assert scores.is_quarantined("other", "b:443")
+    assert set(scores.quarantined_for("b:443")) == {"other"}
+
+
+def test_quarantine_expires():
+    scores = FailureScores(threshold=1, duration=0.1)
+    scores.failure("egress", "a:443")
+    assert scores.is_quarantined("egress", "a:443")
+    time.sleep(0.15)
+    assert not scores.is_quarantined("egress", "a:443")
+    assert scores.quarantined() == []
+
+
+def test_what_counts():
+    assert Feedback.counts(ConnectionRefusedError())
+    assert Feedback.counts(ConnectionResetError())
+    assert Feedback.counts(UpstreamError("down"))
+    assert Feedback.counts(SocksReplyError(5))
+    assert not Feedback.counts(SocksReplyError(4))
+    assert not Feedback.counts(socket.gaierror("no such host"))
+    assert not Feedback.counts(ValueError())
+
+    local = LocalUpstream(subnet_proxy(None))
+    with pytest.raises(Exception) as e:
+        local.resolve("does-not-exist.invalid")
+    assert not Feedback.counts(e.value)
+
+
+def test_early_close_only_counts_when_the_destination_hangs_up():
+    feedback = Feedback(threshold=1)
+    source = "127.44.1.5"
+    feedback.relay_finished(source, bytes_out=10, destination="a:443")
+    assert feedback.source_ok(source, "a:443")
+    feedback.relay_finished(source, bytes_out=10, destination="a:443", remote_closed=True)
+    assert not feedback.source_ok(source, "a:443")
+    assert feedback.source_ok(source, "b:443")
+
+
+def test_subnet_avoids_burned_prefixes_per_destination():
+    feedback = Feedback(threshold=1)
+    feedback.connect_failed(source="127.44.1.5", error=ConnectionRefusedError(), destination="a:443")
+    proxy = subnet_proxy(feedback)
+
+    sources = [proxy.next_source(destination="a:443") for _ in range(200)]
+    assert all(s in SUBNET and s not in BURNED for s in sources)
+    # everyone else still uses the prefix
+    sources = [proxy.next_source(destination="b:443") for _ in range(200)]
+    assert any(s in BURNED for s in sources)
+
+
+def test_subnet_falls_back_when_everything_is_burned():
+    feedback = Feedback(threshold=1)
+    for prefix in SUBNET.subnets(new_prefix=24):
+        feedback.connect_failed(
+            source=prefix[1], error=ConnectionRefusedError(), destination="a:443"
+        )
+    proxy = subnet_proxy(feedback)
+    assert proxy.next_source(destination="a:443") in SUBNET
+
+
+def test_single_prefix_subnet_ignores_quarantine():
+    feedback = Feedback(threshold=1)
+    feedback.connect_failed(source="127.44.1.5", error=ConnectionRefusedError(), destination="a:443")
+    proxy = subnet_proxy(feedback, subnet=BURNED)
+    assert proxy._burned("a:443") is None
+    assert proxy.next_source(destination="a:443") in BURNED
+
+
+def test_sticky_sessions_move_off_burned_prefixes():
+    feedback = Feedback(threshold=1)
+    proxy = SubnetProxy(
+        subnet=str(SUBNET), interface="lo", version=4, sticky_ttl=60, feedback=feedback
+    )
+    pinned = proxy.next_source("user", "a:443")
+    assert proxy.next_source("user", "a:443") == pinned
+    feedback.connect_failed(source=pinned, error=ConnectionRefusedError(), destination="a:443")
+    moved = proxy.next_source("user", "a:443")
+    assert feedback.source_ok(moved, "a:443")
+    assert proxy.next_source("user", "a:443") == moved
+
+
+def test_upstream_quarantine_is_per_destination(stub_socks):
+    feedback = Feedback(threshold=1)
+    first = SocksUpstream("127.0.0.1", stub_socks().port)
+    second = SocksUpstream("127.0.0.1", stub_socks().port)
+    balancer = UpstreamBalancer([first, second], feedback=feedback)
+    feedback.connect_failed(upstream=first, error=ConnectionRefusedError(), destination="a:443")
+
+    for _ in range(4):
+        upstream = balancer.next_upstream("a:443")
+        balancer.release(upstream)
+        assert upstream is second
+    assert {balancer.next_upstream("b:443") for _ in range(2)} == {first, second}
+
+    # an unreachable upstream is skipped for everyone
+    feedback.connect_failed(upstream=second, error=UpstreamError("down"))
+    assert not feedback.upstream_ok(second, "b:443")
+
+
+class Silent:
+    """
+    Accepts, reads whatever the client sends and never answers; optionally hangs up right away
+    """
+
+    def __init__(self, hang_up=False):
+        self.hang_up = hang_up
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(10)
+        self.port = self.listener.getsockname()[1]
+        self.connections = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections.append(conn)
+            if self.hang_up:
+                conn.recv(4096)
+                conn.close()
+
+    def close(self):
+        self.listener.close()
+        for conn in self.connections:
+            conn.close()
+
+
+@pytest.mark.parametrize("hang_up", [False, True])
+def test_relay_blames_egress_only_when_destination_hangs_up(hang_up):
+    feedback = Feedback(threshold=1)
+    destination = Silent(hang_up=hang_up)
+    try:
+        with socks_server(SocksProxy, proxy=subnet_proxy(feedback), feedback=feedback) as server:
+            sock = socks_client(server.server_address[1])
+            with sock:
+                socks5_connect(sock, "127.0.0.1", destination.port)
+                sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+                if hang_up:
+                    assert sock.recv(4096) == b""
+            time.sleep(0.2)
+    finally:
+        destination.close()
+    # a client giving up first says nothing about the source prefix
+    target = f"127.0.0.1:{destination.port}"
+    assert bool(feedback.sources.quarantined_for(target)) == hang_up
+
+
+def test_refusals_only_quarantine_for_that_destination(echo):
+    feedback = Feedback(threshold=3)
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    port = closed.getsockname()[1]
+    closed.close()
+
+    with socks_server(SocksProxy, proxy=subnet_proxy(feedback), feedback=feedback) as server:
+        for _ in range(20):
+            with pytest.raises(ConnectionError):
+                socks_get(server.server_address[1], "127.0.0.1", port)
+        # the prefixes that got refused are only avoided for the closed port
+        assert feedback.sources.quarantined_for(f"127.0.0.1:{port}")
+        assert not feedback.sources.quarantined_for(f"127.0.0.1:{echo.port}")
+        peers = len(echo.peers)
+        for _ in range(50):
+            assert socks_get(server.server_address[1], "127.0.0.1", echo.port) == b"ping"
+    sources = {source_prefix(p) for p in echo.peers[peers:]}
+    assert len(sources) == 4
+
+
+def source_prefix(address):
+    return ipaddress.ip_network(f"{address}/24", strict=False)
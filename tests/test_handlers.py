@@ -0,0 +1,35 @@
+import time
+import socket
+
+import pytest
+
+from trevorproxy.lib.http import AutoProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.upstream import UpstreamAutoProxy, UpstreamBalancer, LocalUpstream
+
+from conftest import socks_server, socks_get
+
+
+def subnet_proxy():
+    return SubnetProxy(subnet="127.30.0.0/16", interface="lo", version=4)
+
+
+@pytest.mark.parametrize(
+    "handler, proxy",
+    [
+        (AutoProxy, subnet_proxy),
+        (UpstreamAutoProxy, lambda: UpstreamBalancer([LocalUpstream(subnet_proxy())])),
+    ],
+)
+def test_probe_without_request(handler, proxy, echo):
+    errors = []
+    with socks_server(handler, proxy=proxy()) as server:
+        server.handle_error = lambda request, client_address: errors.append(client_address)
+        port = server.server_address[1]
+        # health checks and port scans connect and hang up straight away
+        for _ in range(3):
+            socket.create_connection(("127.0.0.1", port), timeout=5).close()
+        # the listener still works afterwards
+        assert socks_get(port, "127.0.0.1", echo.port) == b"ping"
+        time.sleep(0.2)
+    assert errors == []
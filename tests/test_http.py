@@ -0,0 +1,163 @@
+import socket
+import threading
+
+import pytest
+
+from trevorproxy.lib.http import HTTPProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.upstream import UpstreamHTTPProxy, UpstreamBalancer, SocksUpstream
+
+from conftest import socks_server
+
+
+def subnet_proxy():
+    return SubnetProxy(subnet="127.46.0.0/16", interface="lo", version=4)
+
+
+class Origin:
+    """
+    HTTP server that records each request head and answers "ok",
+    closing the connection if the request asked for it
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(10)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while 1:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            data = b""
+            while 1:
+                while b"\r\n\r\n" not in data:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        return
+                    data += chunk
+                head, _, data = data.partition(b"\r\n\r\n")
+                self.requests.append(head)
+                conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                if b"\r\nconnection: close" in head.lower():
+                    return
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def origin():
+    server = Origin()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def proxy_port():
+    with socks_server(HTTPProxy, proxy=subnet_proxy()) as server:
+        yield server.server_address[1]
+
+
+def request(port, head):
+    """
+    Send a request head through the proxy, returning everything received until it hangs up
+    """
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    with sock:
+        sock.sendall(head)
+        data = b""
+        while 1:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+
+def test_absolute_uri_is_rewritten(proxy_port, origin):
+    response = request(
+        proxy_port,
+        f"GET http://127.0.0.1:{origin.port}/path?q=1 HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{origin.port}\r\n\r\n".encode(),
+    )
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    (head,) = origin.requests
+    lines = head.split(b"\r\n")
+    assert lines[0] == b"GET /path?q=1 HTTP/1.1"
+    assert f"Host: 127.0.0.1:{origin.port}".encode() in lines
+
+
+def test_hop_by_hop_headers_are_stripped(proxy_port, origin):
+    request(
+        proxy_port,
+        f"POST http://127.0.0.1:{origin.port}/ HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{origin.port}\r\n"
+        "Proxy-Authorization: Basic dXNlcjpwYXNz\r\n"
+        "Proxy-Connection: keep-alive\r\n"
+        "Keep-Alive: timeout=5\r\n"
+        "Connection: X-Session, content-length\r\n"
+        "Connection: X-Other\r\n"
+        "X-Session: secret\r\n"
+        "x-other: secret\r\n"
+        "X-Kept: yes\r\n"
+        "Content-Length: 0\r\n\r\n".encode(),
+    )
+    (head,) = origin.requests
+    headers = [line.split(b":")[0].lower() for line in head.split(b"\r\n")[1:]]
+    for name in (b"proxy-authorization", b"proxy-connection", b"keep-alive", b"x-session", b"x-other"):
+        assert name not in headers
+    # Connection can't strip the headers that frame the request
+    assert b"content-length" in headers
+    assert b"x-kept" in headers
+    assert headers.count(b"connection") == 1
+    assert b"\r\nConnection: close" in head
+
+
+def test_keep_alive_becomes_one_request_per_connection(proxy_port, origin):
+    # the proxy asks the origin to close, so the client sees the end of the response
+    response = request(
+        proxy_port,
+        f"GET http://127.0.0.1:{origin.port}/ HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{origin.port}\r\nConnection: keep-alive\r\n\r\n".encode(),
+    )
+    assert response.endswith(b"\r\n\r\nok")
+    assert b"\r\nConnection: close" in origin.requests[0]
+    assert b"keep-alive" not in origin.requests[0].lower()
+
+
+def test_bad_requests(proxy_port):
+    for head in (b"GET ftp://example.com/ HTTP/1.1\r\n\r\n", b"GET /relative HTTP/1.1\r\n\r\n"):
+        assert request(proxy_port, head).startswith(b"HTTP/1.1 400 ")
+
+
+def test_unreachable_destination_is_a_502(proxy_port):
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    for head in (
+        f"GET http://127.0.0.1:{port}/ HTTP/1.1\r\n\r\n",
+        f"CONNECT 127.0.0.1:{port} HTTP/1.1\r\n\r\n",
+    ):
+        assert request(proxy_port, head.encode()).startswith(b"HTTP/1.1 502 ")
+
+
+def test_destination_timeout_is_a_504(stub_socks, origin):
+    stub = stub_socks()
+    # TTL expired, what a SOCKS proxy answers when the destination doesn't
+    stub.reply = b"\x05\x06\x00\x01" + b"\x00" * 6
+    balancer = UpstreamBalancer([SocksUpstream("127.0.0.1", stub.port)])
+    with socks_server(UpstreamHTTPProxy, proxy=balancer) as server:
+        response = request(
+            server.server_address[1], f"CONNECT 127.0.0.1:{origin.port} HTTP/1.1\r\n\r\n".encode()
+        )
+    assert response.startswith(b"HTTP/1.1 504 ")
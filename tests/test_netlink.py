@@ -0,0 +1,214 @@
+import errno
+import socket
+import ipaddress
+import threading
+
+from trevorproxy.lib import netlink, subnet
+from trevorproxy.lib.netlink import Discovery
+from trevorproxy.lib.subnet import SubnetProxy
+
+
+def rtattr(kind, data):
+    attr = netlink.RTATTR.pack(netlink.RTATTR.size + len(data), kind) + data
+    return attr + b"\0" * (netlink._align(len(attr)) - len(attr))
+
+
+def message(kind, body):
+    return netlink.NLMSGHDR.pack(netlink.NLMSGHDR.size + len(body), kind, 0, 0, 0) + body
+
+
+def neighbor(kind, address, index=2, state=0x02):
+    address = ipaddress.ip_address(address)
+    family = socket.AF_INET if address.version == 4 else socket.AF_INET6
+    body = netlink.NDMSG.pack(family, 0, 0, index, state, 0, 0)
+    return message(kind, body + rtattr(netlink.NDA_DST, address.packed))
+
+
+def address(kind, interface, index=2):
+    interface = ipaddress.ip_interface(interface)
+    family = socket.AF_INET if interface.version == 4 else socket.AF_INET6
+    body = netlink.IFADDRMSG.pack(family, interface.network.prefixlen, 0, 0, index)
+    return message(kind, body + rtattr(netlink.IFA_ADDRESS, interface.ip.packed))
+
+
+def route(kind):
+    body = netlink.RTMSG.pack(socket.AF_INET, 0, 0, 0, netlink.RT_TABLE_MAIN, 0, 0, 0, 0)
+    return message(kind, body)
+
+
+class FakeSocket:
+    """
+    Netlink socket stand-in that replays a list of events (bytes) and errors (exceptions),
+    then blocks until closed
+    """
+
+    def __init__(self, events):
+        self.events = list(events)
+        self.closed = threading.Event()
+
+    def recv(self, size, flags=0):
+        if flags:
+            # nothing more in the burst
+            raise BlockingIOError
+        if self.events:
+            event = self.events.pop(0)
+            if isinstance(event, Exception):
+                raise event
+            return event
+        self.closed.wait()
+        raise OSError(errno.EBADF, "closed")
+
+    def close(self):
+        self.closed.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def cached(discovery, **tables):
+    """
+    Pre-populate the snapshot and record which tables get dumped afterwards
+    """
+    snapshot = {"links": {}, "addresses": [], "neighbors": set(), "gateways": set()}
+    snapshot.update(tables)
+    discovery._snapshot = snapshot
+    discovery._neighbor_links = {a: {2} for a in snapshot["neighbors"]}
+    dumped = []
+
+    def dump(name):
+        dumped.append(name)
+        return {"links": {}, "addresses": [], "neighbors": set(), "gateways": {"gw"}}[name]
+
+    discovery._dump = dump
+    return dumped
+
+
+def watch(sockets):
+    discovery = Discovery()
+    discovery.retry_delay = 0.01
+    opened = []
+
+    def open_socket():
+        sock = sockets.pop(0)
+        opened.append(sock)
+        return sock
+
+    discovery._open = open_socket
+    cached(discovery)
+    changes = threading.Semaphore(0)
+    discovery.subscribe(changes.release)
+    return discovery, opened, changes
+
+
+def test_overflow_invalidates_and_keeps_reading():
+    overflow = OSError(errno.ENOBUFS, "No buffer space available")
+    sock = FakeSocket([overflow, neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1")])
+    discovery, opened, changes = watch([sock])
+
+    # one refresh for the overflow, one for the event after it
+    assert changes.acquire(timeout=5)
+    assert changes.acquire(timeout=5)
+    assert discovery._snapshot is None
+    assert discovery._monitor.is_alive()
+    assert opened == [sock]
+    sock.close()
+
+
+def test_other_errors_restart_the_monitor():
+    broken = FakeSocket([OSError(errno.EIO, "I/O error")])
+    replacement = FakeSocket([neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1")])
+    discovery, opened, changes = watch([broken, replacement])
+
+    # one refresh for the events missed during the restart, one for the new event
+    assert changes.acquire(timeout=5)
+    assert changes.acquire(timeout=5)
+    assert opened == [broken, replacement]
+    assert discovery._monitor.is_alive()
+    replacement.events.clear()
+
+
+def test_state_changes_dont_notify():
+    sock = FakeSocket(
+        [
+            neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1", state=0x02),
+            # REACHABLE -> STALE -> REACHABLE churn
+            neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1", state=0x04),
+            neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1", state=0x02),
+            neighbor(netlink.RTM_DELNEIGH, "10.0.0.1"),
+        ]
+    )
+    discovery, _, changes = watch([sock])
+    assert changes.acquire(timeout=5)
+    assert changes.acquire(timeout=5)
+    assert not changes.acquire(timeout=0.2)
+    sock.close()
+
+
+def test_neighbor_events_are_applied_without_dumping():
+    discovery = Discovery()
+    dumped = cached(discovery, neighbors={ipaddress.ip_address("10.0.0.9")})
+    first = discovery.snapshot()
+
+    assert discovery._handle(neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1"))
+    assert discovery.snapshot()["neighbors"] == {
+        ipaddress.ip_address("10.0.0.1"),
+        ipaddress.ip_address("10.0.0.9"),
+    }
+    # snapshots already handed out don't change
+    assert first["neighbors"] == {ipaddress.ip_address("10.0.0.9")}
+
+    # the same address on a second interface only goes away with both entries
+    assert not discovery._handle(neighbor(netlink.RTM_NEWNEIGH, "10.0.0.1", index=3))
+    assert not discovery._handle(neighbor(netlink.RTM_DELNEIGH, "10.0.0.1", index=2))
+    assert discovery._handle(neighbor(netlink.RTM_DELNEIGH, "10.0.0.1", index=3))
+    assert discovery.snapshot()["neighbors"] == {ipaddress.ip_address("10.0.0.9")}
+
+    # static no-ARP entries are ignored, like in a dump
+    assert not discovery._handle(neighbor(netlink.RTM_NEWNEIGH, "224.0.0.1", state=0x40))
+    # several events in one read
+    burst = neighbor(netlink.RTM_NEWNEIGH, "10.0.0.2") + neighbor(
+        netlink.RTM_NEWNEIGH, "fe80::1"
+    )
+    assert discovery._handle(burst)
+    assert len(discovery.snapshot()["neighbors"]) == 3
+    assert dumped == []
+
+
+def test_address_events_are_applied_without_dumping():
+    discovery = Discovery()
+    dumped = cached(discovery)
+    assert discovery._handle(address(netlink.RTM_NEWADDR, "192.0.2.5/24"))
+    assert not discovery._handle(address(netlink.RTM_NEWADDR, "192.0.2.5/24"))
+    (entry,) = discovery.snapshot()["addresses"]
+    assert entry["address"] == ipaddress.ip_interface("192.0.2.5/24")
+    assert entry["index"] == 2
+    assert discovery._handle(address(netlink.RTM_DELADDR, "192.0.2.5/24"))
+    assert discovery.snapshot()["addresses"] == []
+    assert dumped == []
+
+
+def test_route_events_only_refresh_gateways():
+    discovery = Discovery()
+    dumped = cached(discovery)
+    assert discovery._handle(route(netlink.RTM_NEWROUTE))
+    assert discovery.snapshot()["gateways"] == {"gw"}
+    assert dumped == ["gateways"]
+
+
+def test_subnet_proxy_unsubscribes_on_stop(monkeypatch):
+    discovery = Discovery()
+    # don't start a real monitor
+    discovery._monitor = threading.current_thread()
+    monkeypatch.setattr(subnet, "discovery", discovery)
+    proxy = SubnetProxy(subnet="127.45.0.0/16", interface="lo", version=4)
+    proxy._route = lambda action, subnet: None
+
+    proxy.start()
+    assert discovery._callbacks == [proxy.refresh_blacklist]
+    proxy.stop()
+    assert discovery._callbacks == []
+    # stopping twice is harmless
+    proxy.stop()
@@ -0,0 +1,174 @@
+import time
+import socket
+import struct
+import threading
+
+import pytest
+
+from trevorproxy.lib.pool import (
+    SocksPool,
+    SocksReplyError,
+    socks5_greeting,
+    socks5_connect,
+)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class Recorder:
+    """
+    Records what a SOCKS client sends and answers with canned replies, one per read
+    """
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.received = []
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        conn, _ = self.listener.accept()
+        with conn:
+            try:
+                for reply in self.replies:
+                    self.received.append(conn.recv(4096))
+                    if reply is None:
+                        # never answer
+                        break
+                    conn.sendall(reply)
+                conn.recv(1)
+            except OSError:
+                pass
+
+    def close(self):
+        self.listener.close()
+
+
+def recorded(replies, exchange):
+    recorder = Recorder(replies)
+    sock = socket.create_connection(("127.0.0.1", recorder.port), timeout=5)
+    try:
+        return exchange(sock), recorder.received
+    finally:
+        sock.close()
+        recorder.close()
+
+
+def test_greeting_encoding():
+    _, received = recorded([b"\x05\x00"], socks5_greeting)
+    assert received == [b"\x05\x01\x00"]
+
+    _, received = recorded(
+        [b"\x05\x02", b"\x01\x00"], lambda sock: socks5_greeting(sock, "user", "secret")
+    )
+    assert received == [b"\x05\x02\x00\x02", b"\x01\x04user\x06secret"]
+
+    with pytest.raises(ConnectionError):
+        recorded([b"\x05\x02", b"\x01\x01"], lambda sock: socks5_greeting(sock, "user", "x"))
+    with pytest.raises(ConnectionError):
+        recorded([b"\x05\x02"], socks5_greeting)
+    with pytest.raises(ConnectionError):
+        recorded([b"\x05\xff"], socks5_greeting)
+
+
+@pytest.mark.parametrize(
+    "address,encoded",
+    [
+        ("192.0.2.1", b"\x01\xc0\x00\x02\x01"),
+        ("2001:db8::1", b"\x04" + socket.inet_pton(socket.AF_INET6, "2001:db8::1")),
+        ("example.com", b"\x03\x0bexample.com"),
+    ],
+)
+def test_connect_encoding(address, encoded):
+    reply = b"\x05\x00\x00\x01\xc6\x33\x64\x07\x1f\x90"
+    bound, received = recorded([reply], lambda sock: socks5_connect(sock, address, 443))
+    assert received == [b"\x05\x01\x00" + encoded + struct.pack("!H", 443)]
+    assert bound == ("198.51.100.7", 8080)
+
+
+def test_connect_reply_addresses():
+    reply = b"\x05\x00\x00\x03\x0bexample.com\x00\x50"
+    bound, _ = recorded([reply], lambda sock: socks5_connect(sock, "192.0.2.1", 80))
+    assert bound == ("example.com", 80)
+
+    reply = b"\x05\x00\x00\x04" + socket.inet_pton(socket.AF_INET6, "::1") + b"\x00\x50"
+    bound, _ = recorded([reply], lambda sock: socks5_connect(sock, "192.0.2.1", 80))
+    assert bound == ("::1", 80)
+
+    with pytest.raises(SocksReplyError) as e:
+        recorded([b"\x05\x04\x00\x01" + b"\x00" * 6], lambda sock: socks5_connect(sock, "a", 1))
+    assert e.value.reply_code == 4
+
+
+def test_prewarm_refill(stub_socks, echo):
+    stub = stub_socks()
+    pool = SocksPool("127.0.0.1", stub.port, size=3, interval=0.05)
+    pool.start()
+    try:
+        wait_for(lambda: len(pool) == 3)
+        sock = pool.connect("127.0.0.1", echo.port)
+        with sock:
+            sock.sendall(b"ping")
+            assert sock.recv(4096) == b"ping"
+        assert (pool.hits, pool.misses) == (1, 0)
+        # the session taken is replaced
+        wait_for(lambda: len(pool) == 3)
+    finally:
+        pool.stop()
+    assert len(pool) == 0
+
+
+def test_idle_sessions_expire(stub_socks):
+    pool = SocksPool("127.0.0.1", stub_socks().port, size=2, idle_timeout=0.2, interval=0.05)
+    pool.start()
+    try:
+        wait_for(lambda: len(pool) == 2)
+        first = {sock for sock, _ in pool._idle}
+        time.sleep(0.4)
+        wait_for(lambda: len(pool) == 2)
+        assert first.isdisjoint(sock for sock, _ in pool._idle)
+        assert all(sock.fileno() == -1 for sock in first)
+    finally:
+        pool.stop()
+
+
+def test_stale_sessions_are_replaced(stub_socks, echo):
+    pool = SocksPool("127.0.0.1", stub_socks().port, size=1, interval=60)
+    # a session the upstream has closed is readable, so get() skips it
+    a, b = socket.socketpair()
+    b.close()
+    pool._idle.append((a, time.monotonic()))
+    sock = pool.connect("127.0.0.1", echo.port)
+    with sock:
+        sock.sendall(b"ping")
+        assert sock.recv(4096) == b"ping"
+    assert (pool.hits, pool.misses) == (0, 1)
+    assert a.fileno() == -1
+
+
+def test_connect_times_out_until_the_reply():
+    # greeting answered, CONNECT never is
+    recorder = Recorder([b"\x05\x00", None])
+    pool = SocksPool("127.0.0.1", recorder.port, connect_timeout=0.2)
+    try:
+        start = time.monotonic()
+        with pytest.raises(socket.timeout):
+            pool.connect("192.0.2.1", 80)
+        assert time.monotonic() - start < 2
+    finally:
+        recorder.close()
+
+
+def test_connected_sessions_have_no_timeout(stub_socks, echo):
+    pool = SocksPool("127.0.0.1", stub_socks().port, connect_timeout=0.2)
+    sock = pool.connect("127.0.0.1", echo.port)
+    with sock:
+        assert sock.gettimeout() is None
@@ -0,0 +1,113 @@
+import time
+import threading
+
+from trevorproxy.lib.ratelimit import ConnectScheduler, Limit, source_network
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_source_network():
+    assert str(source_network("192.0.2.77")) == "192.0.2.0/24"
+    assert str(source_network("2001:db8::1")) == "2001:db8::/64"
+    assert str(source_network("192.0.2.77", 16)) == "192.0.0.0/16"
+    assert source_network(None) is None
+
+
+def test_rate_spacing():
+    scheduler = ConnectScheduler(destination=Limit(rate=5, burst=1))
+    times = []
+    start = time.monotonic()
+    for _ in range(4):
+        scheduler.acquire(destination="a").release()
+        times.append(time.monotonic() - start)
+    # the first goes straight through, the rest are spaced 1/rate apart
+    assert times[0] < 0.1
+    assert times[-1] >= 0.5
+    # other destinations aren't held up
+    start = time.monotonic()
+    scheduler.acquire(destination="b").release()
+    assert time.monotonic() - start < 0.1
+
+
+def test_concurrency_handoff_order():
+    scheduler = ConnectScheduler(destination=Limit(concurrency=1))
+    first = scheduler.acquire(destination="a")
+    order = []
+
+    def connect(i):
+        ticket = scheduler.acquire(destination="a")
+        order.append(i)
+        ticket.release()
+
+    threads = []
+    for i in range(4):
+        thread = threading.Thread(target=connect, args=(i,))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: scheduler.queue_depth == i + 1)
+
+    assert order == []
+    first.release()
+    for thread in threads:
+        thread.join(5)
+    # waiters get the slot in arrival order
+    assert order == [0, 1, 2, 3]
+    assert scheduler.queue_depth == 0
+
+
+def test_released_slots_are_reused():
+    scheduler = ConnectScheduler(upstream=Limit(concurrency=2))
+    tickets = [scheduler.acquire(upstream="u") for _ in range(2)]
+    for ticket in tickets:
+        ticket.release()
+        # releasing twice doesn't free a slot that isn't ours
+        ticket.release()
+    tickets = [scheduler.acquire(upstream="u") for _ in range(2)]
+    assert scheduler._buckets[("upstream", "u")].active == 2
+
+
+def test_eviction_keeps_buckets_in_use():
+    scheduler = ConnectScheduler(destination=Limit(concurrency=1), maxsize=2)
+    held = scheduler.acquire(destination="held")
+    for i in range(20):
+        scheduler.acquire(destination=f"idle{i}").release()
+    assert len(scheduler._buckets) <= 2
+    assert ("destination", "held") in scheduler._buckets
+
+    # the held slot still counts after all that churn
+    started = threading.Event()
+    threading.Thread(
+        target=lambda: (started.set(), scheduler.acquire(destination="held").release()),
+        daemon=True,
+    ).start()
+    started.wait()
+    wait_for(lambda: scheduler.queue_depth == 1)
+    held.release()
+    wait_for(lambda: scheduler.queue_depth == 0)
+
+
+def test_eviction_keeps_buckets_with_rate_sleepers():
+    scheduler = ConnectScheduler(destination=Limit(rate=2, burst=1), maxsize=1)
+    scheduler.acquire(destination="a").release()
+    done = threading.Event()
+    threading.Thread(
+        target=lambda: (scheduler.acquire(destination="a").release(), done.set()),
+        daemon=True,
+    ).start()
+    wait_for(lambda: scheduler._buckets[("destination", "a")].sleeping == 1)
+
+    # churn through other keys while the caller sleeps on the timer wheel
+    for i in range(20):
+        scheduler.acquire(destination=f"other{i}")
+    assert ("destination", "a") in scheduler._buckets
+
+    # the next caller for "a" queues behind the sleeper instead of getting a fresh bucket
+    start = time.monotonic()
+    scheduler.acquire(destination="a").release()
+    assert time.monotonic() - start >= 0.5
+    assert done.wait(5)
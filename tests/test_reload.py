@@ -0,0 +1,69 @@
+import json
+import ipaddress
+
+import pytest
+
+from trevorproxy.lib import subnet
+from trevorproxy.lib.errors import TrevorProxyError
+from trevorproxy.lib.reload import Reloader, load_config
+from trevorproxy.lib.subnet import SubnetProxy
+
+OLD = ipaddress.ip_network("127.49.0.0/16")
+NEW = ipaddress.ip_network("127.50.0.0/16")
+NEIGHBORS = {ipaddress.ip_address("127.49.0.1"), ipaddress.ip_address("127.50.0.1")}
+
+
+def test_load_config(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"subnet": str(NEW), "blacklist": ["127.50.0.2"]}))
+    assert load_config(path)["subnet"] == str(NEW)
+    for content in ("not json", "[]", '{"subnet": "x", "colour": "blue"}'):
+        path.write_text(content)
+        with pytest.raises(TrevorProxyError):
+            load_config(path)
+    with pytest.raises(TrevorProxyError):
+        load_config(tmp_path / "missing.json")
+
+
+def test_reloader_applies_valid_configs_only(tmp_path):
+    path = tmp_path / "config.json"
+    applied = []
+    reloader = Reloader(path, applied.append)
+    path.write_text('{"subnet": "127.50.0.0/16"}')
+    reloader.reload()
+    # a broken edit is logged and the running config kept
+    path.write_text("{")
+    reloader.reload()
+    assert applied == [{"subnet": "127.50.0.0/16"}]
+
+
+def test_reload_switches_subnet_and_blacklist(monkeypatch):
+    monkeypatch.setattr(subnet, "get_blacklist", lambda: NEIGHBORS)
+    proxy = SubnetProxy(subnet=str(OLD), interface="lo", version=4)
+    assert proxy.blacklist == {ipaddress.ip_address("127.49.0.1")}
+    proxy.reload(subnet=str(NEW), blacklist=["127.50.0.2"])
+    assert proxy.subnet == NEW
+    assert proxy.retired == [OLD]
+    assert proxy.blacklist == {
+        ipaddress.ip_address("127.50.0.1"),
+        ipaddress.ip_address("127.50.0.2"),
+    }
+    assert all(proxy.next_source() in NEW for _ in range(100))
+
+
+def test_blacklist_refresh_racing_a_reload(monkeypatch):
+    proxy = SubnetProxy(subnet=str(OLD), interface="lo", version=4)
+    calls = []
+
+    def racing_blacklist():
+        # the subnet is switched while a neighbor-change refresh is dumping neighbors
+        calls.append(1)
+        if len(calls) == 1:
+            proxy.reload(subnet=str(NEW))
+        return NEIGHBORS
+
+    monkeypatch.setattr(subnet, "get_blacklist", racing_blacklist)
+    proxy.refresh_blacklist()
+    # the stale result for the old subnet isn't saved over the new one
+    assert proxy.subnet == NEW
+    assert proxy.blacklist == {ipaddress.ip_address("127.50.0.1")}
@@ -0,0 +1,42 @@
+import errno
+import socket
+
+from trevorproxy.lib import reply
+from trevorproxy.lib.pool import SocksReplyError
+
+
+def test_success():
+    assert reply.success(("192.0.2.1", 8080)) == b"\x05\x00\x00\x01\xc0\x00\x02\x01\x1f\x90"
+    # getsockname() on an IPv6 socket returns a 4-tuple
+    assert reply.success(("2001:db8::1", 80, 0, 0)) == (
+        b"\x05\x00\x00\x04" + socket.inet_pton(socket.AF_INET6, "2001:db8::1") + b"\x00\x50"
+    )
+
+
+def test_encode():
+    assert reply.encode(reply.SUCCEEDED, "192.0.2.1", 8080) == reply.success(("192.0.2.1", 8080))
+    assert reply.encode(reply.SUCCEEDED, "::1", 1) == reply.success(("::1", 1))
+    assert reply.encode(reply.SUCCEEDED, "proxy.example", 443) == (
+        b"\x05\x00\x00\x03\x0dproxy.example\x01\xbb"
+    )
+    assert reply.encode(reply.CONNECTION_REFUSED) == reply.failure(reply.CONNECTION_REFUSED)
+
+
+def test_failure():
+    assert reply.failure() == b"\x05\x01\x00\x01" + b"\x00" * 6
+    assert reply.failure(reply.HOST_UNREACHABLE)[1] == 4
+    # unknown codes become a general failure
+    assert reply.failure(42) == reply.failure(reply.GENERAL_FAILURE)
+
+
+def test_error_code():
+    assert reply.error_code(SocksReplyError(reply.NOT_ALLOWED)) == reply.NOT_ALLOWED
+    assert reply.error_code(socket.gaierror("no such host")) == reply.HOST_UNREACHABLE
+    assert reply.error_code(socket.timeout()) == reply.TTL_EXPIRED
+    assert reply.error_code(ConnectionRefusedError(errno.ECONNREFUSED, "")) == reply.CONNECTION_REFUSED
+    assert reply.error_code(OSError(errno.ENETUNREACH, "")) == reply.NETWORK_UNREACHABLE
+    assert reply.error_code(OSError(errno.EHOSTUNREACH, "")) == reply.HOST_UNREACHABLE
+    assert reply.error_code(PermissionError(errno.EACCES, "")) == reply.NOT_ALLOWED
+    # a reset isn't a refusal: the client shouldn't conclude the port is closed
+    assert reply.error_code(ConnectionResetError(errno.ECONNRESET, "")) == reply.GENERAL_FAILURE
+    assert reply.error_code(ValueError()) == reply.GENERAL_FAILURE
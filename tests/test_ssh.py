@@ -0,0 +1,127 @@
+import time
+import asyncio
+
+import pytest
+
+from trevorproxy.lib import ssh
+from trevorproxy.lib.api import SSHProxyServer
+
+
+class FakeSSHProxy:
+    """
+    SSHProxy without ssh: reports whatever `active` is set to as its established connections
+    """
+
+    def __init__(self, host, proxy_port, key=None, key_pass="", ssh_args={}, prewarm=0):
+        self.host = host
+        self.proxy_port = proxy_port
+        self.pool = None
+        self.active = 0
+        self.stopped = False
+        self.running = False
+        self.starts = 0
+
+    def start(self, wait=True, timeout=30):
+        self.starts += 1
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def is_connected(self):
+        self.running = not self.stopped
+        return self.running
+
+    def active_connections(self):
+        return self.active
+
+    def __str__(self):
+        return f"socks5://127.0.0.1:{self.proxy_port}"
+
+
+@pytest.fixture
+def balancer(monkeypatch):
+    monkeypatch.setattr(ssh, "SSHProxy", FakeSSHProxy)
+    return ssh.SSHLoadBalancer(["a", "b"], base_port=40000)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def proxy(balancer, host):
+    return next(p for p in balancer.proxies.values() if p.host == host)
+
+
+def test_reload_without_drain_stops_removed_hosts(balancer):
+    b = proxy(balancer, "b")
+    b.active = 1
+    balancer.reload(["a"])
+    assert b.stopped
+    assert [p.host for p in balancer.proxies.values()] == ["a"]
+
+
+def test_reload_drains_removed_hosts(balancer):
+    b = proxy(balancer, "b")
+    b.active = 1
+    balancer.reload(["a"], drain_timeout=30)
+    # out of rotation straight away, but its connections keep flowing
+    assert [p.host for p in balancer.proxies.values()] == ["a"]
+    assert not b.stopped
+    assert balancer.retiring == [b]
+
+    b.active = 0
+    assert wait_for(lambda: b.stopped)
+    assert balancer.retiring == []
+
+
+def test_reload_drain_timeout(balancer):
+    b = proxy(balancer, "b")
+    b.active = 1
+    balancer.reload(["a"], drain_timeout=1)
+    assert wait_for(lambda: b.stopped)
+
+
+def test_retiring_ports_are_not_reused(balancer):
+    b = proxy(balancer, "b")
+    b.active = 1
+    balancer.reload(["a", "c"], drain_timeout=30)
+    c = proxy(balancer, "c")
+    assert c.proxy_port not in (proxy(balancer, "a").proxy_port, b.proxy_port)
+    balancer.stop()
+    assert b.stopped and c.stopped
+
+
+def test_proxy_server_restarts_dead_tunnels(monkeypatch):
+    monkeypatch.setattr(ssh, "SSHProxy", FakeSSHProxy)
+
+    async def run():
+        server = SSHProxyServer(["a", "b"], base_port=40000)
+        server.monitor_interval = 0.05
+        await server.start()
+        a, b = (upstream.ssh_proxy for upstream in server.balancer.upstreams)
+        assert a.starts == b.starts == 1
+
+        # the ssh process dies
+        b.stopped = True
+        for _ in range(100):
+            if b.starts == 2 and b.running:
+                break
+            await asyncio.sleep(0.01)
+        assert b.starts == 2
+        assert all(upstream.is_healthy() for upstream in server.balancer.upstreams)
+
+        monitor = server._monitor
+        await server.stop()
+        assert monitor.done()
+        assert a.stopped and b.stopped
+        # nothing restarts them after stop()
+        await asyncio.sleep(0.1)
+        assert a.starts == 1 and b.starts == 2
+
+    asyncio.run(run())
@@ -0,0 +1,18 @@
+import sys
+import subprocess
+from pathlib import Path
+
+guard = Path(__file__).resolve().parent.parent / "benchmarks" / "startup.py"
+
+
+def test_startup_guard():
+    # the timing bound is loose here: shared CI machines are noisy, the import and
+    # ~/.trevorproxy checks are what this catches
+    result = subprocess.run(
+        [sys.executable, str(guard), "--runs", "3", "--max-ms", "2000"],
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert result.stdout.strip().endswith("OK")
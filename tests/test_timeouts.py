@@ -0,0 +1,85 @@
+import time
+import socket
+
+from trevorproxy.lib.socks import SocksProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.timeouts import Timeouts
+from trevorproxy.lib.pool import socks5_connect
+
+from conftest import socks_server, socks_client
+
+
+def subnet_proxy():
+    return SubnetProxy(subnet="127.47.0.0/16", interface="lo", version=4)
+
+
+def closed_after(sock, timeout=5):
+    """
+    Seconds until the proxy hangs up on `sock`
+    """
+    start = time.monotonic()
+    sock.settimeout(timeout)
+    assert sock.recv(4096) == b""
+    return time.monotonic() - start
+
+
+def test_handshake_timeout():
+    timeouts = Timeouts(handshake=0.3)
+    with socks_server(SocksProxy, proxy=subnet_proxy(), timeouts=timeouts) as server:
+        # connect and say nothing
+        sock = socket.create_connection(("127.0.0.1", server.server_address[1]), timeout=5)
+        with sock:
+            assert 0.2 <= closed_after(sock) < 2
+    assert timeouts.handshake_timeouts == 1
+
+
+def test_handshake_timeout_stops_at_the_request(echo):
+    timeouts = Timeouts(handshake=0.3)
+    with socks_server(SocksProxy, proxy=subnet_proxy(), timeouts=timeouts) as server:
+        sock = socks_client(server.server_address[1])
+        with sock:
+            socks5_connect(sock, "127.0.0.1", echo.port)
+            time.sleep(0.6)
+            sock.sendall(b"ping")
+            assert sock.recv(4096) == b"ping"
+    assert timeouts.handshake_timeouts == 0
+
+
+def test_idle_timeout(echo):
+    timeouts = Timeouts(idle=0.4)
+    with socks_server(SocksProxy, proxy=subnet_proxy(), timeouts=timeouts) as server:
+        sock = socks_client(server.server_address[1])
+        with sock:
+            socks5_connect(sock, "127.0.0.1", echo.port)
+            # activity keeps the relay open past the idle timeout
+            for _ in range(4):
+                time.sleep(0.2)
+                sock.sendall(b"ping")
+                assert sock.recv(4096) == b"ping"
+            assert timeouts.idle_timeouts == 0
+            assert 0.25 <= closed_after(sock) < 2
+    assert timeouts.idle_timeouts == 1
+
+
+def test_lifetime_timeout(echo):
+    timeouts = Timeouts(lifetime=0.5)
+    with socks_server(SocksProxy, proxy=subnet_proxy(), timeouts=timeouts) as server:
+        sock = socks_client(server.server_address[1])
+        with sock:
+            socks5_connect(sock, "127.0.0.1", echo.port)
+            sock.sendall(b"ping")
+            assert sock.recv(4096) == b"ping"
+            assert closed_after(sock) < 2
+    assert timeouts.lifetime_timeouts == 1
+
+
+def test_keepalive_options():
+    timeouts = Timeouts(keepalive=30, keepalive_interval=5, keepalive_count=3)
+    sock = socket.socket()
+    with sock:
+        timeouts.apply(sock)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 30
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL) == 5
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT) == 3
+    assert Timeouts(keepalive=0).sockopts == []
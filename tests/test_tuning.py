@@ -0,0 +1,89 @@
+import socket
+import struct
+
+from trevorproxy.lib.socks import SocksProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.pool import socks5_connect
+from trevorproxy.lib.tuning import (
+    SocketTuning,
+    IP_BIND_ADDRESS_NO_PORT,
+    get_preset,
+    presets,
+)
+
+from conftest import socks_server, socks_client
+
+
+class RefusingSocket:
+    """
+    Records setsockopt() calls and rejects one option
+    """
+
+    def __init__(self, refused):
+        self.refused = refused
+        self.calls = []
+
+    def setsockopt(self, level, option, value):
+        self.calls.append(option)
+        if option == self.refused:
+            raise OSError(92, "Protocol not available")
+
+
+def test_default_sets_nothing():
+    tuning = SocketTuning()
+    assert tuning.listener_opts == tuning.client_opts == tuning.egress_opts == []
+    assert str(tuning) == f"backlog={socket.SOMAXCONN}, relay_buffer=4,096"
+
+
+def test_presets():
+    for name in presets:
+        # SO_LINGER 0 drops unsent data, so it's opt-in only
+        assert not get_preset(name).linger
+    spray = get_preset("spray")
+    assert spray.nodelay and spray.bind_no_port
+    assert spray.backlog == 4096
+    assert get_preset("bulk").relay_buffer == 64 * 1024
+
+
+def test_apply_egress():
+    tuning = SocketTuning(nodelay=True, bind_no_port=True, linger=True, buffer=256 * 1024)
+    sock = socket.socket()
+    with sock:
+        tuning.apply_egress(sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_IP, IP_BIND_ADDRESS_NO_PORT)
+        onoff, seconds = struct.unpack("ii", sock.getsockopt(socket.SOL_SOCKET, socket.SO_LINGER, 8))
+        assert (onoff, seconds) == (1, 0)
+        # the kernel doubles the requested size for bookkeeping
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 256 * 1024
+    # the listener gets the buffers but not the egress-only options
+    assert tuning.listener_opts == tuning.egress_opts[:2]
+
+
+def test_rejected_options_are_skipped():
+    tuning = SocketTuning(nodelay=True, bind_no_port=True)
+    sock = RefusingSocket(IP_BIND_ADDRESS_NO_PORT)
+    tuning.apply_egress(sock)
+    tuning.apply_egress(sock)
+    # refused once, not tried again; the other option is still set every time
+    assert sock.calls == [
+        socket.TCP_NODELAY,
+        IP_BIND_ADDRESS_NO_PORT,
+        socket.TCP_NODELAY,
+    ]
+
+
+def test_server_uses_tuning(echo):
+    tuning = get_preset("spray")
+    proxy = SubnetProxy(subnet="127.51.0.0/16", interface="lo", version=4)
+    with socks_server(SocksProxy, proxy=proxy, tuning=tuning) as server:
+        assert server.request_queue_size == 4096
+        assert server.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 64 * 1024
+        sock = socks_client(server.server_address[1])
+        with sock:
+            socks5_connect(sock, "127.0.0.1", echo.port)
+            sock.sendall(b"ping")
+            assert sock.recv(4096) == b"ping"
+    # the source address was bound with IP_BIND_ADDRESS_NO_PORT set
+    (peer,) = echo.peers
+    assert peer.startswith("127.51.")
@@ -0,0 +1,166 @@
+import time
+import socket
+import struct
+import ipaddress
+
+import pytest
+
+from trevorproxy.lib.socks import SocksProxy
+from trevorproxy.lib.subnet import SubnetProxy
+from trevorproxy.lib.pool import recv_exact
+from trevorproxy.lib.registry import ConnectionRegistry
+from trevorproxy.lib.accounting import Accounting
+
+from conftest import socks_server, socks_client
+
+# every address in 127.0.0.0/8 is already local, so no route is needed
+SUBNET = ipaddress.ip_network("127.28.0.0/16")
+
+
+@pytest.fixture
+def server():
+    proxy = SubnetProxy(subnet=str(SUBNET), interface="lo", version=4)
+    with socks_server(SocksProxy, proxy=proxy, udp_timeout=2) as server:
+        yield server
+
+
+def associate(port):
+    """
+    UDP ASSOCIATE, returning the control connection and the relay address
+    """
+    control = socks_client(port)
+    control.sendall(b"\x05\x03\x00\x01" + b"\x00" * 6)
+    version, status, _, address_type = recv_exact(control, 4)
+    assert (version, status, address_type) == (5, 0, 1)
+    address = socket.inet_ntoa(recv_exact(control, 4))
+    port = struct.unpack("!H", recv_exact(control, 2))[0]
+    return control, (address, port)
+
+
+def datagram(address, port, payload):
+    return (
+        b"\x00\x00\x00\x01" + socket.inet_aton(address) + struct.pack("!H", port) + payload
+    )
+
+
+def test_udp_echo_from_subnet(server, echo):
+    control, relay = associate(server.server_address[1])
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    try:
+        for i in range(3):
+            payload = f"hello {i}".encode()
+            client.sendto(datagram("127.0.0.1", echo.udp_port, payload), relay)
+            data, sender = client.recvfrom(65535)
+            assert sender == relay
+            # the reply carries the echo server's address in its header
+            assert data == datagram("127.0.0.1", echo.udp_port, payload)
+    finally:
+        client.close()
+        control.close()
+
+    # the whole association leaves from one random address in the subnet
+    assert len(echo.peers) == 3
+    assert len(set(echo.peers)) == 1
+    assert ipaddress.ip_address(echo.peers[0]) in SUBNET
+
+
+def test_udp_associations_get_their_own_source(server, echo):
+    sources = set()
+    for _ in range(5):
+        control, relay = associate(server.server_address[1])
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        try:
+            client.sendto(datagram("127.0.0.1", echo.udp_port, b"x"), relay)
+            client.recvfrom(65535)
+        finally:
+            client.close()
+            control.close()
+        sources.add(echo.peers[-1])
+    assert len(sources) == 5
+
+
+def test_udp_ignores_other_senders(server, echo):
+    control, relay = associate(server.server_address[1])
+    # a datagram from an address other than the client's is dropped
+    stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stranger.bind(("127.0.0.2", 0))
+    stranger.settimeout(0.5)
+    try:
+        stranger.sendto(datagram("127.0.0.1", echo.udp_port, b"x"), relay)
+        with pytest.raises(socket.timeout):
+            stranger.recvfrom(65535)
+    finally:
+        stranger.close()
+        control.close()
+    assert echo.peers == []
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_udp_send_errors_dont_end_the_association(server, echo):
+    control, relay = associate(server.server_address[1])
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    try:
+        # sending to broadcast without SO_BROADCAST fails with EACCES
+        client.sendto(datagram("255.255.255.255", echo.udp_port, b"lost"), relay)
+        client.sendto(datagram("127.0.0.1", echo.udp_port, b"after"), relay)
+        data, _ = client.recvfrom(65535)
+        assert data == datagram("127.0.0.1", echo.udp_port, b"after")
+    finally:
+        client.close()
+        control.close()
+
+
+def test_udp_associations_are_registered_and_accounted(echo):
+    registry = ConnectionRegistry()
+    accounting = Accounting()
+    proxy = SubnetProxy(subnet=str(SUBNET), interface="lo", version=4)
+    with socks_server(
+        SocksProxy, proxy=proxy, udp_timeout=10, registry=registry, accounting=accounting
+    ) as server:
+        control, relay = associate(server.server_address[1])
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        try:
+            client.sendto(datagram("127.0.0.1", echo.udp_port, b"hello"), relay)
+            client.recvfrom(65535)
+            wait_for(lambda: registry.totals()["bytes_in"] == 5)
+            (conn,) = registry.connections()
+            assert conn.source == echo.peers[0]
+            assert conn.bytes_out == 5
+
+            # draining waits for the association, and closing it ends it
+            assert registry.drain(0.1) == 1
+            registry.close()
+            assert registry.drain(5) == 0
+        finally:
+            client.close()
+            control.close()
+        wait_for(lambda: accounting.usage["prefix"])
+
+    (usage,) = accounting.usage["prefix"].values()
+    assert (usage.connections, usage.bytes_out, usage.bytes_in) == (1, 5, 5)
+
+
+def test_udp_domain_names_use_the_destination_cache(server, echo):
+    control, relay = associate(server.server_address[1])
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    header = b"\x00\x00\x00\x03\x09localhost" + struct.pack("!H", echo.udp_port)
+    try:
+        for _ in range(3):
+            client.sendto(header + b"hello", relay)
+            data, _ = client.recvfrom(65535)
+            assert data == datagram("127.0.0.1", echo.udp_port, b"hello")
+    finally:
+        client.close()
+        control.close()
+    assert (server.destinations.misses, server.destinations.hits) == (1, 2)
@@ -6,21 +6,137 @@ import sys
 import time
 import logging
 import argparse
-import ipaddress
 from shutil import which
 from pathlib import Path
 
 package_path = Path(__file__).resolve().parent
 sys.path.append(str(package_path))
 
-import lib.logger
-from lib import util
 from lib import logger
 from lib.errors import *
 
 log = logging.getLogger("trevorproxy.cli")
 
 
+def make_feedback(options):
+    """
+    Feedback for quarantining burned source prefixes and failing upstreams, unless disabled
+    """
+    if options.quarantine_threshold <= 0:
+        return None
+    from lib.feedback import Feedback
+
+    return Feedback(
+        threshold=options.quarantine_threshold,
+        duration=options.quarantine_time,
+        source_prefix=getattr(options, "source_prefix", None),
+    )
+
+
+def serve(options, handlers, **server_kwargs):
+    """
+    Run the SOCKS (and optionally HTTP) listeners until interrupted, then drain active relays
+
+    `handlers` is a (SOCKS, HTTP, SOCKS+HTTP) tuple of request handler classes
+    """
+    import threading
+    import ipaddress
+    from lib import stats
+    from lib.timeouts import Timeouts
+    from lib.destination import DestinationCache
+    from lib.tuning import get_preset
+    from lib.socks import ThreadingTCPServer, ThreadingTCPServer6
+
+    socks_handler, http_handler, auto_handler = handlers
+    registry = server_kwargs["registry"]
+    scheduler = server_kwargs.pop("scheduler", None)
+
+    listen_address = ipaddress.ip_network(options.listen_address, strict=False)
+    tcp_server = (
+        ThreadingTCPServer if listen_address.version == 4 else ThreadingTCPServer6
+    )
+    timeouts = Timeouts(
+        handshake=options.handshake_timeout,
+        idle=options.idle_timeout,
+        lifetime=options.max_lifetime,
+        keepalive=options.keepalive,
+        user_timeout=options.user_timeout,
+    )
+    server_kwargs["timeouts"] = timeouts
+    destinations = server_kwargs.setdefault("destinations", DestinationCache())
+    tuning = server_kwargs.setdefault("tuning", get_preset(options.tuning))
+    log.debug(f'Socket tuning "{options.tuning}": {tuning}')
+    server_kwargs["scheduler"] = scheduler if scheduler else None
+
+    stats.register("Connections", registry.summary)
+    stats.register(
+        "Oldest connections",
+        lambda: [
+            str(c)
+            for c in sorted(registry.connections(), key=lambda c: c.started)[:10]
+        ],
+    )
+    stats.register("Timeouts", timeouts.summary)
+    stats.register("DNS cache", destinations.summary)
+    if scheduler:
+        stats.register("Queued connections", lambda: scheduler.queue_depth)
+    feedback = server_kwargs.get("feedback", None)
+    if feedback is not None:
+        stats.register("Quarantined", feedback.summary)
+
+    accounting = None
+    if options.accounting:
+        from lib.accounting import Accounting
+
+        accounting = Accounting(
+            path=options.accounting,
+            interval=options.accounting_interval,
+            source_prefix=getattr(options, "source_prefix", None),
+        )
+        accounting.start()
+        server_kwargs["accounting"] = accounting
+        stats.register("Top upstreams", lambda: accounting.top("upstream"))
+        stats.register("Top source prefixes", lambda: accounting.top("prefix"))
+
+    handler = socks_handler
+    http_server = None
+    if options.http_port is not None:
+        if options.http_port == options.port:
+            handler = auto_handler
+        else:
+            http_server = tcp_server(
+                (options.listen_address, options.http_port),
+                http_handler,
+                **server_kwargs,
+            )
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        log.info(f"Listening on http://{options.listen_address}:{options.http_port}")
+
+    try:
+        with tcp_server(
+            (options.listen_address, options.port),
+            handler,
+            **server_kwargs,
+        ) as server:
+            log.info(f"Listening on socks5://{options.listen_address}:{options.port}")
+            server.serve_forever()
+    finally:
+        if http_server is not None:
+            http_server.shutdown()
+            http_server.server_close()
+        # listeners are closed; give active relays a chance to finish
+        if len(registry):
+            log.info(
+                f"Waiting up to {options.drain_timeout}s for {len(registry):,} active connections to finish"
+            )
+            remaining = registry.drain(options.drain_timeout)
+            if remaining:
+                log.warning(f"Closing {remaining:,} active connections")
+                registry.close()
+        if accounting is not None:
+            accounting.stop()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Round-robin requests through multiple SSH tunnels via a single SOCKS server"
@@ -29,8 +145,7 @@ def main():
         "-p",
         "--port",
         type=int,
-        default=1080,
-        help="Port for SOCKS server to listen on (default: 1080)",
+        help="Port for SOCKS server to listen on (default: 1080, or 31337 for the coordinator)",
     )
     parser.add_argument(
         "-l",
@@ -38,6 +153,29 @@ def main():
         default="127.0.0.1",
         help="Listen address for SOCKS server (default: 127.0.0.1)",
     )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="JSON config file with subnet/blacklist or ssh_hosts, re-read on SIGHUP",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=int,
+        default=30,
+        help="On shutdown or reload, seconds to wait for active connections to finish (default: 30)",
+    )
+    parser.add_argument(
+        "--shard",
+        help="Only use this node's share of the subnet or SSH hosts, e.g. 1/3 for the first of three nodes",
+    )
+    parser.add_argument(
+        "--coordinator",
+        help="Get this node's shard from a coordinator (host:port) and report usage to it",
+    )
+    parser.add_argument(
+        "--node-name",
+        help="Name this node reports to the coordinator (default: hostname:port)",
+    )
     parser.add_argument("-q", "--quiet", action="store_true", help="Be quiet")
     parser.add_argument(
         "-v", "-d", "--verbose", "--debug", action="store_true", help="Be verbose"
@@ -45,16 +183,185 @@ def main():
 
     subparsers = parser.add_subparsers(dest="proxytype", help="proxy type")
 
-    subnet = subparsers.add_parser("subnet", help="round-robin traffic from subnet")
+    # options shared by the modes that run the SOCKS server in-process
+    listener = argparse.ArgumentParser(add_help=False)
+    listener.add_argument(
+        "--http-port",
+        type=int,
+        help="Also accept HTTP proxy requests on this port (same as --port to share it with SOCKS)",
+    )
+    listener.add_argument(
+        "--handshake-timeout",
+        type=int,
+        default=30,
+        help="Seconds a client has to finish its SOCKS/HTTP request (default: 30, 0 to disable)",
+    )
+    listener.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=0,
+        help="Close connections with no traffic for this many seconds (default: disabled)",
+    )
+    listener.add_argument(
+        "--max-lifetime",
+        type=int,
+        default=0,
+        help="Close connections after this many seconds regardless of activity (default: disabled)",
+    )
+    listener.add_argument(
+        "--keepalive",
+        type=int,
+        default=60,
+        help="Seconds of inactivity before sending TCP keepalives on both legs (default: 60, 0 to disable)",
+    )
+    listener.add_argument(
+        "--user-timeout",
+        type=int,
+        default=0,
+        help="TCP_USER_TIMEOUT in seconds for unacknowledged data on both legs (default: system default)",
+    )
+    listener.add_argument(
+        "--tuning",
+        choices=["default", "spray", "bulk"],
+        default="default",
+        help='Socket tuning preset: "spray" for many small connections, "bulk" for big transfers (default: default)',
+    )
+    listener.add_argument(
+        "--dest-rate",
+        type=float,
+        default=0,
+        help="Max new connections per second to each destination host (default: unlimited)",
+    )
+    listener.add_argument(
+        "--dest-concurrency",
+        type=int,
+        default=0,
+        help="Max concurrent connections to each destination host (default: unlimited)",
+    )
+
+    listener.add_argument(
+        "--quarantine-threshold",
+        type=float,
+        default=0,
+        help="Quarantine a source prefix or upstream for a destination after this many recent connect failures or early closes (default: 0, disabled)",
+    )
+    listener.add_argument(
+        "--quarantine-time",
+        type=int,
+        default=300,
+        help="Seconds a quarantined source prefix or upstream is avoided (default: 300)",
+    )
+    listener.add_argument(
+        "--accounting",
+        metavar="PATH",
+        help="Record connections, failures and bytes per upstream and source prefix in this SQLite database",
+    )
+    listener.add_argument(
+        "--accounting-interval",
+        type=int,
+        default=60,
+        help="Seconds between writes to the accounting database (default: 60)",
+    )
+
+    subnet = subparsers.add_parser(
+        "subnet", help="round-robin traffic from subnet", parents=[listener]
+    )
     subnet.add_argument("-i", "--interface", help="Interface to send packets on")
     subnet.add_argument(
-        "-s", "--subnet", required=True, help="Subnet to send packets from"
+        "-s", "--subnet", help="Subnet to send packets from"
+    )
+    subnet.add_argument(
+        "--sticky",
+        choices=["username", "destination"],
+        help="Reuse the same source address per SOCKS username or per destination host",
+    )
+    subnet.add_argument(
+        "--sticky-ttl",
+        type=int,
+        default=300,
+        help="Seconds of inactivity before a sticky source address is released (default: 300)",
+    )
+    subnet.add_argument(
+        "--sticky-size",
+        type=int,
+        default=100000,
+        help="Maximum number of sticky sessions to remember (default: 100000)",
+    )
+    subnet.add_argument(
+        "--udp-timeout",
+        type=int,
+        default=60,
+        help="Seconds before an idle UDP association is closed (default: 60)",
+    )
+    subnet.add_argument(
+        "--source-rate",
+        type=float,
+        default=0,
+        help="Max new connections per second from each source prefix (default: unlimited)",
+    )
+    subnet.add_argument(
+        "--source-concurrency",
+        type=int,
+        default=0,
+        help="Max concurrent connections from each source prefix (default: unlimited)",
+    )
+    subnet.add_argument(
+        "--source-prefix",
+        type=int,
+        help="Prefix length used to group source addresses for limits, accounting and quarantine (default: 64 for IPv6, 24 for IPv4)",
     )
 
-    ssh = subparsers.add_parser("ssh", help="round-robin traffic through SSH hosts")
+    coordinator = subparsers.add_parser(
+        "coordinator",
+        help="assign shards to other TREVORproxy nodes and aggregate their usage",
+    )
+    coordinator.add_argument(
+        "-n",
+        "--nodes",
+        type=int,
+        required=True,
+        help="Number of nodes to split the subnet or SSH hosts between",
+    )
+    coordinator.add_argument(
+        "--interval",
+        type=int,
+        default=10,
+        help="Seconds between usage summaries (default: 10)",
+    )
+
+    usage = subparsers.add_parser(
+        "usage", help="show the busiest upstreams or source prefixes from an accounting database"
+    )
+    usage.add_argument(
+        "database", help="Accounting database written by --accounting"
+    )
+    usage.add_argument(
+        "--by",
+        choices=["upstream", "prefix"],
+        default="upstream",
+        help="Group by upstream or by source prefix (default: upstream)",
+    )
+    usage.add_argument(
+        "--since",
+        default="24h",
+        help="Time window, e.g. 30m, 12h, 7d (default: 24h)",
+    )
+    usage.add_argument(
+        "--sort",
+        choices=["bytes", "connections", "failures"],
+        default="bytes",
+        help="Sort by (default: bytes)",
+    )
+    usage.add_argument(
+        "-n", "--top", type=int, default=20, help="Number of rows (default: 20)"
+    )
+
+    ssh = subparsers.add_parser(
+        "ssh", help="round-robin traffic through SSH hosts", parents=[listener]
+    )
     ssh.add_argument(
         "ssh_hosts",
-        nargs="+",
+        nargs="*",
         help="Round-robin load-balance through these SSH hosts (user@host)",
     )
     ssh.add_argument(
@@ -67,18 +374,177 @@ def main():
         type=int,
         help="Base listening port to use for SOCKS proxies (default: 32482)",
     )
+    ssh.add_argument(
+        "--prewarm",
+        type=int,
+        default=0,
+        help="Keep this many negotiated SOCKS sessions open to each tunnel. Clients are then served by "
+        "TREVORproxy's own listener instead of being redirected to the tunnels with iptables, which also "
+        "enables the listener options (default: 0)",
+    )
+
+    upstream = subparsers.add_parser(
+        "upstream",
+        help="balance traffic over local subnet egress, SSH hosts and external proxies",
+        parents=[listener],
+    )
+    upstream.add_argument(
+        "upstreams",
+        nargs="*",
+        help="Upstreams: ssh://user@host, socks5://[user:pass@]host:port or http://[user:pass@]host:port",
+    )
+    upstream.add_argument(
+        "-s", "--subnet", help="Also send traffic directly from this subnet"
+    )
+    upstream.add_argument(
+        "-i", "--interface", help="Interface to send subnet traffic on"
+    )
+    upstream.add_argument(
+        "-k", "--key", help="Use this SSH key when connecting to SSH upstreams"
+    )
+    upstream.add_argument(
+        "--base-port",
+        default=32482,
+        type=int,
+        help="Base listening port to use for SSH tunnels (default: 32482)",
+    )
+    upstream.add_argument(
+        "--max-connections",
+        type=int,
+        default=0,
+        help="Max concurrent connections through each upstream, override with ?max_connections=N (default: unlimited)",
+    )
+    upstream.add_argument(
+        "--max-failures",
+        type=int,
+        default=3,
+        help="Consecutive failures before an upstream is taken out of rotation (default: 3)",
+    )
+    upstream.add_argument(
+        "--retry-after",
+        type=int,
+        default=30,
+        help="Seconds before a failed upstream is tried again (default: 30)",
+    )
+    upstream.add_argument(
+        "--upstream-rate",
+        type=float,
+        default=0,
+        help="Max new connections per second through each upstream (default: unlimited)",
+    )
+    upstream.add_argument(
+        "--prewarm",
+        type=int,
+        default=0,
+        help="Keep this many negotiated sessions open to each SOCKS/SSH upstream (default: 0)",
+    )
 
     try:
         options = parser.parse_args()
+        if options.port is None:
+            options.port = 1080
+            if options.proxytype == "coordinator":
+                from lib.coordinator import DEFAULT_PORT
+
+                options.port = DEFAULT_PORT
 
         if not options.quiet:
             logging.getLogger("trevorproxy").setLevel(logging.DEBUG)
+        logger.log_to_file()
+
+        from lib import stats
+
+        # log stats on SIGUSR1
+        stats.install()
+
+        config = {}
+        if options.config:
+            from lib.reload import load_config, Reloader
+
+            config = load_config(options.config)
+            for k in ("subnet", "ssh_hosts"):
+                if k in config:
+                    setattr(options, k, config[k])
+
+        if options.proxytype == "coordinator":
+            from lib.coordinator import Coordinator
+
+            Coordinator(
+                address=options.listen_address,
+                port=options.port,
+                nodes=options.nodes,
+                interval=options.interval,
+            ).serve_forever()
+            return
+
+        if options.proxytype == "usage":
+            from lib.accounting import query, parse_duration
+
+            since = time.time() - parse_duration(options.since)
+            rows = query(
+                options.database,
+                kind=options.by,
+                since=since,
+                top=options.top,
+                order=options.sort,
+            )
+            print(
+                f"{options.by:<40} {'connections':>12} {'failures':>10} {'bytes out':>16} {'bytes in':>16}"
+            )
+            for key, connections, failures, bytes_out, bytes_in in rows:
+                print(
+                    f"{key:<40} {connections:>12,} {failures:>10,} {bytes_out:>16,} {bytes_in:>16,}"
+                )
+            return
+
+        if options.proxytype == "subnet" and not options.subnet:
+            parser.error("a subnet is required (-s or config file)")
+        elif options.proxytype == "ssh" and not options.ssh_hosts:
+            parser.error("at least one SSH host is required")
+        elif options.proxytype == "upstream" and not (
+            options.upstreams or options.subnet
+        ):
+            parser.error("at least one upstream or a subnet (-s) is required")
+
+        shard = None
+        coordinator_client = None
+        if options.shard and options.coordinator:
+            parser.error("--shard and --coordinator are mutually exclusive")
+        elif options.shard:
+            from lib.coordinator import parse_shard
+
+            shard = parse_shard(options.shard)
+        elif options.coordinator:
+            import socket
+            from lib.coordinator import CoordinatorClient, parse_address
+
+            host, port = parse_address(options.coordinator)
+            coordinator_client = CoordinatorClient(
+                host,
+                port,
+                node=options.node_name or f"{socket.gethostname()}:{options.port}",
+            )
+            shard = coordinator_client.join()
+        if shard is not None:
+            log.info(f"Using shard {shard[0] + 1}/{shard[1]}")
 
         if options.proxytype == "ssh":
+            from lib import util
             from lib.ssh import SSHLoadBalancer
+            from lib.coordinator import take_shard
+
+            ssh_hosts = take_shard(options.ssh_hosts, shard)
+            if not ssh_hosts:
+                raise TrevorProxyError(
+                    f"Shard {shard[0] + 1}/{shard[1]} has no SSH hosts, add more hosts or use fewer nodes"
+                )
 
             # make sure executables exist
-            for binary in SSHLoadBalancer.dependencies:
+            dependencies = SSHLoadBalancer.dependencies
+            if options.prewarm > 0:
+                # no iptables: connections go through our own listener
+                dependencies = ["ssh", "ss"]
+            for binary in dependencies:
                 if not which(binary):
                     log.error(f"Please install {binary}")
                     sys.exit(1)
@@ -86,32 +552,128 @@ def main():
             options.key_pass = util.get_ssh_key_passphrase(options.key)
 
             load_balancer = SSHLoadBalancer(
-                hosts=options.ssh_hosts,
+                hosts=ssh_hosts,
                 key=options.key,
                 key_pass=options.key_pass,
                 base_port=options.base_port,
-                socks_server=True,
+                socks_server=options.prewarm <= 0,
+                prewarm=options.prewarm,
             )
 
             try:
                 load_balancer.start()
-                log.info(
-                    f"Listening on socks5://{options.listen_address}:{options.port}"
+
+                stats.register(
+                    "Tunnel connections",
+                    lambda: [
+                        f"{p.host}: {p.active_connections():,}"
+                        for p in list(load_balancer.proxies.values())
+                        if p is not None
+                    ],
                 )
 
-                # serve forever
-                while 1:
-                    # rebuild proxy if it goes down
-                    for proxy in load_balancer.proxies.values():
-                        if not proxy.is_connected():
-                            log.debug(
-                                f"SSH Proxy {proxy} went down, attempting to rebuild"
+                if coordinator_client is not None:
+                    coordinator_client.start_reporting(
+                        lambda: {
+                            "active": sum(
+                                p.active_connections()
+                                for p in list(load_balancer.proxies.values())
+                                if p is not None
                             )
-                            proxy.start()
-                    time.sleep(1)
+                        }
+                    )
+
+                def rebuild():
+                    # rebuild proxies if they go down
+                    while 1:
+                        for proxy in list(load_balancer.proxies.values()):
+                            if proxy is not None and not proxy.is_connected():
+                                log.debug(
+                                    f"SSH Proxy {proxy} went down, attempting to rebuild"
+                                )
+                                try:
+                                    proxy.start()
+                                except Exception as e:
+                                    log.warning(e)
+                        time.sleep(1)
+
+                if options.prewarm <= 0:
+                    if options.config:
+                        Reloader(
+                            options.config,
+                            lambda c: load_balancer.reload(
+                                take_shard(c["ssh_hosts"], shard),
+                                drain_timeout=options.drain_timeout,
+                            )
+                            if "ssh_hosts" in c
+                            else None,
+                        ).install()
+                    # iptables sends clients straight to the tunnels
+                    log.info(
+                        f"Listening on socks5://{options.listen_address}:{options.port}"
+                    )
+                    rebuild()
+
+                # prewarmed sessions only help connections we open ourselves,
+                # so serve clients in-process and hand them to the tunnels' pools
+                import threading
+                from lib.ratelimit import ConnectScheduler, Limit
+                from lib.registry import ConnectionRegistry
+                from lib.upstream import (
+                    UpstreamBalancer,
+                    SSHUpstream,
+                    UpstreamSocksProxy,
+                    UpstreamHTTPProxy,
+                    UpstreamAutoProxy,
+                )
+
+                feedback = make_feedback(options)
+                upstreams = {}
+
+                def tunnels():
+                    # keep the same SSHUpstream (and its counters) for hosts that stay
+                    proxies = [p for p in load_balancer.proxies.values() if p is not None]
+                    for proxy in list(upstreams):
+                        if proxy not in proxies:
+                            del upstreams[proxy]
+                    for proxy in proxies:
+                        if proxy not in upstreams:
+                            upstreams[proxy] = SSHUpstream(proxy)
+                    return [upstreams[p] for p in proxies]
+
+                balancer = UpstreamBalancer(tunnels(), feedback=feedback)
+                if options.config:
+
+                    def apply_config(c):
+                        if "ssh_hosts" in c:
+                            load_balancer.reload(
+                                take_shard(c["ssh_hosts"], shard),
+                                drain_timeout=options.drain_timeout,
+                            )
+                            balancer.upstreams = tunnels()
+
+                    Reloader(options.config, apply_config).install()
+                threading.Thread(target=rebuild, daemon=True).start()
+
+                registry = ConnectionRegistry()
+                stats.register("Upstreams", balancer.summary)
+                serve(
+                    options,
+                    (UpstreamSocksProxy, UpstreamHTTPProxy, UpstreamAutoProxy),
+                    proxy=balancer,
+                    scheduler=ConnectScheduler(
+                        destination=Limit(
+                            rate=options.dest_rate,
+                            concurrency=options.dest_concurrency,
+                        )
+                    ),
+                    registry=registry,
+                    feedback=feedback,
+                )
 
             finally:
-                load_balancer.stop()
+                log.info("Shutting down, waiting for active connections to finish")
+                load_balancer.stop(drain_timeout=options.drain_timeout)
 
         elif options.proxytype == "subnet":
             # make sure executables exist
@@ -120,33 +682,217 @@ def main():
                     log.error(f"Please install {binary}")
                     sys.exit(1)
 
+            import threading
             from lib.subnet import SubnetProxy
-            from lib.socks import ThreadingTCPServer, ThreadingTCPServer6, SocksProxy
-
-            listen_address = ipaddress.ip_network(options.listen_address, strict=False)
+            from lib.ratelimit import ConnectScheduler, Limit
+            from lib.registry import ConnectionRegistry
+            from lib.socks import SocksProxy
+            from lib.http import HTTPProxy, AutoProxy
 
+            feedback = make_feedback(options)
             subnet_proxy = SubnetProxy(
-                interface=options.interface, subnet=options.subnet
+                interface=options.interface,
+                subnet=options.subnet,
+                sticky_ttl=options.sticky_ttl if options.sticky else 0,
+                sticky_size=options.sticky_size,
+                shard=shard,
+                feedback=feedback,
             )
             try:
+                if "blacklist" in config:
+                    subnet_proxy.reload(blacklist=config["blacklist"])
                 subnet_proxy.start()
-                tcp_server = (
-                    ThreadingTCPServer
-                    if listen_address.version == 4
-                    else ThreadingTCPServer6
+                registry = ConnectionRegistry()
+                if coordinator_client is not None:
+                    coordinator_client.start_reporting(registry.totals)
+
+                if options.config:
+
+                    def apply_config(c):
+                        subnet_proxy.reload(
+                            subnet=c.get("subnet", None),
+                            blacklist=c.get("blacklist", None),
+                        )
+                        # let relays on the old subnet finish before unrouting it
+                        threading.Thread(
+                            target=subnet_proxy.drain_retired,
+                            args=(registry, options.drain_timeout),
+                            daemon=True,
+                        ).start()
+
+                    Reloader(options.config, apply_config).install()
+                scheduler = ConnectScheduler(
+                    destination=Limit(
+                        rate=options.dest_rate, concurrency=options.dest_concurrency
+                    ),
+                    source=Limit(
+                        rate=options.source_rate,
+                        concurrency=options.source_concurrency,
+                    ),
+                    source_prefix=options.source_prefix,
                 )
-                with tcp_server(
-                    (options.listen_address, options.port),
-                    SocksProxy,
+                serve(
+                    options,
+                    (SocksProxy, HTTPProxy, AutoProxy),
                     proxy=subnet_proxy,
-                ) as server:
-                    log.info(
-                        f"Listening on socks5://{options.listen_address}:{options.port}"
-                    )
-                    server.serve_forever()
+                    sticky=options.sticky,
+                    udp_timeout=options.udp_timeout,
+                    scheduler=scheduler,
+                    registry=registry,
+                    feedback=feedback,
+                )
             finally:
                 subnet_proxy.stop()
 
+        elif options.proxytype == "upstream":
+            import threading
+            from lib.coordinator import take_shard
+            from lib.ratelimit import ConnectScheduler, Limit
+            from lib.registry import ConnectionRegistry
+            from lib.destination import DestinationCache
+            from lib.tuning import get_preset
+            from lib.upstream import (
+                UpstreamBalancer,
+                UpstreamSocksProxy,
+                UpstreamHTTPProxy,
+                UpstreamAutoProxy,
+                parse_upstream,
+            )
+
+            tuning = get_preset(options.tuning)
+            upstream_options = dict(
+                max_connections=options.max_connections,
+                max_failures=options.max_failures,
+                retry_after=options.retry_after,
+                tuning=tuning,
+            )
+            upstreams = []
+            destinations = DestinationCache()
+            feedback = make_feedback(options)
+            subnet_proxy = None
+            if options.subnet:
+                from lib.subnet import SubnetProxy
+                from lib.upstream import LocalUpstream
+
+                subnet_proxy = SubnetProxy(
+                    interface=options.interface,
+                    subnet=options.subnet,
+                    shard=shard,
+                    feedback=feedback,
+                )
+                if "blacklist" in config:
+                    subnet_proxy.reload(blacklist=config["blacklist"])
+                upstreams.append(
+                    LocalUpstream(subnet_proxy, destinations=destinations, **upstream_options)
+                )
+
+            urls = take_shard(options.upstreams, shard)
+            if any(u.startswith("ssh://") for u in urls):
+                from lib import util
+                from lib.ssh import SSHProxy
+                from lib.upstream import SSHUpstream
+
+                for binary in ["ssh", "ss"]:
+                    if not which(binary):
+                        log.error(f"Please install {binary}")
+                        sys.exit(1)
+                key_pass = util.get_ssh_key_passphrase(options.key)
+            for url in urls:
+                if url.startswith("ssh://"):
+                    ssh_proxy = SSHProxy(
+                        url[len("ssh://") :],
+                        options.base_port + len(upstreams),
+                        options.key,
+                        key_pass,
+                        prewarm=options.prewarm,
+                    )
+                    upstreams.append(SSHUpstream(ssh_proxy, **upstream_options))
+                else:
+                    upstreams.append(
+                        parse_upstream(url, prewarm=options.prewarm, **upstream_options)
+                    )
+            if not upstreams:
+                raise TrevorProxyError(
+                    f"Shard {shard[0] + 1}/{shard[1]} has no upstreams, add more upstreams or use fewer nodes"
+                )
+
+            balancer = UpstreamBalancer(upstreams, feedback=feedback)
+            try:
+                balancer.start()
+                ssh_proxies = [u.ssh_proxy for u in upstreams if hasattr(u, "ssh_proxy")]
+
+                # wait for the SSH tunnels to come up
+                for _ in range(30):
+                    if all(p.is_connected() for p in ssh_proxies):
+                        break
+                    time.sleep(1)
+
+                def monitor():
+                    # rebuild SSH tunnels if they go down
+                    while 1:
+                        for proxy in ssh_proxies:
+                            if not proxy.is_connected():
+                                log.debug(
+                                    f"SSH Proxy {proxy} went down, attempting to rebuild"
+                                )
+                                try:
+                                    proxy.start()
+                                except Exception as e:
+                                    log.warning(e)
+                        time.sleep(1)
+
+                if ssh_proxies:
+                    threading.Thread(target=monitor, daemon=True).start()
+
+                registry = ConnectionRegistry()
+                if coordinator_client is not None:
+                    coordinator_client.start_reporting(registry.totals)
+
+                if options.config:
+
+                    def apply_config(c):
+                        # upstreams come from the command line, only local egress is reloadable
+                        if "ssh_hosts" in c:
+                            log.warning("ssh_hosts can't be reloaded in upstream mode, ignoring")
+                        if "subnet" not in c and "blacklist" not in c:
+                            return
+                        if subnet_proxy is None:
+                            log.warning(
+                                "Subnet changes need a subnet (-s) at startup in upstream mode, ignoring"
+                            )
+                            return
+                        subnet_proxy.reload(
+                            subnet=c.get("subnet", None),
+                            blacklist=c.get("blacklist", None),
+                        )
+                        threading.Thread(
+                            target=subnet_proxy.drain_retired,
+                            args=(registry, options.drain_timeout),
+                            daemon=True,
+                        ).start()
+
+                    Reloader(options.config, apply_config).install()
+
+                stats.register("Upstreams", balancer.summary)
+                scheduler = ConnectScheduler(
+                    destination=Limit(
+                        rate=options.dest_rate, concurrency=options.dest_concurrency
+                    ),
+                    upstream=Limit(rate=options.upstream_rate),
+                )
+                serve(
+                    options,
+                    (UpstreamSocksProxy, UpstreamHTTPProxy, UpstreamAutoProxy),
+                    proxy=balancer,
+                    destinations=destinations,
+                    tuning=tuning,
+                    scheduler=scheduler,
+                    registry=registry,
+                    feedback=feedback,
+                )
+            finally:
+                balancer.stop()
+
         """
         from ipaddress import ip_network, ip_address
         blacklist = [ip_address('192.168.0.1'), ip_address('192.168.0.250'), ip_address('192.168.0.133')]
@@ -0,0 +1,181 @@
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+from .ratelimit import source_network
+from .errors import TrevorProxyError
+
+log = logging.getLogger("trevorproxy.accounting")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    time INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    connections INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    bytes_out INTEGER NOT NULL,
+    bytes_in INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS usage_kind_time ON usage (kind, time);
+"""
+
+
+class Usage:
+    __slots__ = ("connections", "failures", "bytes_out", "bytes_in")
+
+    def __init__(self):
+        self.connections = 0
+        self.failures = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+    def __str__(self):
+        return (
+            f"{self.connections:,} connections, {self.failures:,} failures, "
+            f"{self.bytes_out:,}/{self.bytes_in:,} bytes out/in"
+        )
+
+
+class Accounting:
+    """
+    Connections, failures and bytes per upstream and per source sub-prefix
+
+    Relays call record() once when they end, so the relay loop itself isn't slowed down.
+    If `path` is set, the counters are appended to an SQLite database every `interval`
+    seconds and reset; each row covers one key for one interval.
+    """
+
+    def __init__(self, path=None, interval=60, source_prefix=None):
+        self.path = None if path is None else Path(path)
+        self.interval = float(interval)
+        self.source_prefix = source_prefix
+        # kind ("upstream" or "prefix") --> key --> Usage
+        self.usage = {"upstream": {}, "prefix": {}}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, upstream=None, source=None, bytes_out=0, bytes_in=0, failed=False):
+        prefix = source_network(source, self.source_prefix)
+        with self._lock:
+            for kind, key in (("upstream", upstream), ("prefix", prefix)):
+                if key is None:
+                    continue
+                key = str(key)
+                usage = self.usage[kind].get(key, None)
+                if usage is None:
+                    usage = self.usage[kind][key] = Usage()
+                if failed:
+                    usage.failures += 1
+                else:
+                    usage.connections += 1
+                    usage.bytes_out += bytes_out
+                    usage.bytes_in += bytes_in
+
+    def start(self):
+        if self.path is None:
+            return
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        log.info(f"Writing usage to {self.path} every {self.interval:.0f}s")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.flush()
+
+    def flush(self):
+        """
+        Append the current counters to the database and reset them
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            usage = self.usage
+            self.usage = {"upstream": {}, "prefix": {}}
+        now = int(time.time())
+        rows = [
+            (now, kind, key, u.connections, u.failures, u.bytes_out, u.bytes_in)
+            for kind, keys in usage.items()
+            for key, u in keys.items()
+        ]
+        if not rows:
+            return
+        try:
+            with self._connect() as db:
+                db.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            log.error(f"Failed to write usage to {self.path}: {e}")
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def _connect(self):
+        return sqlite3.connect(str(self.path), timeout=30)
+
+    def top(self, kind, n=10):
+        """
+        Busiest keys since the last flush
+        """
+        with self._lock:
+            items = list(self.usage[kind].items())
+        items.sort(key=lambda i: i[1].bytes_out + i[1].bytes_in, reverse=True)
+        return [f"{key}: {u}" for key, u in items[:n]]
+
+
+def query(path, kind="upstream", since=None, until=None, top=10, order="bytes"):
+    """
+    Totals per key from an accounting database, busiest first
+    `since` and `until` are unix timestamps
+    Returns a list of (key, connections, failures, bytes_out, bytes_in)
+    """
+    if not Path(path).is_file():
+        raise TrevorProxyError(f"No accounting database at {path}")
+    order_by = {
+        "bytes": "SUM(bytes_out) + SUM(bytes_in)",
+        "connections": "SUM(connections)",
+        "failures": "SUM(failures)",
+    }[order]
+    where = ["kind = ?"]
+    args = [kind]
+    if since is not None:
+        where.append("time >= ?")
+        args.append(int(since))
+    if until is not None:
+        where.append("time < ?")
+        args.append(int(until))
+    sql = (
+        "SELECT key, SUM(connections), SUM(failures), SUM(bytes_out), SUM(bytes_in) "
+        f"FROM usage WHERE {' AND '.join(where)} GROUP BY key "
+        f"ORDER BY {order_by} DESC LIMIT ?"
+    )
+    args.append(int(top))
+    with sqlite3.connect(str(path), timeout=30) as db:
+        return db.execute(sql, args).fetchall()
+
+
+def parse_duration(s):
+    """
+    "90" / "30m" / "12h" / "7d" --> seconds
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    s = str(s).strip().lower()
+    try:
+        if s and s[-1] in units:
+            seconds = float(s[:-1]) * units[s[-1]]
+        else:
+            seconds = float(s)
+    except ValueError:
+        seconds = None
+    # also rules out "nan" and "inf"
+    if seconds is None or not 0 <= seconds < float("inf"):
+        raise TrevorProxyError(f'Invalid duration "{s}", e.g. 30m, 12h, 7d')
+    return seconds
@@ -0,0 +1,45 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class AffinityCache:
+    """
+    Bounded LRU mapping of session keys (SOCKS username, destination host) to pinned source addresses
+
+    Entries expire after `ttl` seconds of inactivity; when the cache is full, the least recently used entry is evicted
+    """
+
+    def __init__(self, maxsize=100000, ttl=300):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """
+        Return the address pinned to `key`, calling `factory()` to pin a new one if it's missing or expired
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is not None and entry[1] > now:
+                value = entry[0]
+            else:
+                value = factory()
+            self._cache[key] = (value, now + self.ttl)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+            return value
+
+    def discard(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,325 @@
+"""
+asyncio API for running TREVORproxy inside another program
+
+    from trevorproxy.lib.api import SubnetProxyServer, SSHProxyServer
+
+    async with SubnetProxyServer("dead:beef::/64", interface="eth0") as proxy:
+        # point a SOCKS client at the in-process listener
+        print(f"socks5://127.0.0.1:{proxy.port}")
+        # or pick a random source address and connect yourself
+        source = proxy.next_source()
+
+    async with SSHProxyServer(["root@1.2.3.4", "root@4.3.2.1"]) as proxy:
+        print(f"socks5://127.0.0.1:{proxy.port}")
+        # or talk to one tunnel directly
+        tunnel = proxy.next_upstream()
+
+Blocking work (routes, SSH startup, listener shutdown) runs in the default executor,
+so the event loop is never stalled.
+"""
+
+import asyncio
+import logging
+import threading
+
+from .registry import ConnectionRegistry
+
+log = logging.getLogger("trevorproxy.api")
+
+
+class ProxyServer:
+    """
+    Base class: runs a SOCKS5 listener in a background thread for the lifetime of the context manager
+    `port=0` picks a free port, available as `.port` once started
+    """
+
+    def __init__(
+        self,
+        listen_address="127.0.0.1",
+        port=0,
+        http=False,
+        drain_timeout=5,
+        **server_kwargs,
+    ):
+        self.listen_address = str(listen_address)
+        self.requested_port = int(port)
+        # accept HTTP proxy requests on the same port
+        self.http = http
+        self.drain_timeout = drain_timeout
+        self.server_kwargs = server_kwargs
+        self.registry = ConnectionRegistry()
+        self.server = None
+        self.port = None
+        self._thread = None
+
+    @property
+    def proxy(self):
+        """
+        The object passed to the SOCKS server as `proxy`
+        """
+        raise NotImplementedError
+
+    @property
+    def handler(self):
+        raise NotImplementedError
+
+    def _start_proxy(self):
+        pass
+
+    def _stop_proxy(self):
+        pass
+
+    def _serve(self):
+        from .socks import ThreadingTCPServer, ThreadingTCPServer6
+
+        tcp_server = ThreadingTCPServer6 if ":" in self.listen_address else ThreadingTCPServer
+        self.server = tcp_server(
+            (self.listen_address, self.requested_port),
+            self.handler,
+            proxy=self.proxy,
+            registry=self.registry,
+            **self.server_kwargs,
+        )
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        log.info(f"Listening on socks5://{self.listen_address}:{self.port}")
+
+    def _shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            if self.registry.drain(self.drain_timeout):
+                self.registry.close()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._start_proxy)
+        try:
+            await loop.run_in_executor(None, self._serve)
+        except Exception:
+            await loop.run_in_executor(None, self._stop_proxy)
+            raise
+        return self.port
+
+    async def stop(self):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._shutdown)
+        finally:
+            await loop.run_in_executor(None, self._stop_proxy)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.stop()
+
+
+class SubnetProxyServer(ProxyServer):
+    """
+    Sends traffic from random addresses in `subnet` (see SubnetProxy for the options)
+    Pass a Feedback to move away from source prefixes that get blocked
+    """
+
+    def __init__(
+        self,
+        subnet,
+        interface=None,
+        sticky=None,
+        sticky_ttl=300,
+        feedback=None,
+        listen_address="127.0.0.1",
+        port=0,
+        http=False,
+        **server_kwargs,
+    ):
+        from .subnet import SubnetProxy
+
+        super().__init__(
+            listen_address=listen_address,
+            port=port,
+            http=http,
+            sticky=sticky,
+            feedback=feedback,
+            **server_kwargs,
+        )
+        self.subnet_proxy = SubnetProxy(
+            subnet=subnet,
+            interface=interface,
+            sticky_ttl=sticky_ttl if sticky else 0,
+            feedback=feedback,
+        )
+
+    @property
+    def proxy(self):
+        return self.subnet_proxy
+
+    @property
+    def handler(self):
+        if self.http:
+            from .http import AutoProxy
+
+            return AutoProxy
+        from .socks import SocksProxy
+
+        return SocksProxy
+
+    def next_source(self, key=None):
+        """
+        A random source address from the subnet (an ipaddress object)
+        Bind a socket to it to send traffic from it directly
+        """
+        return self.subnet_proxy.next_source(key)
+
+    def connector(self, **kwargs):
+        """
+        Connector for opening connections from random source addresses without the SOCKS hop
+        """
+        from .connector import Connector
+
+        return Connector(self.subnet_proxy, **kwargs)
+
+    def _start_proxy(self):
+        self.subnet_proxy.start()
+
+    def _stop_proxy(self):
+        self.subnet_proxy.stop()
+
+
+class SSHProxyServer(ProxyServer):
+    """
+    Round-robins traffic through SSH tunnels behind one SOCKS port, without touching iptables
+    Pass a Feedback to skip tunnels whose egress address gets blocked
+    """
+
+    def __init__(
+        self,
+        hosts,
+        key=None,
+        key_pass="",
+        base_port=32482,
+        prewarm=0,
+        timeout=30,
+        feedback=None,
+        listen_address="127.0.0.1",
+        port=0,
+        http=False,
+        **server_kwargs,
+    ):
+        from .ssh import SSHLoadBalancer
+
+        super().__init__(
+            listen_address=listen_address,
+            port=port,
+            http=http,
+            feedback=feedback,
+            **server_kwargs,
+        )
+        self.timeout = timeout
+        self.feedback = feedback
+        self.load_balancer = SSHLoadBalancer(
+            hosts=hosts,
+            key=key,
+            key_pass=key_pass,
+            base_port=base_port,
+            prewarm=prewarm,
+        )
+        self.balancer = None
+        # seconds between tunnel health checks
+        self.monitor_interval = 1
+        self._monitor = None
+        self._restart = None
+
+    @property
+    def proxy(self):
+        return self.balancer
+
+    @property
+    def handler(self):
+        from .upstream import UpstreamSocksProxy, UpstreamAutoProxy
+
+        return UpstreamAutoProxy if self.http else UpstreamSocksProxy
+
+    def next_upstream(self):
+        """
+        The next SSHProxy in the rotation
+        Use `.connect(address, port)` on it for a tunnelled socket, or its `socks5://127.0.0.1:<port>` URL
+        """
+        return next(self.load_balancer)
+
+    def connector(self, **kwargs):
+        """
+        Connector for opening tunnelled connections without the SOCKS hop
+        """
+        from .connector import Connector
+
+        return Connector(self.load_balancer, **kwargs)
+
+    async def start(self):
+        from .errors import SSHProxyError
+        from .upstream import UpstreamBalancer, SSHUpstream
+
+        proxies = [p for p in self.load_balancer.proxies.values() if p is not None]
+        loop = asyncio.get_running_loop()
+        for proxy in proxies:
+            await loop.run_in_executor(None, lambda p=proxy: p.start(wait=False))
+
+        # wait for all the tunnels without blocking the loop
+        for _ in range(int(self.timeout)):
+            if all(p.is_connected() for p in proxies):
+                break
+            for p in proxies:
+                if not p.sh.is_alive():
+                    await self._stop_proxy_async()
+                    raise SSHProxyError(f"Failed to start SSH proxy {p}: {p.command}")
+            await asyncio.sleep(1)
+        else:
+            await self._stop_proxy_async()
+            raise SSHProxyError("Timed out waiting for SSH proxies to start")
+
+        self.balancer = UpstreamBalancer(
+            [SSHUpstream(p) for p in proxies], feedback=self.feedback
+        )
+        port = await super().start()
+        self._monitor = asyncio.create_task(self._watch_tunnels(proxies))
+        return port
+
+    async def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            try:
+                await self._monitor
+            except asyncio.CancelledError:
+                pass
+            self._monitor = None
+        # let a restart that's already running finish, so it can't outlive _stop_proxy()
+        if self._restart is not None:
+            await asyncio.wait([self._restart])
+            self._restart = None
+        await super().stop()
+
+    async def _watch_tunnels(self, proxies):
+        """
+        Rebuild SSH tunnels that go down
+        is_connected() also refreshes the `running` flag that SSHUpstream.is_healthy() checks
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            for proxy in proxies:
+                if not proxy.is_connected():
+                    log.debug(f"SSH Proxy {proxy} went down, attempting to rebuild")
+                    self._restart = loop.run_in_executor(None, proxy.start)
+                    try:
+                        await asyncio.shield(self._restart)
+                    except Exception as e:
+                        log.warning(e)
+            await asyncio.sleep(self.monitor_interval)
+
+    async def _stop_proxy_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, self._stop_proxy)
+
+    def _stop_proxy(self):
+        self.load_balancer.stop()
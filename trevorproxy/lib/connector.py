@@ -0,0 +1,214 @@
+"""
+Direct egress for code running in the same process: sockets come back already bound to a
+random source address (SubnetProxy) or already tunnelled (SSHLoadBalancer), with no SOCKS hop
+
+    connector = Connector(subnet_proxy)
+    sock = connector.connect("example.com", 443)
+    reader, writer = await connector.open_connection("example.com", 443, ssl=True)
+    conn = connector.http_connection("example.com", https=True)
+    opener = connector.urllib_opener()
+    session.mount("https://", connector.requests_adapter())
+"""
+
+import socket
+import asyncio
+import logging
+import http.client
+import urllib.request
+from functools import partial
+
+from .upstream import LocalUpstream
+from .errors import TrevorProxyError
+
+log = logging.getLogger("trevorproxy.connector")
+
+# optional
+try:
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection as _URLLib3HTTPConnection
+    from urllib3.connection import HTTPSConnection as _URLLib3HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+except ImportError:
+    HTTPAdapter = None
+
+
+def _timeout(timeout):
+    # http.client and urllib3 use sentinel objects for "default"
+    return timeout if isinstance(timeout, (int, float)) else None
+
+
+class Connector:
+    """
+    Opens outgoing connections through a SubnetProxy or an SSHLoadBalancer
+    The SubnetProxy must already be started (its route added)
+    """
+
+    def __init__(self, proxy, timeout=None, tuning=None, destinations=None):
+        self.proxy = proxy
+        self.timeout = timeout
+        self.local = None
+        if hasattr(proxy, "next_source"):
+            self.local = LocalUpstream(proxy, destinations=destinations, tuning=tuning)
+
+    def connect(self, host, port, timeout=None, key=None):
+        """
+        Blocking socket connected to (host, port)
+        `key` pins a source address when the SubnetProxy has sticky sessions enabled
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if self.local is not None:
+            sock, _, _ = self.local.connect(
+                host,
+                port,
+                key=key,
+                before_connect=lambda sock, source: sock.settimeout(timeout),
+            )
+            return sock
+
+        proxy = next(self.proxy)
+        # SSHLoadBalancer yields None for "current_ip"
+        if proxy is None:
+            return socket.create_connection((host, port), timeout=timeout)
+        sock = proxy.connect(host, port)
+        sock.settimeout(timeout)
+        return sock
+
+    async def connect_async(self, host, port, key=None):
+        """
+        Non-blocking socket connected to (host, port)
+        """
+        loop = asyncio.get_running_loop()
+        if self.local is None:
+            sock = await loop.run_in_executor(None, self.connect, host, port, None, key)
+            sock.setblocking(False)
+            return sock
+
+        # only the lookup can block (and it's usually cached)
+        address, family = await loop.run_in_executor(None, self.local.resolve, host)
+        sock, _ = self.local.bind(family, key, f"{host}:{port}")
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (address, port))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def open_connection(self, host, port, key=None, **kwargs):
+        """
+        Drop-in for asyncio.open_connection(); extra kwargs (ssl, limit, ...) are passed through
+        """
+        sock = await self.connect_async(host, port, key=key)
+        if kwargs.get("ssl", None) and "server_hostname" not in kwargs:
+            kwargs["server_hostname"] = host
+        try:
+            return await asyncio.open_connection(sock=sock, **kwargs)
+        except BaseException:
+            sock.close()
+            raise
+
+    def http_connection(self, host, port=None, https=False, **kwargs):
+        """
+        http.client.HTTP(S)Connection that connects through this connector
+        """
+        if https:
+            return HTTPSConnection(host, port, connector=self, **kwargs)
+        return HTTPConnection(host, port, connector=self, **kwargs)
+
+    def urllib_opener(self):
+        """
+        urllib.request opener whose requests leave through this connector
+        """
+        return urllib.request.build_opener(
+            ConnectorHTTPHandler(self), ConnectorHTTPSHandler(self)
+        )
+
+    def requests_adapter(self, **kwargs):
+        """
+        Transport adapter for requests: session.mount("https://", connector.requests_adapter())
+        """
+        if HTTPAdapter is None:
+            raise TrevorProxyError("Please install requests to use requests_adapter()")
+        return ConnectorAdapter(self, **kwargs)
+
+
+class HTTPConnection(http.client.HTTPConnection):
+    def __init__(self, host, port=None, connector=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.connector = connector
+
+    def connect(self):
+        self.sock = self.connector.connect(
+            self.host, self.port, timeout=_timeout(self.timeout)
+        )
+
+
+class HTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, port=None, connector=None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.connector = connector
+
+    def connect(self):
+        sock = self.connector.connect(self.host, self.port, timeout=_timeout(self.timeout))
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+class ConnectorHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, connector):
+        super().__init__()
+        self.connector = connector
+
+    def http_open(self, req):
+        return self.do_open(partial(HTTPConnection, connector=self.connector), req)
+
+
+class ConnectorHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, connector):
+        super().__init__()
+        self.connector = connector
+
+    def https_open(self, req):
+        return self.do_open(
+            partial(HTTPSConnection, connector=self.connector, context=self._context),
+            req,
+        )
+
+
+if HTTPAdapter is not None:
+
+    class ConnectorAdapter(HTTPAdapter):
+        """
+        requests adapter: urllib3 connections are opened by the connector instead of socket.create_connection
+        """
+
+        def __init__(self, connector, **kwargs):
+            self.connector = connector
+            super().__init__(**kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            connector = self.connector
+
+            def new_conn(conn):
+                return connector.connect(
+                    conn._dns_host, conn.port, timeout=_timeout(conn.timeout)
+                )
+
+            http_connection = type(
+                "HTTPConnection", (_URLLib3HTTPConnection,), {"_new_conn": new_conn}
+            )
+            https_connection = type(
+                "HTTPSConnection", (_URLLib3HTTPSConnection,), {"_new_conn": new_conn}
+            )
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": type(
+                    "HTTPConnectionPool",
+                    (HTTPConnectionPool,),
+                    {"ConnectionCls": http_connection},
+                ),
+                "https": type(
+                    "HTTPSConnectionPool",
+                    (HTTPSConnectionPool,),
+                    {"ConnectionCls": https_connection},
+                ),
+            }
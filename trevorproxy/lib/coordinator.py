@@ -0,0 +1,205 @@
+"""
+Lightweight coordination between several TREVORproxy nodes
+
+Each node owns a disjoint shard (index, count) of the address space or SSH host list.
+Shards can be given statically (--shard 1/3) or assigned by a coordinator process,
+which also aggregates the usage stats every node reports. Messages are single JSON
+datagrams over UDP:
+
+    node -> coordinator:    {"type": "join", "node": "<name>"}
+    coordinator -> node:    {"type": "shard", "index": 0, "count": 3}
+    node -> coordinator:    {"type": "report", "node": "<name>", "shard": [0, 3], "stats": {...}}
+"""
+
+import json
+import time
+import socket
+import logging
+import threading
+
+from .errors import TrevorProxyError
+
+log = logging.getLogger("trevorproxy.coordinator")
+
+DEFAULT_PORT = 31337
+
+
+def parse_shard(s):
+    """
+    "1/3" --> (0, 3)
+    Shards are numbered from 1 on the command line
+    """
+    try:
+        number, count = [int(i) for i in str(s).split("/")]
+    except ValueError:
+        raise TrevorProxyError(f'Invalid shard "{s}", must be in the format N/COUNT')
+    if count < 1 or not 1 <= number <= count:
+        raise TrevorProxyError(f'Invalid shard "{s}", N must be between 1 and COUNT')
+    return number - 1, count
+
+
+def parse_address(s, default_port=DEFAULT_PORT):
+    host, _, port = str(s).rpartition(":")
+    if not host:
+        host, port = port, default_port
+    return host.strip("[]"), int(port)
+
+
+def take_shard(items, shard):
+    """
+    This node's share of a list (e.g. SSH hosts)
+    """
+    if shard is None:
+        return list(items)
+    index, count = shard
+    return list(items)[index::count]
+
+
+class Coordinator:
+    """
+    Hands out shards to joining nodes and aggregates their usage reports
+    """
+
+    def __init__(self, address="127.0.0.1", port=DEFAULT_PORT, nodes=1, interval=10):
+        self.address = address
+        self.port = int(port)
+        self.count = int(nodes)
+        self.interval = float(interval)
+        # node name --> shard index
+        self.assignments = {}
+        # node name --> (time received, report)
+        self.reports = {}
+        self.sock = None
+        self._stop = threading.Event()
+
+    def serve_forever(self):
+        family = socket.AF_INET6 if ":" in self.address else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind((self.address, self.port))
+        self.sock.settimeout(self.interval)
+        log.info(
+            f"Coordinating {self.count} nodes on udp://{self.address}:{self.port}"
+        )
+        last_summary = time.monotonic()
+        with self.sock:
+            while not self._stop.is_set():
+                try:
+                    data, sender = self.sock.recvfrom(65535)
+                    self.handle(data, sender)
+                except socket.timeout:
+                    pass
+                except Exception as e:
+                    log.error(f"Error handling message: {e}")
+                if time.monotonic() - last_summary >= self.interval:
+                    last_summary = time.monotonic()
+                    for line in self.summary():
+                        log.info(line)
+
+    def stop(self):
+        """
+        Make serve_forever() return (within one interval)
+        """
+        self._stop.set()
+
+    def handle(self, data, sender):
+        message = json.loads(data)
+        node = str(message["node"])
+        if message["type"] == "join":
+            reply = self.assign(node)
+            self.sock.sendto(json.dumps(reply).encode(), sender)
+        elif message["type"] == "report":
+            self.reports[node] = (time.monotonic(), message)
+
+    def assign(self, node):
+        if node not in self.assignments:
+            used = set(self.assignments.values())
+            free = [i for i in range(self.count) if i not in used]
+            if not free:
+                log.error(f"No free shards for node {node}")
+                return {"type": "error", "error": "All shards are taken"}
+            self.assignments[node] = free[0]
+            log.info(f"Assigned shard {free[0] + 1}/{self.count} to {node}")
+        return {"type": "shard", "index": self.assignments[node], "count": self.count}
+
+    def summary(self):
+        lines = []
+        totals = {"active": 0, "connections": 0, "bytes_out": 0, "bytes_in": 0}
+        now = time.monotonic()
+        for node, (received, report) in sorted(self.reports.items()):
+            stats = report.get("stats", {})
+            stale = " (stale)" if now - received > self.interval * 3 else ""
+            shard = report.get("shard", None)
+            shard = f"{shard[0] + 1}/{shard[1]}" if shard else "-"
+            lines.append(
+                f"{node} [shard {shard}]{stale}: {stats.get('active', 0):,} active, "
+                f"{stats.get('connections', 0):,} total, "
+                f"{stats.get('bytes_out', 0):,}/{stats.get('bytes_in', 0):,} bytes out/in"
+            )
+            for k in totals:
+                totals[k] += int(stats.get(k, 0))
+        if lines:
+            lines.insert(
+                0,
+                f"All nodes: {totals['active']:,} active, {totals['connections']:,} total, "
+                f"{totals['bytes_out']:,}/{totals['bytes_in']:,} bytes out/in",
+            )
+        return lines
+
+
+class CoordinatorClient:
+    """
+    Joins a coordinator to get a shard, then periodically reports usage stats
+    """
+
+    def __init__(self, address, port, node, interval=10):
+        self.address = (address, int(port))
+        self.node = str(node)
+        self.interval = float(interval)
+        self.shard = None
+        family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+
+    def join(self, timeout=10):
+        """
+        Ask the coordinator for this node's shard, retrying until `timeout`
+        """
+        deadline = time.monotonic() + timeout
+        message = json.dumps({"type": "join", "node": self.node}).encode()
+        self.sock.settimeout(1)
+        while time.monotonic() < deadline:
+            self.sock.sendto(message, self.address)
+            try:
+                reply = json.loads(self.sock.recv(65535))
+            except socket.timeout:
+                continue
+            if reply.get("type") == "shard":
+                self.shard = (int(reply["index"]), int(reply["count"]))
+                log.info(
+                    f"Coordinator assigned shard {self.shard[0] + 1}/{self.shard[1]}"
+                )
+                return self.shard
+            raise TrevorProxyError(f"Coordinator refused to assign a shard: {reply}")
+        raise TrevorProxyError(
+            f"No response from coordinator at {self.address[0]}:{self.address[1]}"
+        )
+
+    def start_reporting(self, get_stats):
+        """
+        Send `get_stats()` to the coordinator every interval
+        """
+
+        def report():
+            while 1:
+                try:
+                    message = {
+                        "type": "report",
+                        "node": self.node,
+                        "shard": self.shard,
+                        "stats": get_stats(),
+                    }
+                    self.sock.sendto(json.dumps(message).encode(), self.address)
+                except Exception as e:
+                    log.debug(f"Failed to report to coordinator: {e}")
+                time.sleep(self.interval)
+
+        threading.Thread(target=report, daemon=True).start()
@@ -31,7 +31,11 @@ import ipaddress
 from random import randint
 
 
-def ipgen(network="0.0.0.0/0", blacklist=None):
+def ipgen(network="0.0.0.0/0", blacklist=None, shard=None):
+    """
+    `shard` is an optional (index, count) tuple; only addresses where int(ip) % count == index
+    are yielded, so nodes with different indexes never hand out the same address
+    """
     if blacklist is None:
         blacklist = set()
     else:
@@ -50,9 +54,15 @@ def ipgen(network="0.0.0.0/0", blacklist=None):
         # don't give a shit
         ip_generator = prig(net)
 
-    for ip in ip_generator:
-        if ip not in blacklist:
-            yield ip
+    if shard is None:
+        for ip in ip_generator:
+            if ip not in blacklist:
+                yield ip
+    else:
+        index, count = shard
+        for ip in ip_generator:
+            if int(ip) % count == index and ip not in blacklist:
+                yield ip
 
 
 def prig(net):
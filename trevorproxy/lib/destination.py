@@ -0,0 +1,76 @@
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger("trevorproxy.destination")
+
+
+class DestinationCache:
+    """
+    Bounded LRU of resolved hostnames, so repeated connections to the same targets skip getaddrinfo
+
+    Entries expire `ttl` seconds after they were resolved (failures after `negative_ttl`).
+    Lookups happen outside the lock, so a slow resolver never blocks hits on other hosts.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, negative_ttl=5):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, family=socket.AF_INET):
+        """
+        Return (family, address) for `host`, preferring `family`, or None if it can't be resolved
+        """
+        if isinstance(host, bytes):
+            host = host.decode("utf-8", errors="ignore")
+        key = (host.lower(), family)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is not None and entry[1] > now:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        result = self._lookup(host, family)
+
+        expires = now + (self.ttl if result is not None else self.negative_ttl)
+        with self._lock:
+            self._cache[key] = (result, expires)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _lookup(host, family):
+        other = socket.AF_INET if family == socket.AF_INET6 else socket.AF_INET6
+        for f in (family, other):
+            try:
+                address = socket.getaddrinfo(host, 0, f, socket.SOCK_STREAM)[0][-1][0]
+            except OSError:
+                log.debug("Failed to resolve %s via %s", host, f)
+                continue
+            log.debug("Resolved %s to %s", host, address)
+            return f, address
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"{len(self):,} cached, {self.hits:,} hits, {self.misses:,} misses ({rate:.1f}% hit rate)"
+
+    def __len__(self):
+        return len(self._cache)
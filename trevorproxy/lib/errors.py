@@ -8,3 +8,11 @@ class SSHProxyError(TrevorProxyError):
 
 class InterfaceProxyError(TrevorProxyError):
     pass
+
+
+class SubnetProxyError(TrevorProxyError):
+    pass
+
+
+class UpstreamError(TrevorProxyError):
+    pass
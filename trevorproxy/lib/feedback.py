@@ -0,0 +1,269 @@
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+
+from . import reply as socks_reply
+from .pool import SocksReplyError
+from .ratelimit import source_network
+from .errors import UpstreamError
+
+log = logging.getLogger("trevorproxy.feedback")
+
+
+class FailureScores:
+    """
+    Decaying failure scores with temporary quarantine, in a bounded LRU
+
+    Scores are kept per (egress, destination); a destination of None stands for every
+    destination. Each failure adds 1 to a score and each success takes off `success_credit`.
+    Scores halve every `half_life` seconds, so old failures are forgotten. When a score
+    reaches `threshold`, the egress is quarantined for that destination for `duration` seconds.
+    """
+
+    def __init__(
+        self, threshold=5, duration=300, half_life=60, success_credit=0.5, maxsize=10000
+    ):
+        self.threshold = float(threshold)
+        self.duration = float(duration)
+        self.half_life = float(half_life)
+        self.success_credit = float(success_credit)
+        self.maxsize = max(1, int(maxsize))
+        # (egress, destination) --> [score, last update, quarantined until]
+        self._scores = OrderedDict()
+        # destination --> {egress: quarantined until}, replaced (never modified) on each change
+        # so lookups don't need the lock
+        self._active = {}
+        self._lock = threading.Lock()
+        # number of quarantines so far; lets callers skip lookups while it's 0
+        self.quarantines = 0
+
+    def _entry(self, key, now):
+        entry = self._scores.get(key, None)
+        if entry is None:
+            entry = self._scores[key] = [0.0, now, 0]
+            if len(self._scores) > self.maxsize:
+                self._scores.popitem(last=False)
+        else:
+            # decay in whole seconds, so a burst of `threshold` failures always trips it
+            elapsed = int(now - entry[1])
+            if elapsed:
+                entry[0] *= 0.5 ** (elapsed / self.half_life)
+                entry[1] += elapsed
+            self._scores.move_to_end(key)
+        return entry
+
+    def failure(self, egress, destination=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry((egress, destination), now)
+            entry[0] += 1
+            if entry[0] >= self.threshold and entry[2] <= now:
+                entry[2] = now + self.duration
+                # start over once the quarantine ends
+                entry[0] = 0.0
+                self._quarantine(egress, destination, entry[2], now)
+                self.quarantines += 1
+                target = "" if destination is None else f" for {destination}"
+                log.warning(f"Quarantining {egress}{target} for {self.duration:.0f}s")
+
+    def _quarantine(self, egress, destination, until, now):
+        # drop expired quarantines while we're copying anyway
+        active = {}
+        for d, egresses in self._active.items():
+            egresses = {e: u for e, u in egresses.items() if u > now}
+            if egresses:
+                active[d] = egresses
+        active.setdefault(destination, {})[egress] = until
+        self._active = active
+
+    def success(self, egress, destination=None):
+        now = time.monotonic()
+        key = (egress, destination)
+        with self._lock:
+            if key in self._scores:
+                entry = self._entry(key, now)
+                entry[0] = max(0.0, entry[0] - self.success_credit)
+
+    def is_quarantined(self, egress, destination=None):
+        active = self._active
+        now = time.monotonic()
+        for d in (destination, None):
+            egresses = active.get(d, None)
+            if egresses is not None and egresses.get(egress, 0) > now:
+                return True
+        return False
+
+    def quarantined_for(self, destination=None):
+        """
+        {egress: quarantined until} for `destination`, including quarantines for all destinations
+        """
+        active = self._active
+        now = time.monotonic()
+        quarantined = {}
+        for d in {destination, None}:
+            egresses = active.get(d, None)
+            if egresses is not None:
+                quarantined.update((e, u) for e, u in egresses.items() if u > now)
+        return quarantined
+
+    def quarantined(self):
+        """
+        [(egress, destination, seconds left), ...]
+        """
+        now = time.monotonic()
+        return [
+            (egress, destination, until - now)
+            for destination, egresses in self._active.items()
+            for egress, until in egresses.items()
+            if until > now
+        ]
+
+    def __len__(self):
+        return len(self._scores)
+
+
+class Feedback:
+    """
+    Steers traffic away from burned source prefixes and failing upstreams
+
+    Handlers report failed connects, relays the destination closed before sending anything,
+    and relays that worked, along with the destination ("host:port"). A source prefix or
+    upstream is only quarantined for the destination that keeps failing, so one closed port
+    doesn't burn it for every target. Failures of the upstream itself (UpstreamError) count
+    for all destinations. SubnetProxy and the balancers check burned_sources() and
+    upstream_ok() when picking egress, and fall back to quarantined ones only when nothing
+    else is left.
+    """
+
+    # SOCKS replies from an upstream that say nothing about its egress being blocked
+    # (upstreams answer HOST_UNREACHABLE when their own lookup fails)
+    ignored_replies = {
+        socks_reply.HOST_UNREACHABLE,
+        socks_reply.COMMAND_NOT_SUPPORTED,
+        socks_reply.ADDRESS_TYPE_NOT_SUPPORTED,
+    }
+
+    def __init__(
+        self,
+        threshold=5,
+        duration=300,
+        half_life=60,
+        early_close=5,
+        source_prefix=None,
+        maxsize=10000,
+    ):
+        self.source_prefix = source_prefix
+        # relays that get no response within this many seconds count as failures
+        self.early_close = float(early_close)
+        options = dict(
+            threshold=threshold, duration=duration, half_life=half_life, maxsize=maxsize
+        )
+        self.sources = FailureScores(**options)
+        self.upstreams = FailureScores(**options)
+        # destination --> (quarantines, expires, burned_sources() result)
+        self._burned = {}
+        self._maxsize = max(1, int(maxsize))
+
+    @classmethod
+    def counts(cls, error):
+        """
+        Whether an error could be caused by the egress (a block) rather than the request
+        """
+        if isinstance(error, UpstreamError):
+            return True
+        if isinstance(error, SocksReplyError):
+            return error.reply_code not in cls.ignored_replies
+        # lookup failures have nothing to do with where traffic leaves from
+        return isinstance(error, OSError) and not isinstance(error, socket.gaierror)
+
+    def connect_failed(self, source=None, upstream=None, error=None, destination=None):
+        if error is not None and not self.counts(error):
+            return
+        # the upstream itself failed, not just the connection to this destination
+        upstream_destination = None if isinstance(error, UpstreamError) else destination
+        self._report(source, upstream, destination, upstream_destination, failed=True)
+
+    def relay_finished(
+        self,
+        source=None,
+        upstream=None,
+        bytes_out=0,
+        bytes_in=0,
+        age=0,
+        destination=None,
+        remote_closed=False,
+    ):
+        if bytes_in:
+            self._report(source, upstream, destination, destination, failed=False)
+        elif bytes_out and remote_closed and age < self.early_close:
+            # the client spoke, the destination hung up without answering
+            log.debug(f"Early close from source {source}, upstream {upstream}")
+            self._report(source, upstream, destination, destination, failed=True)
+
+    def _report(self, source, upstream, destination, upstream_destination, failed):
+        for scores, key, target in (
+            (self.sources, source_network(source, self.source_prefix), destination),
+            (self.upstreams, None if upstream is None else str(upstream), upstream_destination),
+        ):
+            if key is None:
+                continue
+            if failed:
+                scores.failure(key, target)
+            else:
+                scores.success(key, target)
+
+    def source_ok(self, address, destination=None):
+        if not self.sources.quarantines:
+            return True
+        return not self.sources.is_quarantined(
+            source_network(address, self.source_prefix), destination
+        )
+
+    def burned_sources(self, destination=None):
+        """
+        Source prefixes quarantined for `destination` as {ip version: (prefixlen, netmask,
+        network addresses)} with ints throughout, or None
+
+        A candidate address is burned if `int(address) & netmask in network_addresses`, so
+        callers can test many of them cheaply. Results are cached until a quarantine starts
+        or ends.
+        """
+        scores = self.sources
+        quarantines = scores.quarantines
+        if not quarantines:
+            return None
+        now = time.monotonic()
+        cached = self._burned.get(destination, None)
+        if cached is not None and cached[0] == quarantines and cached[1] > now:
+            return cached[2]
+
+        quarantined = scores.quarantined_for(destination)
+        burned = None
+        expires = float("inf")
+        if quarantined:
+            expires = min(quarantined.values())
+            burned = {}
+            for network in quarantined:
+                _, netmask, networks = burned.setdefault(
+                    network.version, (network.prefixlen, int(network.netmask), set())
+                )
+                networks.add(int(network.network_address))
+        if len(self._burned) >= self._maxsize:
+            self._burned = {}
+        self._burned[destination] = (quarantines, expires, burned)
+        return burned
+
+    def upstream_ok(self, upstream, destination=None):
+        if not self.upstreams.quarantines:
+            return True
+        return not self.upstreams.is_quarantined(str(upstream), destination)
+
+    def summary(self):
+        lines = []
+        for scores in (self.sources, self.upstreams):
+            for egress, destination, left in scores.quarantined():
+                target = "" if destination is None else f" for {destination}"
+                lines.append(f"{egress}{target} quarantined for another {left:.0f}s")
+        return lines
@@ -0,0 +1,201 @@
+import socket
+import logging
+import traceback
+from urllib.parse import urlsplit
+
+from . import reply as socks_reply
+from .socks import SocksProxy, SOCKS_VERSION
+
+log = logging.getLogger("trevorproxy.http")
+
+# max size of an HTTP request head
+MAX_HEADER_SIZE = 65536
+# request headers meant for the proxy, not the destination
+HOP_BY_HOP_HEADERS = {
+    b"proxy-connection",
+    b"proxy-authorization",
+    b"connection",
+    b"keep-alive",
+}
+# never dropped because the Connection header names them: they frame the request
+FRAMING_HEADERS = {b"host", b"content-length", b"transfer-encoding"}
+
+
+class HTTPProxy(SocksProxy):
+    """
+    HTTP proxy front-end supporting CONNECT tunnels and absolute-URI forwarding
+
+    Shares the outbound connector (source address randomization) and relay loop with SocksProxy
+    """
+
+    def handle(self):
+        log.debug("Accepting connection from %s:%s", *self.client_address[:2])
+        self.handle_http()
+
+    def handle_http(self):
+        self.username = ""
+        self.ticket = None
+        self.source_address = None
+        self.destination = None
+        self.upstream = None
+
+        try:
+            head, leftover = self.read_head()
+            self.handshake_done()
+            request_line, headers = self.parse_head(head)
+            method, target, version = request_line.split(b" ", 2)
+            method = method.upper()
+
+            if method == b"CONNECT":
+                host, port = self.split_host_port(target.decode(), 443)
+                payload = b""
+            else:
+                url = urlsplit(target.decode())
+                if url.scheme != "http" or not url.hostname:
+                    self.send_error(400, "Bad Request")
+                    return
+                host = url.hostname
+                port = url.port or 80
+                path = url.path or "/"
+                if url.query:
+                    path += f"?{url.query}"
+                # rewrite to origin-form, one request per connection
+                drop = HOP_BY_HOP_HEADERS | self.connection_options(headers)
+                headers = [(k, v) for k, v in headers if k.lower() not in drop]
+                headers.append((b"Connection", b"close"))
+                payload = b"\r\n".join(
+                    [b" ".join([method, path.encode(), version])]
+                    + [k + b": " + v for k, v in headers]
+                ) + b"\r\n\r\n"
+        except Exception as e:
+            if log.level <= logging.DEBUG:
+                e = traceback.format_exc()
+            log.error(f"Error in HTTP request: {e}")
+            self.send_error(400, "Bad Request")
+            return
+
+        try:
+            self.address_family = self.default_family()
+            address = self.literal_address(host)
+            if address is None:
+                address = self.resolve(host)
+                if address is None:
+                    log.error(f"Could not resolve hostname {host}")
+                    self.send_error(502, "Bad Gateway")
+                    return
+            log.debug(f"Destination address: {address}")
+            self.destination = f"{host}:{port}"
+            remote = self.connect_remote(address, port, host.lower())
+            log.debug(f"Connected to {address}:{port}")
+        except Exception as e:
+            self.connect_failed(e)
+            timed_out = socks_reply.error_code(e) == socks_reply.TTL_EXPIRED
+            if log.level <= logging.DEBUG:
+                e = traceback.format_exc()
+            log.error(f"Error in HTTP reply: {e}")
+            if timed_out:
+                self.send_error(504, "Gateway Timeout")
+            else:
+                self.send_error(502, "Bad Gateway")
+            return
+
+        if method == b"CONNECT":
+            self.connection.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        try:
+            remote.sendall(payload + leftover)
+        except Exception as e:
+            log.error(f"Error forwarding HTTP request: {e}")
+            remote.close()
+            return
+
+        self.exchange_loop(self.connection, remote)
+        self.server.close_request(self.request)
+
+    def read_head(self):
+        """
+        Read until the end of the request head
+        Returns the head and any bytes received after it
+        """
+        data = b""
+        while 1:
+            chunk = self.connection.recv(4096)
+            if not chunk:
+                raise ConnectionError("Client closed connection before sending request")
+            data += chunk
+            end = data.find(b"\r\n\r\n")
+            if end != -1:
+                return data[:end], data[end + 4 :]
+            if len(data) > MAX_HEADER_SIZE:
+                raise ValueError("Request head too large")
+
+    @staticmethod
+    def parse_head(head):
+        lines = head.split(b"\r\n")
+        headers = []
+        for line in lines[1:]:
+            k, _, v = line.partition(b":")
+            headers.append((k.strip(), v.strip()))
+        return lines[0], headers
+
+    @staticmethod
+    def connection_options(headers):
+        """
+        Lowercased names listed in Connection headers, which are hop-by-hop too (RFC 7230 section 6.1)
+        """
+        options = set()
+        for k, v in headers:
+            if k.lower() == b"connection":
+                options.update(o.strip().lower() for o in v.split(b","))
+        return options - FRAMING_HEADERS
+
+    @staticmethod
+    def split_host_port(hostport, default_port):
+        if hostport.startswith("["):
+            host, _, rest = hostport[1:].partition("]")
+            port = rest.lstrip(":")
+        elif hostport.count(":") == 1:
+            host, port = hostport.split(":")
+        else:
+            host, port = hostport, ""
+        return host, int(port) if port else default_port
+
+    def literal_address(self, host):
+        """
+        Return host if it is an IP address (and set self.address_family), otherwise None
+        """
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host)
+            except OSError:
+                continue
+            self.address_family = family
+            return host
+        return None
+
+    def send_error(self, code, message):
+        try:
+            self.connection.sendall(
+                f"HTTP/1.1 {code} {message}\r\nConnection: close\r\nContent-Length: 0\r\n\r\n".encode()
+            )
+        except Exception:
+            pass
+
+
+class AutoProxy(HTTPProxy):
+    """
+    Accepts both SOCKS5 and HTTP proxy requests on the same port, detected by the first byte
+    """
+
+    def handle(self):
+        try:
+            first = self.connection.recv(1, socket.MSG_PEEK)
+        except Exception as e:
+            log.error(f"Error detecting protocol: {e}")
+            return
+        if not first:
+            return
+        if first[0] == SOCKS_VERSION:
+            SocksProxy.handle(self)
+        else:
+            log.debug("Accepting connection from %s:%s", *self.client_address[:2])
+            self.handle_http()
@@ -8,13 +8,27 @@ from pathlib import Path
 
 log_dir = Path.home() / ".trevorproxy"
 log_file = log_dir / "trevorproxy.log"
-log_dir.mkdir(exist_ok=True)
 
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
-file_handler = logging.FileHandler(str(log_file))
-file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+file_handler = None
 
 root_logger = logging.getLogger("trevorproxy")
-root_logger.handlers = [console_handler, file_handler]
+root_logger.handlers = [console_handler]
 root_logger.setLevel(logging.DEBUG)
+
+
+def log_to_file():
+    """
+    Start logging to ~/.trevorproxy/trevorproxy.log
+    Called once arguments are parsed, so e.g. --help never touches the filesystem
+    """
+    global file_handler
+    if file_handler is None:
+        log_dir.mkdir(exist_ok=True)
+        # the file isn't opened until the first message is written
+        file_handler = logging.FileHandler(str(log_file), delay=True)
+        file_handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+        )
+        root_logger.addHandler(file_handler)
@@ -0,0 +1,462 @@
+"""
+Interface, address, neighbor and route discovery over rtnetlink
+
+Replaces forking `ip -j ...` and parsing its JSON. Dumps are cached in a snapshot
+that a monitor thread keeps current from kernel change events, so repeated lookups
+(e.g. building blacklists for every pool argument) are free.
+"""
+
+import os
+import time
+import errno
+import socket
+import struct
+import logging
+import ipaddress
+import threading
+
+log = logging.getLogger("trevorproxy.netlink")
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+NDA_DST = 1
+
+NUD_NOARP = 0x40
+
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+
+RT_SCOPE_UNIVERSE = 0
+RT_TABLE_MAIN = 254
+
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+NLMSGHDR = struct.Struct("=IHHII")
+RTATTR = struct.Struct("=HH")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTMSG = struct.Struct("=BBBBBBBBI")
+NDMSG = struct.Struct("=BBHiHBB")
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def parse_attrs(data, offset):
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, kind = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[kind & 0x3FFF] = data[offset + RTATTR.size : offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _address(family, raw):
+    if family == socket.AF_INET and len(raw) == 4:
+        return ipaddress.IPv4Address(raw)
+    elif family == socket.AF_INET6 and len(raw) == 16:
+        return ipaddress.IPv6Address(raw)
+    return None
+
+
+def dump(msg_type, body):
+    """
+    Send an rtnetlink dump request and yield (type, payload) for each reply message
+    """
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        seq = int(time.time()) & 0xFFFFFFFF
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(body), msg_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0
+        )
+        sock.sendall(header + body)
+
+        while 1:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, kind, flags, msg_seq, pid = NLMSGHDR.unpack_from(data, offset)
+                if length < NLMSGHDR.size:
+                    return
+                payload = data[offset + NLMSGHDR.size : offset + length]
+                offset += _align(length)
+                if msg_seq != seq:
+                    continue
+                if kind == NLMSG_DONE:
+                    return
+                elif kind == NLMSG_ERROR:
+                    (error,) = struct.unpack_from("=i", payload)
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return
+                yield kind, payload
+
+
+def _parse_link(payload):
+    _, _, index, flags, _ = IFINFOMSG.unpack_from(payload)
+    attrs = parse_attrs(payload, IFINFOMSG.size)
+    ifname = attrs.get(IFLA_IFNAME, b"").rstrip(b"\0").decode()
+    return index, {"ifname": ifname, "flags": flags}
+
+
+def _parse_address(payload):
+    family, prefixlen, _, scope, index = IFADDRMSG.unpack_from(payload)
+    attrs = parse_attrs(payload, IFADDRMSG.size)
+    # IFA_LOCAL is the local address on point-to-point links, otherwise it's IFA_ADDRESS
+    address = _address(family, attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS, b"")))
+    if address is None:
+        return None
+    return {
+        "index": index,
+        "address": ipaddress.ip_interface(f"{address}/{prefixlen}"),
+        "scope": scope,
+    }
+
+
+def _parse_neighbor(payload):
+    """
+    (ifindex, address) of a neighbor entry, or None if it should be ignored
+    """
+    family, _, _, index, state, _, _ = NDMSG.unpack_from(payload)
+    # like `ip neigh`, skip static no-ARP entries (multicast, etc.)
+    if state & NUD_NOARP:
+        return None
+    attrs = parse_attrs(payload, NDMSG.size)
+    address = _address(family, attrs.get(NDA_DST, b""))
+    if address is None:
+        return None
+    return index, address
+
+
+def get_links():
+    """
+    {index: {"ifname": str, "flags": int}}
+    """
+    links = {}
+    for _, payload in dump(RTM_GETLINK, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+        index, link = _parse_link(payload)
+        links[index] = link
+    return links
+
+
+def get_addresses():
+    """
+    [{"index": int, "address": IPv4Interface/IPv6Interface, "scope": int}]
+    """
+    addresses = []
+    for _, payload in dump(RTM_GETADDR, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)):
+        address = _parse_address(payload)
+        if address is not None:
+            addresses.append(address)
+    return addresses
+
+
+def get_neighbor_links():
+    """
+    {address: {ifindex, ...}} for every neighbor entry
+    """
+    neighbors = {}
+    for _, payload in dump(
+        RTM_GETNEIGH, NDMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0)
+    ):
+        neighbor = _parse_neighbor(payload)
+        if neighbor is not None:
+            index, address = neighbor
+            neighbors.setdefault(address, set()).add(index)
+    return neighbors
+
+
+def get_neighbors():
+    return set(get_neighbor_links())
+
+
+def get_gateways(table=RT_TABLE_MAIN):
+    gateways = set()
+    for _, payload in dump(
+        RTM_GETROUTE, RTMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0, 0, 0)
+    ):
+        family = payload[0]
+        attrs = parse_attrs(payload, RTMSG.size)
+        route_table = payload[4]
+        if RTA_TABLE in attrs:
+            (route_table,) = struct.unpack("=I", attrs[RTA_TABLE])
+        if table is not None and route_table != table:
+            continue
+        address = _address(family, attrs.get(RTA_GATEWAY, b""))
+        if address is not None:
+            gateways.add(address)
+    return gateways
+
+
+class Discovery:
+    """
+    Cached snapshot of links, addresses, neighbors and gateways
+
+    Call subscribe() to start a monitor thread which keeps the snapshot current and notifies
+    callbacks whenever the kernel reports a change to it. Link, address and neighbor events
+    are applied from the message itself (neighbor state changes that don't add or remove an
+    address are ignored); route events only mark the gateways for a fresh dump, since one
+    gateway can back several routes. Each table is replaced rather than modified, so a
+    snapshot handed out earlier never changes underneath its reader.
+    """
+
+    groups = (
+        RTMGRP_LINK
+        | RTMGRP_NEIGH
+        | RTMGRP_IPV4_IFADDR
+        | RTMGRP_IPV4_ROUTE
+        | RTMGRP_IPV6_IFADDR
+        | RTMGRP_IPV6_ROUTE
+    )
+
+    tables = ("links", "addresses", "neighbors", "gateways")
+
+    def __init__(self):
+        # table name --> contents, or None until it's (re-)dumped
+        self._snapshot = None
+        # address --> ifindexes with a neighbor entry for it, backing snapshot["neighbors"]
+        self._neighbor_links = {}
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._monitor = None
+        # seconds before reopening the event socket after an error (doubles up to 60)
+        self.retry_delay = 1
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                snapshot = dict.fromkeys(self.tables)
+            stale = [name for name, table in snapshot.items() if table is None]
+            if stale:
+                snapshot = dict(snapshot)
+                for name in stale:
+                    snapshot[name] = self._dump(name)
+                self._snapshot = snapshot
+            return snapshot
+
+    def _dump(self, name):
+        if name == "links":
+            return get_links()
+        elif name == "addresses":
+            return get_addresses()
+        elif name == "neighbors":
+            self._neighbor_links = get_neighbor_links()
+            return set(self._neighbor_links)
+        return get_gateways()
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def subscribe(self, callback):
+        """
+        Call `callback()` after every change to links, addresses, neighbors or routes
+        """
+        self._callbacks.append(callback)
+        if self._monitor is None:
+            self._monitor = threading.Thread(target=self._watch, daemon=True)
+            self._monitor.start()
+
+    def unsubscribe(self, callback):
+        try:
+            self._callbacks.remove(callback)
+        except ValueError:
+            pass
+
+    def _open(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        try:
+            sock.bind((0, self.groups))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _watch(self):
+        try:
+            sock = self._open()
+        except Exception as e:
+            log.warning(f"Unable to monitor netlink events: {e}")
+            self._monitor = None
+            return
+
+        while 1:
+            with sock:
+                self._read(sock)
+            # events were missed while the socket was down
+            self._changed()
+            sock = None
+            delay = self.retry_delay
+            while sock is None:
+                time.sleep(delay)
+                try:
+                    sock = self._open()
+                except Exception as e:
+                    log.debug(f"Failed to reopen netlink socket: {e}")
+                    delay = min(delay * 2, 60)
+            log.debug("Netlink monitor restarted")
+
+    def _read(self, sock):
+        """
+        Handle events until the socket fails
+        """
+        while 1:
+            try:
+                changed = self._handle(sock.recv(65536))
+                # changes arrive in bursts; apply them all and notify once
+                while 1:
+                    try:
+                        data = sock.recv(65536, socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    changed = self._handle(data) or changed
+            except Exception as e:
+                if getattr(e, "errno", None) != errno.ENOBUFS:
+                    log.warning(f"Error reading netlink events, restarting monitor: {e}")
+                    return
+                # the socket overflowed and events were dropped; we can't tell which,
+                # so refresh everything and keep reading
+                log.debug("Netlink event buffer overflowed, refreshing")
+                self.invalidate()
+                changed = True
+            if changed:
+                self._notify()
+
+    def _handle(self, data):
+        """
+        Apply every event in `data` to the snapshot; returns whether anything changed
+        """
+        changed = False
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            length, kind, _, _, _ = NLMSGHDR.unpack_from(data, offset)
+            if length < NLMSGHDR.size:
+                break
+            payload = data[offset + NLMSGHDR.size : offset + length]
+            offset += _align(length)
+            with self._lock:
+                try:
+                    changed = self._apply(kind, payload) or changed
+                except Exception as e:
+                    log.debug(f"Failed to parse netlink event {kind}: {e}")
+                    self._snapshot = None
+                    changed = True
+        return changed
+
+    def _apply(self, kind, payload):
+        snapshot = self._snapshot
+        if kind in (RTM_NEWNEIGH, RTM_DELNEIGH):
+            table = "neighbors"
+        elif kind in (RTM_NEWADDR, RTM_DELADDR):
+            table = "addresses"
+        elif kind in (RTM_NEWLINK, RTM_DELLINK):
+            table = "links"
+        elif kind in (RTM_NEWROUTE, RTM_DELROUTE):
+            table = "gateways"
+        else:
+            return False
+        if snapshot is None or snapshot[table] is None:
+            # nothing cached to update, but subscribers still need to know
+            return True
+
+        if table == "neighbors":
+            neighbor = _parse_neighbor(payload)
+            if neighbor is None:
+                return False
+            index, address = neighbor
+            links = self._neighbor_links.get(address, set())
+            if kind == RTM_NEWNEIGH:
+                if index in links:
+                    # a state change (REACHABLE, STALE, ...) of an entry we already have
+                    return False
+                self._neighbor_links[address] = links | {index}
+                if links:
+                    return False
+                value = snapshot["neighbors"] | {address}
+            else:
+                if index not in links:
+                    return False
+                links = links - {index}
+                if links:
+                    self._neighbor_links[address] = links
+                    return False
+                self._neighbor_links.pop(address, None)
+                value = snapshot["neighbors"] - {address}
+
+        elif table == "addresses":
+            address = _parse_address(payload)
+            if address is None:
+                return False
+            key = (address["index"], address["address"])
+            value = [
+                a for a in snapshot["addresses"] if (a["index"], a["address"]) != key
+            ]
+            if kind == RTM_NEWADDR:
+                value.append(address)
+            if value == snapshot["addresses"]:
+                return False
+
+        elif table == "links":
+            index, link = _parse_link(payload)
+            value = dict(snapshot["links"])
+            if kind == RTM_NEWLINK:
+                value[index] = link
+            else:
+                value.pop(index, None)
+            if value == snapshot["links"]:
+                return False
+
+        else:
+            # one gateway can back several routes, so dump them again when needed
+            value = None
+
+        self._snapshot = dict(snapshot, **{table: value})
+        return True
+
+    def _changed(self):
+        self.invalidate()
+        self._notify()
+
+    def _notify(self):
+        for callback in list(self._callbacks):
+            try:
+                callback()
+            except Exception as e:
+                log.error(f"Error in netlink callback: {e}")
+
+
+# shared snapshot for the whole process
+discovery = Discovery()
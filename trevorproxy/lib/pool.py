@@ -0,0 +1,238 @@
+import time
+import select
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+
+log = logging.getLogger("trevorproxy.pool")
+SOCKS_VERSION = 5
+
+
+class SocksReplyError(ConnectionError):
+    """
+    Upstream SOCKS server refused a request; `reply_code` is passed on to our client
+    """
+
+    def __init__(self, reply_code):
+        self.reply_code = reply_code
+        super().__init__(f"Upstream SOCKS server returned error {reply_code}")
+
+
+def recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by upstream proxy")
+        data += chunk
+    return data
+
+
+def socks5_greeting(sock, username=None, password=None):
+    """
+    Negotiate the "no authentication" method with a SOCKS5 server,
+    or username/password authentication if credentials are given
+    """
+    if username is None:
+        sock.sendall(struct.pack("!BBB", SOCKS_VERSION, 1, 0))
+    else:
+        sock.sendall(struct.pack("!BBBB", SOCKS_VERSION, 2, 0, 2))
+    version, method = struct.unpack("!BB", recv_exact(sock, 2))
+    if version != SOCKS_VERSION or method not in (0, 2):
+        raise ConnectionError(f"Upstream SOCKS server rejected greeting ({method})")
+    if method == 2:
+        if username is None:
+            raise ConnectionError("Upstream SOCKS server requires authentication")
+        username = username.encode()
+        password = (password or "").encode()
+        sock.sendall(
+            struct.pack("!BB", 1, len(username))
+            + username
+            + struct.pack("!B", len(password))
+            + password
+        )
+        _, status = struct.unpack("!BB", recv_exact(sock, 2))
+        if status != 0:
+            raise ConnectionError("Upstream SOCKS server rejected credentials")
+
+
+def socks5_connect(sock, address, port):
+    """
+    Send a SOCKS5 CONNECT request over an already-negotiated socket
+    Returns the (address, port) bound by the upstream proxy
+    """
+    try:
+        request = b"\x01" + socket.inet_pton(socket.AF_INET, address)
+    except OSError:
+        try:
+            request = b"\x04" + socket.inet_pton(socket.AF_INET6, address)
+        except OSError:
+            hostname = address.encode("idna")
+            request = struct.pack("!BB", 3, len(hostname)) + hostname
+    sock.sendall(
+        struct.pack("!BBB", SOCKS_VERSION, 1, 0) + request + struct.pack("!H", port)
+    )
+
+    version, status, _, address_type = struct.unpack("!BBBB", recv_exact(sock, 4))
+    if status != 0:
+        raise SocksReplyError(status)
+    if address_type == 1:
+        bind_address = socket.inet_ntop(socket.AF_INET, recv_exact(sock, 4))
+    elif address_type == 4:
+        bind_address = socket.inet_ntop(socket.AF_INET6, recv_exact(sock, 16))
+    else:
+        bind_address = recv_exact(sock, recv_exact(sock, 1)[0]).decode()
+    bind_port = struct.unpack("!H", recv_exact(sock, 2))[0]
+    return bind_address, bind_port
+
+
+class SocksPool:
+    """
+    Keeps a few SOCKS5 sessions to an upstream proxy (e.g. an `ssh -D` port) open and negotiated
+    up to the request stage, so that a new connection only needs to send its CONNECT
+
+    Idle sessions are evicted after `idle_timeout` seconds and any session the upstream has
+    closed is discarded during the periodic health check. Sessions keep `connect_timeout`
+    until the upstream has answered the CONNECT, so a stalled upstream can't hang a caller
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        size=4,
+        idle_timeout=60,
+        interval=1,
+        username=None,
+        password=None,
+        connect_timeout=10,
+    ):
+        self.host = str(host)
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.size = int(size)
+        self.idle_timeout = float(idle_timeout)
+        self.interval = float(interval)
+        self.connect_timeout = float(connect_timeout)
+
+        self.hits = 0
+        self.misses = 0
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            if not self._stop.is_set():
+                return
+            # wait for a previous maintenance thread to finish stopping
+            self._thread.join()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._maintain, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for sock, _ in idle:
+            self._close(sock)
+
+    def get(self):
+        """
+        Return a negotiated socket, from the pool if possible
+        It still has the connect timeout, which the caller clears once its CONNECT is answered
+        """
+        while 1:
+            with self._lock:
+                try:
+                    sock, _ = self._idle.popleft()
+                except IndexError:
+                    break
+            if self._healthy(sock):
+                self.hits += 1
+                return sock
+            self._close(sock)
+
+        self.misses += 1
+        return self._open()
+
+    def connect(self, address, port):
+        """
+        Open a tunnelled connection to (address, port) through the upstream proxy
+        """
+        sock = self.get()
+        try:
+            socks5_connect(sock, address, port)
+        except Exception:
+            self._close(sock)
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def _open(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            socks5_greeting(sock, self.username, self.password)
+        except Exception:
+            self._close(sock)
+            raise
+        # the timeout stays until the CONNECT reply; connect() clears it
+        return sock
+
+    def _healthy(self, sock):
+        # the upstream shouldn't send anything before our request;
+        # if a negotiated session is readable, it's been closed or is in a bad state
+        try:
+            r, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not r
+
+    def _close(self, sock):
+        try:
+            sock.close()
+        except Exception:
+            pass
+
+    def _maintain(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                fresh = deque()
+                stale = []
+                for sock, created in self._idle:
+                    if now - created > self.idle_timeout or not self._healthy(sock):
+                        stale.append(sock)
+                    else:
+                        fresh.append((sock, created))
+                self._idle = fresh
+                missing = self.size - len(self._idle)
+            for sock in stale:
+                self._close(sock)
+
+            for _ in range(missing):
+                try:
+                    sock = self._open()
+                except Exception as e:
+                    log.debug(f"Failed to prewarm session to {self.host}:{self.port}: {e}")
+                    break
+                with self._lock:
+                    if self._stop.is_set():
+                        self._close(sock)
+                        break
+                    self._idle.append((sock, time.monotonic()))
+
+            self._stop.wait(self.interval)
+
+    def __len__(self):
+        return len(self._idle)
+
+    def __str__(self):
+        return f"SocksPool(socks5://{self.host}:{self.port}, {len(self)}/{self.size})"
@@ -0,0 +1,217 @@
+import time
+import logging
+import ipaddress
+import threading
+from itertools import islice
+from collections import OrderedDict, deque
+
+from .timer import wheel
+
+log = logging.getLogger("trevorproxy.ratelimit")
+
+
+def source_network(source, prefix=None):
+    """
+    The sub-prefix a source address belongs to (default: /64 for IPv6, /24 for IPv4), or None
+    """
+    if source is None:
+        return None
+    source = ipaddress.ip_address(str(source))
+    if prefix is None:
+        prefix = 64 if source.version == 6 else 24
+    prefix = min(prefix, source.max_prefixlen)
+    return ipaddress.ip_network(f"{source}/{prefix}", strict=False)
+
+
+class Limit:
+    """
+    Connection rate (per second) and concurrency limit applied to each key of a category
+    Zero means unlimited
+    """
+
+    def __init__(self, rate=0, burst=None, concurrency=0):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(1.0, self.rate)
+        self.concurrency = int(concurrency)
+
+    def __bool__(self):
+        return bool(self.rate or self.concurrency)
+
+    def __str__(self):
+        return f"{self.rate:g}/s (burst {self.burst:g}), max {self.concurrency} concurrent"
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "active", "waiters", "sleeping")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+        self.active = 0
+        self.waiters = deque()
+        # callers waiting on the timer wheel for a rate token
+        self.sleeping = 0
+
+    def reserve(self, limit, now):
+        """
+        Take a token, returning how many seconds to wait until it's actually available
+        Tokens may go negative, which queues callers in arrival order
+        """
+        self.tokens = min(limit.burst, self.tokens + (now - self.updated) * limit.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / limit.rate
+
+    def idle(self):
+        return self.active == 0 and not self.waiters and not self.sleeping
+
+
+class Ticket:
+    """
+    Concurrency slots held by one connection, released when the connection ends
+    """
+
+    __slots__ = ("scheduler", "slots", "released")
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.slots = []
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            for limit, bucket in self.slots:
+                self.scheduler._release(bucket)
+
+
+class ConnectScheduler:
+    """
+    Shapes outgoing connections per destination host, per source sub-prefix and per upstream
+
+    Connections over a limit are queued rather than rejected: rate waits are woken by the
+    shared timer wheel, and concurrency waits are handed the slot of the next connection to finish.
+    Per-key state lives in a bounded LRU so memory stays flat no matter how many keys are seen.
+    """
+
+    def __init__(
+        self,
+        destination=None,
+        source=None,
+        upstream=None,
+        source_prefix=None,
+        maxsize=65536,
+    ):
+        self.limits = {
+            "destination": destination or Limit(),
+            "source": source or Limit(),
+            "upstream": upstream or Limit(),
+        }
+        # group source addresses by this prefix length (default: /64 for IPv6, /24 for IPv4)
+        self.source_prefix = source_prefix
+        self.maxsize = int(maxsize)
+
+        self.queued = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        return self.queued
+
+    def __bool__(self):
+        return any(self.limits.values())
+
+    def acquire(self, destination=None, source=None, upstream=None):
+        """
+        Block until a connection to `destination` from `source` via `upstream` is allowed
+        Returns a Ticket which must be released when the connection closes
+        """
+        ticket = Ticket(self)
+        try:
+            for category, key in (
+                ("destination", destination),
+                ("source", self.source_key(source)),
+                ("upstream", upstream),
+            ):
+                limit = self.limits[category]
+                if key is None or not limit:
+                    continue
+                self._acquire(ticket, limit, (category, str(key)))
+        except BaseException:
+            ticket.release()
+            raise
+        return ticket
+
+    def source_key(self, source):
+        return source_network(source, self.source_prefix)
+
+    def _acquire(self, ticket, limit, key):
+        waiter = None
+        with self._lock:
+            bucket = self._bucket(key, limit)
+            if limit.concurrency:
+                if bucket.active >= limit.concurrency or bucket.waiters:
+                    waiter = threading.Event()
+                    bucket.waiters.append(waiter)
+                else:
+                    bucket.active += 1
+                ticket.slots.append((limit, bucket))
+
+        if waiter is not None:
+            self._wait(waiter, key)
+
+        if limit.rate:
+            with self._lock:
+                delay = bucket.reserve(limit, time.monotonic())
+                if delay > 0:
+                    # keeps the bucket (and the tokens we owe it) from being evicted meanwhile
+                    bucket.sleeping += 1
+            if delay > 0:
+                waiter = threading.Event()
+                wheel.schedule(delay, waiter.set)
+                try:
+                    self._wait(waiter, key)
+                finally:
+                    with self._lock:
+                        bucket.sleeping -= 1
+
+    def _wait(self, waiter, key):
+        with self._lock:
+            self.queued += 1
+            depth = self.queued
+        log.debug(f"Queueing connection for {key[0]} {key[1]} (queue depth: {depth})")
+        try:
+            waiter.wait()
+        finally:
+            with self._lock:
+                self.queued -= 1
+
+    def _release(self, bucket):
+        with self._lock:
+            if bucket.waiters:
+                # hand our slot directly to the next connection in line
+                bucket.waiters.popleft().set()
+            else:
+                bucket.active -= 1
+
+    def _bucket(self, key, limit):
+        now = time.monotonic()
+        try:
+            bucket = self._buckets[key]
+            self._buckets.move_to_end(key)
+            return bucket
+        except KeyError:
+            pass
+        bucket = _Bucket(limit.burst, now)
+        self._buckets[key] = bucket
+        # evict least recently used keys that aren't in use
+        if len(self._buckets) > self.maxsize:
+            for old_key in list(islice(self._buckets, 16)):
+                if self._buckets[old_key].idle():
+                    del self._buckets[old_key]
+                    if len(self._buckets) <= self.maxsize:
+                        break
+        return bucket
@@ -0,0 +1,149 @@
+import time
+import socket
+import logging
+import threading
+from itertools import count
+
+log = logging.getLogger("trevorproxy.registry")
+
+
+class Connection:
+    """
+    One live relay
+    """
+
+    __slots__ = (
+        "id",
+        "client",
+        "source",
+        "destination",
+        "upstream",
+        "bytes_out",
+        "bytes_in",
+        "started",
+        "last_active",
+        "sockets",
+    )
+
+    def __init__(self, id, client, source, destination, upstream, sockets):
+        self.id = id
+        self.client = client
+        self.source = source
+        self.destination = destination
+        self.upstream = upstream
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.sockets = sockets
+
+    @property
+    def age(self):
+        return time.monotonic() - self.started
+
+    def close(self):
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "client": self.client,
+            "source": self.source,
+            "destination": self.destination,
+            "upstream": self.upstream,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "age": round(self.age, 1),
+        }
+
+    def __str__(self):
+        via = f" via {self.upstream}" if self.upstream else ""
+        return (
+            f"{self.client} -> {self.destination} from {self.source}{via} "
+            f"({self.bytes_out:,}/{self.bytes_in:,} bytes out/in, {self.age:.0f}s)"
+        )
+
+
+class ConnectionRegistry:
+    """
+    Tracks every live relay so shutdowns and reloads can wait for them to finish
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._ids = count(1)
+        self._cond = threading.Condition()
+
+        # totals for finished connections
+        self.finished = 0
+        self.finished_bytes_out = 0
+        self.finished_bytes_in = 0
+
+    def register(self, client=None, source=None, destination=None, upstream=None, sockets=()):
+        with self._cond:
+            conn = Connection(
+                next(self._ids), client, source, destination, upstream, tuple(sockets)
+            )
+            self._connections[conn.id] = conn
+            return conn
+
+    def unregister(self, conn):
+        with self._cond:
+            if self._connections.pop(conn.id, None) is not None:
+                self.finished += 1
+                self.finished_bytes_out += conn.bytes_out
+                self.finished_bytes_in += conn.bytes_in
+            self._cond.notify_all()
+
+    def connections(self):
+        with self._cond:
+            return list(self._connections.values())
+
+    def drain(self, timeout, match=None):
+        """
+        Wait up to `timeout` seconds for matching connections (all by default) to finish
+        Returns the number still open
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while 1:
+                remaining = [
+                    c for c in self._connections.values() if match is None or match(c)
+                ]
+                left = deadline - time.monotonic()
+                if not remaining or left <= 0:
+                    return len(remaining)
+                self._cond.wait(min(left, 1))
+
+    def close(self, match=None):
+        """
+        Forcibly end matching connections (all by default)
+        """
+        for conn in self.connections():
+            if match is None or match(conn):
+                conn.close()
+
+    def totals(self):
+        """
+        Connection and byte counts, including active connections
+        """
+        connections = self.connections()
+        return {
+            "active": len(connections),
+            "connections": self.finished + len(connections),
+            "bytes_out": self.finished_bytes_out + sum(c.bytes_out for c in connections),
+            "bytes_in": self.finished_bytes_in + sum(c.bytes_in for c in connections),
+        }
+
+    def summary(self):
+        connections = self.connections()
+        bytes_out = sum(c.bytes_out for c in connections)
+        bytes_in = sum(c.bytes_in for c in connections)
+        return f"{len(connections):,} active connections ({bytes_out:,}/{bytes_in:,} bytes out/in)"
+
+    def __len__(self):
+        return len(self._connections)
@@ -0,0 +1,63 @@
+import json
+import signal
+import logging
+import threading
+from pathlib import Path
+
+from .errors import TrevorProxyError
+
+log = logging.getLogger("trevorproxy.reload")
+
+# keys accepted in the config file
+CONFIG_KEYS = {"subnet", "blacklist", "ssh_hosts"}
+
+
+def load_config(path):
+    """
+    Read a JSON config file, e.g.:
+        {"subnet": "dead:beef::/64", "blacklist": ["dead:beef::1"]}
+        {"ssh_hosts": ["root@1.2.3.4", "root@4.3.2.1"]}
+    """
+    try:
+        config = json.loads(Path(path).read_text())
+    except Exception as e:
+        raise TrevorProxyError(f"Failed to read config file {path}: {e}")
+    if not isinstance(config, dict):
+        raise TrevorProxyError(f"Config file {path} must contain a JSON object")
+    unknown = set(config).difference(CONFIG_KEYS)
+    if unknown:
+        raise TrevorProxyError(
+            f"Unknown keys in config file {path}: {', '.join(sorted(unknown))}"
+        )
+    return config
+
+
+class Reloader:
+    """
+    Re-reads the config file on SIGHUP and passes it to `apply`, which diffs it against the running proxy
+
+    Reloads run in a background thread so the listener keeps accepting connections,
+    and are serialized so they never overlap
+    """
+
+    def __init__(self, path, apply):
+        self.path = path
+        self.apply = apply
+        self._lock = threading.Lock()
+
+    def install(self):
+        signal.signal(signal.SIGHUP, self._on_signal)
+        log.info(f"Send SIGHUP to reload {self.path}")
+
+    def _on_signal(self, signum, frame):
+        threading.Thread(target=self.reload, daemon=True).start()
+
+    def reload(self):
+        with self._lock:
+            log.info(f"Reloading {self.path}")
+            try:
+                self.apply(load_config(self.path))
+            except Exception as e:
+                log.error(f"Failed to reload {self.path}: {e}")
+            else:
+                log.info(f"Successfully reloaded {self.path}")
@@ -0,0 +1,106 @@
+"""
+SOCKS5 reply encoding (RFC 1928 section 6)
+
+    +----+-----+-------+------+----------+----------+
+    |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
+    +----+-----+-------+------+----------+----------+
+"""
+
+import errno
+import socket
+import struct
+
+SOCKS_VERSION = 5
+
+# reply codes
+SUCCEEDED = 0
+GENERAL_FAILURE = 1
+NOT_ALLOWED = 2
+NETWORK_UNREACHABLE = 3
+HOST_UNREACHABLE = 4
+CONNECTION_REFUSED = 5
+TTL_EXPIRED = 6
+COMMAND_NOT_SUPPORTED = 7
+ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+# address types
+IPV4 = 1
+DOMAIN = 3
+IPV6 = 4
+
+_port = struct.Struct("!H")
+
+# header + ATYP for successful replies, by address family
+_success_headers = {
+    socket.AF_INET: bytes((SOCKS_VERSION, SUCCEEDED, 0, IPV4)),
+    socket.AF_INET6: bytes((SOCKS_VERSION, SUCCEEDED, 0, IPV6)),
+}
+
+# failures carry no meaningful bind address, so the whole reply is fixed
+_failures = {
+    code: bytes((SOCKS_VERSION, code, 0, IPV4)) + b"\x00" * 6 for code in range(1, 9)
+}
+
+_errnos = {
+    errno.ECONNREFUSED: CONNECTION_REFUSED,
+    # a reset during the handshake usually comes from a middlebox, not a closed port
+    errno.ECONNRESET: GENERAL_FAILURE,
+    errno.ENETUNREACH: NETWORK_UNREACHABLE,
+    errno.ENETDOWN: NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: HOST_UNREACHABLE,
+    errno.EHOSTDOWN: HOST_UNREACHABLE,
+    errno.ETIMEDOUT: TTL_EXPIRED,
+    errno.EACCES: NOT_ALLOWED,
+    errno.EPERM: NOT_ALLOWED,
+    errno.EAFNOSUPPORT: ADDRESS_TYPE_NOT_SUPPORTED,
+}
+
+
+def success(bind_address):
+    """
+    Reply for a socket bound to `bind_address`, as returned by getsockname()
+    """
+    address, port = bind_address[:2]
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    return (
+        _success_headers[family]
+        + socket.inet_pton(family, address)
+        + _port.pack(port)
+    )
+
+
+def encode(code, address="0.0.0.0", port=0):
+    """
+    Reply with any code and an IPv4, IPv6 or domain name bind address
+    """
+    for family, address_type in ((socket.AF_INET, IPV4), (socket.AF_INET6, IPV6)):
+        try:
+            packed = socket.inet_pton(family, address)
+            break
+        except OSError:
+            continue
+    else:
+        packed = address.encode("idna")
+        if len(packed) > 255:
+            raise ValueError(f"Domain name too long: {address}")
+        packed = bytes((len(packed),)) + packed
+        address_type = DOMAIN
+    return bytes((SOCKS_VERSION, code, 0, address_type)) + packed + _port.pack(port)
+
+
+def failure(code=GENERAL_FAILURE):
+    return _failures.get(code, _failures[GENERAL_FAILURE])
+
+
+def error_code(e):
+    """
+    Reply code for an exception raised while connecting, so clients can fail fast
+    """
+    code = getattr(e, "reply_code", None)
+    if code is not None:
+        return code
+    if isinstance(e, socket.gaierror):
+        return HOST_UNREACHABLE
+    if isinstance(e, (socket.timeout, TimeoutError)):
+        return TTL_EXPIRED
+    return _errnos.get(getattr(e, "errno", None), GENERAL_FAILURE)
@@ -1,10 +1,17 @@
 # NOTE: Adapted from https://github.com/rushter/socks5
 
+import time
 import select
 import socket
 import struct
 import logging
 import traceback
+from . import reply as socks_reply
+from .udp import UDPAssociation
+from .timeouts import Timeouts
+from .registry import ConnectionRegistry
+from .destination import DestinationCache
+from .tuning import SocketTuning
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
 log = logging.getLogger("trevorproxy.socks")
@@ -12,21 +19,82 @@ SOCKS_VERSION = 5
 
 
 class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    # relays are tracked and drained by the ConnectionRegistry instead
+    daemon_threads = True
+    block_on_close = False
+
     def __init__(self, *args, **kwargs):
         self.username = kwargs.pop("username", "")
         self.password = kwargs.pop("password", "")
         self.proxy = kwargs.pop("proxy")
+        # pin source addresses by "username" or "destination"
+        self.sticky = kwargs.pop("sticky", None)
+        # seconds before an idle UDP association is closed
+        self.udp_timeout = kwargs.pop("udp_timeout", 60)
+        # optional ConnectScheduler for rate shaping
+        self.scheduler = kwargs.pop("scheduler", None)
+        # live relays, for graceful shutdown and stats
+        self.registry = kwargs.pop("registry", None)
+        if self.registry is None:
+            self.registry = ConnectionRegistry()
+        # handshake/idle/lifetime timeouts and keepalive
+        self.timeouts = kwargs.pop("timeouts", None)
+        if self.timeouts is None:
+            self.timeouts = Timeouts()
+        # resolved hostnames, shared by all handlers
+        self.destinations = kwargs.pop("destinations", None)
+        if self.destinations is None:
+            self.destinations = DestinationCache()
+        # socket options for the listener and both legs of each relay
+        self.tuning = kwargs.pop("tuning", None)
+        if self.tuning is None:
+            self.tuning = SocketTuning()
+        # optional Accounting for per-upstream / per-prefix usage
+        self.accounting = kwargs.pop("accounting", None)
+        # optional Feedback, told about failing source prefixes and upstreams
+        self.feedback = kwargs.pop("feedback", None)
+        self.request_queue_size = self.tuning.backlog
         self.allow_reuse_address = True
         super().__init__(*args, **kwargs)
 
+    def server_bind(self):
+        self.tuning.apply_listener(self.socket)
+        super().server_bind()
+
 
 class ThreadingTCPServer6(ThreadingTCPServer):
     address_family = socket.AF_INET6
 
 
 class SocksProxy(StreamRequestHandler):
+    # whether UDP ASSOCIATE is offered
+    udp = True
+    # set per request in handle(), which may return before getting that far
+    ticket = None
+    upstream = None
+    # (address, port) an upstream proxy reported for the connection, sent back in our reply
+    bound = None
+
+    def setup(self):
+        super().setup()
+        self.server.tuning.apply_client(self.connection)
+        self.server.timeouts.apply(self.connection)
+        self.handshake_timer = self.server.timeouts.watch_handshake(self.connection)
+
+    def handshake_done(self):
+        if self.handshake_timer is not None:
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+
     def handle(self):
         log.debug("Accepting connection from %s:%s", *self.client_address[:2])
+        self.username = ""
+        self.ticket = None
+        self.source_address = None
+        self.destination = None
+        self.upstream = None
+        self.bound = None
+        destination = None
 
         # greeting header
         try:
@@ -62,47 +130,41 @@ class SocksProxy(StreamRequestHandler):
                 raise ValueError(f"Only SOCKS version 5 is supported (socks5://)")
 
             address = None
-            self.address_family = (
-                socket.AF_INET6
-                if self.server.proxy.subnet.version == 6
-                else socket.AF_INET
-            )
+            self.address_family = self.default_family()
 
             if address_type == 1:  # IPv4
-                log.debug("Address type == IPv4")
                 address = socket.inet_ntop(socket.AF_INET, self.connection.recv(4))
                 self.address_family = socket.AF_INET
 
             if address_type == 4:  # IPv6
-                log.debug("Address type == IPv6")
                 address = socket.inet_ntop(socket.AF_INET6, self.connection.recv(16))
                 self.address_family = socket.AF_INET6
 
             elif address_type == 3:  # Domain name
-                log.debug(f"Address type == domain name")
                 domain_length = self.connection.recv(1)[0]
                 domain = self.connection.recv(domain_length)
-                if self.server.proxy.subnet.version == 6:
-                    resolve_order = [socket.AF_INET6, socket.AF_INET]
-                else:
-                    resolve_order = [socket.AF_INET, socket.AF_INET6]
-                for family in resolve_order:
-                    try:
-                        log.debug(f"Trying to resolve {domain} via {str(family)}")
-                        address = socket.getaddrinfo(domain, 0, family)[0][-1][0]
-                        self.address_family = family
-                        log.debug(
-                            f"Successfully resolved {domain} to {address} via {str(family)}"
-                        )
-                        break
-                    except Exception as e:
-                        log.debug(f"Failed to resolve {domain} via {str(family)}")
-                        continue
+                destination = domain.decode("utf-8", errors="ignore").lower()
+                address = self.resolve(destination)
                 if address is None:
-                    log.error(f"Could not resolve hostname {address}")
+                    log.error(f"Could not resolve hostname {destination}")
+                    self.connection.sendall(
+                        socks_reply.failure(socks_reply.HOST_UNREACHABLE)
+                    )
                     return
-            log.debug(f"Destination address: {address}")
+
+            elif address_type != 1:
+                log.error(f"Unsupported address type {address_type}")
+                self.connection.sendall(
+                    socks_reply.failure(socks_reply.ADDRESS_TYPE_NOT_SUPPORTED)
+                )
+                return
+            log.debug("Destination address: %s", address)
+            if destination is None:
+                destination = address
             port = struct.unpack("!H", self.connection.recv(2))[0]
+            self.destination = f"{destination}:{port}"
+            # the request is in; connecting (and any queueing) isn't part of the handshake
+            self.handshake_done()
 
         except Exception as e:
             if log.level <= logging.DEBUG:
@@ -113,59 +175,140 @@ class SocksProxy(StreamRequestHandler):
         # reply
         try:
             if cmd == 1:  # CONNECT
+                remote = self.connect_remote(address, port, destination)
+                log.debug("Connected to %s:%s", address, port)
+                if self.bound is None:
+                    reply = socks_reply.success(remote.getsockname())
+                else:
+                    reply = socks_reply.encode(socks_reply.SUCCEEDED, *self.bound)
+
+            elif cmd == 3 and self.udp:  # UDP ASSOCIATE
                 subnet_family = (
                     socket.AF_INET
                     if self.server.proxy.subnet.version == 4
                     else socket.AF_INET6
                 )
-                remote = socket.socket(self.address_family, socket.SOCK_STREAM)
-
-                # if the IP families match, then randomize source address
-                if subnet_family == self.address_family:
-                    log.debug(
-                        f"{str(self.address_family)} matches address family ({subnet_family}), randomizing source address"
-                    )
-                    random_source_addr = str(next(self.server.proxy.ipgen))
-                    log.info(f"Using random source address: {random_source_addr}")
-
-                    # special case for IPv6
-                    if self.address_family == socket.AF_INET6:
-                        remote.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
-
-                    remote.bind((random_source_addr, 0))
-
-                # otherwise, passthrough
-                else:
-                    log.warning(
-                        f"{str(self.address_family)} does not match that of subnet ({str(subnet_family)}), source IP randomization is impossible."
-                    )
+                random_source_addr = str(
+                    self.server.proxy.next_source(self.affinity_key(destination))
+                )
+                self.source_address = random_source_addr
+                log.info(f"Using random source address for UDP: {random_source_addr}")
+                association = UDPAssociation(
+                    client_host=self.client_address[0],
+                    bind_host=self.connection.getsockname()[0],
+                    source_address=random_source_addr,
+                    family=subnet_family,
+                    idle_timeout=self.server.udp_timeout,
+                    destinations=self.server.destinations,
+                )
+                reply = association.reply()
 
-                remote.connect((address, port))
-                bind_address = remote.getsockname()
-                log.debug(f"Connected to {address}:{port}")
             else:
-                self.server.close_request(self.request)
-
-            addr_format = "I" if self.address_family == socket.AF_INET else "IIII"
-            addr, port = bind_address[:2]
-            reply = struct.pack(f"!BBBBIH", SOCKS_VERSION, 0, 0, 1, address_type, port)
+                log.error(f"Unsupported SOCKS command {cmd}")
+                reply = socks_reply.failure(socks_reply.COMMAND_NOT_SUPPORTED)
 
         except Exception as e:
+            # tell the client why, so it doesn't sit waiting for a timeout
+            reply = socks_reply.failure(socks_reply.error_code(e))
+            if cmd == 1:
+                self.connect_failed(e)
             if log.level <= logging.DEBUG:
                 e = traceback.format_exc()
             log.error(f"Error in reply: {e}")
-            # return connection refused error
-            reply = self.generate_failed_reply(address_type, 5)
-            return
 
         self.connection.sendall(reply)
 
         # establish data exchange
         if reply[1] == 0 and cmd == 1:
             self.exchange_loop(self.connection, remote)
+        elif reply[1] == 0 and cmd == 3:
+            self.udp_loop(association)
 
         self.server.close_request(self.request)
 
+    def default_family(self):
+        """
+        Address family of the subnet, used for hostnames and as a default
+        """
+        return socket.AF_INET6 if self.server.proxy.subnet.version == 6 else socket.AF_INET
+
+    def resolve(self, domain):
+        """
+        Resolve a hostname, preferring the address family of the subnet
+        Sets self.address_family and returns the address, or None if resolution failed
+        """
+        result = self.server.destinations.resolve(domain, self.default_family())
+        if result is None:
+            return None
+        self.address_family, address = result
+        return address
+
+    def connect_remote(self, address, port, destination=None):
+        """
+        Connect to (address, port), randomizing the source address if the address family matches the subnet
+        """
+        subnet_family = (
+            socket.AF_INET if self.server.proxy.subnet.version == 4 else socket.AF_INET6
+        )
+        remote = socket.socket(self.address_family, socket.SOCK_STREAM)
+        random_source_addr = None
+
+        try:
+            self.server.tuning.apply_egress(remote)
+            # if the IP families match, then randomize source address
+            if subnet_family == self.address_family:
+                random_source_addr = str(
+                    self.server.proxy.next_source(
+                        self.affinity_key(destination), self.destination
+                    )
+                )
+                log.info(f"Using random source address: {random_source_addr}")
+                self.source_address = random_source_addr
+
+                # special case for IPv6
+                if self.address_family == socket.AF_INET6:
+                    remote.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
+
+                remote.bind((random_source_addr, 0))
+
+            # otherwise, passthrough
+            else:
+                log.warning(
+                    f"{str(self.address_family)} does not match that of subnet ({str(subnet_family)}), source IP randomization is impossible."
+                )
+
+            self.server.timeouts.apply(remote)
+
+            # wait our turn if the destination or source prefix is over its limits
+            if self.server.scheduler:
+                self.ticket = self.server.scheduler.acquire(
+                    destination=destination or address, source=random_source_addr
+                )
+
+            remote.connect((address, port))
+        except Exception:
+            remote.close()
+            raise
+        return remote
+
+    def finish(self):
+        self.handshake_done()
+        try:
+            super().finish()
+        finally:
+            if self.ticket is not None:
+                self.ticket.release()
+
+    def affinity_key(self, destination):
+        """
+        Key used to pin a source address to this session, or None to rotate
+        """
+        if self.server.sticky == "username":
+            return self.username or None
+        elif self.server.sticky == "destination":
+            return destination
+        return None
+
     def get_available_methods(self, n):
         methods = []
         for i in range(n):
@@ -193,6 +336,7 @@ class SocksProxy(StreamRequestHandler):
 
             password_len = ord(self.connection.recv(1))
             password = self.connection.recv(password_len).decode("utf-8")
+            self.username = username
 
             if (
                 username == self.server.username and password == self.server.password
@@ -215,30 +359,99 @@ class SocksProxy(StreamRequestHandler):
         return valid
 
     def generate_failed_reply(self, address_type, error_number):
-        return struct.pack(
-            "!BBBBIH", SOCKS_VERSION, error_number, 0, address_type, 0, 0
+        return socks_reply.failure(error_number)
+
+    def connect_failed(self, e):
+        self.account(failed=True)
+        # upstream failures are reported by the balancer, which sees every attempt
+        if self.server.feedback is not None and self.source_address is not None:
+            self.server.feedback.connect_failed(
+                source=self.source_address, error=e, destination=self.destination
+            )
+
+    def account(self, bytes_out=0, bytes_in=0, failed=False):
+        accounting = self.server.accounting
+        if accounting is not None:
+            accounting.record(
+                upstream=self.upstream,
+                source=self.source_address,
+                bytes_out=bytes_out,
+                bytes_in=bytes_in,
+                failed=failed,
+            )
+
+    def udp_loop(self, association):
+        """
+        Run a UDP association, tracked in the registry and accounting like a TCP relay
+        """
+        # shutting down the control connection ends the association
+        conn = self.server.registry.register(
+            client="%s:%s" % self.client_address[:2],
+            source=self.source_address,
+            destination="udp",
+            sockets=(self.connection,),
         )
+        try:
+            association.run(self.connection, conn)
+        finally:
+            self.server.registry.unregister(conn)
+            self.account(association.bytes_out, association.bytes_in)
 
     def exchange_loop(self, client, remote):
+        conn = self.server.registry.register(
+            client="%s:%s" % self.client_address[:2],
+            source=self.source_address,
+            destination=self.destination,
+            upstream=None if self.upstream is None else str(self.upstream),
+            sockets=(client, remote),
+        )
+        timers = self.server.timeouts.watch_relay(conn)
+        relay_buffer = self.server.tuning.relay_buffer
+        # whether the destination ended the relay, rather than the client
+        remote_closed = False
         try:
             while True:
                 # wait until client or remote is available for read
                 r, w, e = select.select([client, remote], [], [])
 
                 if client in r:
-                    data = client.recv(4096)
+                    data = client.recv(relay_buffer)
                     if remote.send(data) <= 0:
                         break
+                    conn.bytes_out += len(data)
+                    conn.last_active = time.monotonic()
 
                 if remote in r:
-                    data = remote.recv(4096)
+                    try:
+                        data = remote.recv(relay_buffer)
+                    except OSError:
+                        remote_closed = True
+                        raise
+                    if not data:
+                        remote_closed = True
                     if client.send(data) <= 0:
                         break
+                    conn.bytes_in += len(data)
+                    conn.last_active = time.monotonic()
         except Exception as e:
             if log.level <= logging.DEBUG:
                 e = traceback.format_exc()
             log.error(f"Error in data exchange: {e}")
         finally:
+            for timer in timers:
+                timer.cancel()
+            self.server.registry.unregister(conn)
+            self.account(conn.bytes_out, conn.bytes_in)
+            if self.server.feedback is not None:
+                self.server.feedback.relay_finished(
+                    source=self.source_address,
+                    upstream=self.upstream,
+                    bytes_out=conn.bytes_out,
+                    bytes_in=conn.bytes_in,
+                    age=conn.age,
+                    destination=self.destination,
+                    remote_closed=remote_closed,
+                )
             # Ensure remote socket is properly closed
             try:
                 remote.close()
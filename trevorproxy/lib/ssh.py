@@ -1,17 +1,20 @@
-import sh
+import socket
 import logging
+import threading
 from time import sleep
-import subprocess as sp
 from pathlib import Path
 
-from .util import sudo_run
+from .util import sudo_run, is_listening, count_established
+from .pool import SocksPool, socks5_greeting, socks5_connect
 from .errors import SSHProxyError
 
 log = logging.getLogger("trevorproxy.ssh")
 
 
 class SSHProxy:
-    def __init__(self, host, proxy_port, key=None, key_pass="", ssh_args={}):
+    def __init__(
+        self, host, proxy_port, key=None, key_pass="", ssh_args={}, prewarm=0
+    ):
         self.host = host
         self.proxy_port = proxy_port
         self.key = key
@@ -27,11 +30,18 @@ class SSHProxy:
         self.command = ""
         self._ssh_stdout = ""
         self.running = False
+        # keep a few negotiated SOCKS sessions ready for in-process connections
+        self.pool = None
+        if prewarm > 0:
+            self.pool = SocksPool("127.0.0.1", proxy_port, size=prewarm)
 
     def start(self, wait=True, timeout=30):
         self.stop()
 
         if not self.is_connected():
+            # sh is only needed once we actually spawn ssh
+            import sh
+
             log.info(f"Opening SSH connection to {self.host}")
             self._ssh_stdout = ""
             self._password_entered = False
@@ -64,7 +74,12 @@ class SSHProxy:
                 else:
                     sleep(1)
 
+        if self.pool is not None:
+            self.pool.start()
+
     def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
         try:
             self.sh.process.terminate()
         except:
@@ -73,6 +88,28 @@ class SSHProxy:
             except:
                 pass
 
+    def connect(self, address, port):
+        """
+        Open a connection to (address, port) through this SSH tunnel
+        """
+        if self.pool is not None:
+            return self.pool.connect(address, port)
+        sock = socket.create_connection(("127.0.0.1", self.proxy_port), timeout=10)
+        try:
+            socks5_greeting(sock)
+            socks5_connect(sock, address, port)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def active_connections(self):
+        """
+        Number of connections currently going through this tunnel
+        """
+        return count_established(self.proxy_port)
+
     def _smart_decode(self, data):
         if isinstance(data, bytes):
             return data.decode("utf-8", errors="ignore")
@@ -93,8 +130,7 @@ class SSHProxy:
         if self.sh is None:
             return False
 
-        netstat = sp.run(["ss", "-ntlp"], stderr=sp.DEVNULL, stdout=sp.PIPE)
-        if not f" 127.0.0.1:{self.proxy_port} " in netstat.stdout.decode():
+        if not is_listening("127.0.0.1", self.proxy_port):
             log.debug(f'Waiting for {" ".join(self.sh.cmd)}')
             self.running = False
         else:
@@ -191,6 +227,7 @@ class SSHLoadBalancer:
         base_port=33482,
         current_ip=False,
         socks_server=False,
+        prewarm=0,
     ):
         self.args = dict()
         self.hosts = hosts
@@ -200,10 +237,20 @@ class SSHLoadBalancer:
         self.current_ip = current_ip
         self.proxies = dict()
         self.socks_server = socks_server
+        self.prewarm = prewarm
+        # proxies removed by reload() that are still finishing their connections
+        self.retiring = []
 
         for i, host in enumerate(hosts):
             proxy_port = self.base_port + i
-            proxy = SSHProxy(host, proxy_port, key, key_pass, ssh_args=self.args)
+            proxy = SSHProxy(
+                host,
+                proxy_port,
+                key,
+                key_pass,
+                ssh_args=self.args,
+                prewarm=prewarm,
+            )
             self.proxies[str(proxy)] = proxy
 
         if current_ip:
@@ -231,10 +278,122 @@ class SSHLoadBalancer:
         if self.socks_server:
             self.iptables.start()
 
-    def stop(self):
+    def stop(self, drain_timeout=0):
+        """
+        Stop all proxies
+        If `drain_timeout` is set, stop accepting new connections first and wait
+        up to that many seconds for established tunnels to finish
+        """
+        if self.socks_server:
+            self.iptables.stop()
+        if drain_timeout > 0:
+            for proxy in self.proxies.values():
+                if proxy is not None and proxy.pool is not None:
+                    proxy.pool.stop()
+            self.drain(drain_timeout)
         [proxy.stop() for proxy in self.proxies.values() if proxy is not None]
+        for proxy in list(self.retiring):
+            proxy.stop()
+        self.retiring = []
+
+    def drain(self, timeout, proxies=None):
+        if proxies is None:
+            proxies = [p for p in self.proxies.values() if p is not None]
+        left = timeout
+        while 1:
+            active = sum(p.active_connections() for p in proxies)
+            if not active or left <= 0:
+                break
+            log.info(f"Waiting for {active:,} connections to finish ({left:.0f}s)")
+            sleep(1)
+            left -= 1
+        return active
+
+    def reload(self, hosts, timeout=30, drain_timeout=0):
+        """
+        Add and remove SSH hosts without restarting the rest
+
+        New tunnels are started first, then the iptables rules are replaced and
+        the balancer state is swapped, and finally the removed tunnels are stopped.
+        Connections through unchanged hosts are unaffected. With `drain_timeout`, removed
+        tunnels are given up to that many seconds (in the background) to finish their
+        connections before they're stopped.
+        """
+        current = {p.host: p for p in self.proxies.values() if p is not None}
+        added = [h for h in hosts if h not in current]
+        removed = [p for h, p in current.items() if h not in hosts]
+        if not added and not removed:
+            return
+
+        # retiring tunnels still hold their ports
+        used_ports = {p.proxy_port for p in list(current.values()) + self.retiring}
+        new_proxies = []
+        port = self.base_port
+        for host in added:
+            while port in used_ports:
+                port += 1
+            used_ports.add(port)
+            proxy = SSHProxy(
+                host,
+                port,
+                self.key,
+                self.key_pass,
+                ssh_args=self.args,
+                prewarm=self.prewarm,
+            )
+            new_proxies.append(proxy)
+
+        for proxy in new_proxies:
+            log.info(f"Adding SSH host {proxy.host}")
+            proxy.start(timeout=timeout)
+
+        proxies = dict()
+        for host in hosts:
+            proxy = current.get(host, None)
+            if proxy is None:
+                proxy = next(p for p in new_proxies if p.host == host)
+            proxies[str(proxy)] = proxy
+        if self.current_ip:
+            proxies["None"] = None
+
         if self.socks_server:
+            iptables = IPTables(
+                list(proxies.values()),
+                address=self.iptables.address,
+                proxy_port=self.iptables.proxy_port,
+            )
+            # add the new rules before removing the old ones so there's no gap
+            iptables.start()
             self.iptables.stop()
+            self.iptables = iptables
+
+        # swap in the new state all at once
+        self.hosts = list(hosts)
+        self.proxy_round_robin = list(proxies.values())
+        self.proxies = proxies
+
+        for proxy in removed:
+            log.info(f"Removing SSH host {proxy.host}")
+            if drain_timeout > 0:
+                self.retiring.append(proxy)
+                threading.Thread(
+                    target=self._retire, args=(proxy, drain_timeout), daemon=True
+                ).start()
+            else:
+                proxy.stop()
+
+    def _retire(self, proxy, timeout):
+        # no new sessions; wait for the established ones
+        if proxy.pool is not None:
+            proxy.pool.stop()
+        remaining = self.drain(timeout, [proxy])
+        if remaining:
+            log.warning(
+                f"Closing {remaining:,} connections still using removed SSH host {proxy.host}"
+            )
+        proxy.stop()
+        if proxy in self.retiring:
+            self.retiring.remove(proxy)
 
     def __next__(self):
         """
@@ -251,5 +410,5 @@ class SSHLoadBalancer:
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        debug.info("Shutting down proxies")
+        log.info("Shutting down proxies")
         self.stop()
@@ -0,0 +1,38 @@
+import signal
+import logging
+
+log = logging.getLogger("trevorproxy.stats")
+
+# name --> function returning the current value
+sources = {}
+
+
+def register(name, func):
+    sources[name] = func
+
+
+def collect():
+    stats = {}
+    for name, func in list(sources.items()):
+        try:
+            stats[name] = func()
+        except Exception as e:
+            stats[name] = f"error: {e}"
+    return stats
+
+
+def log_stats(*args):
+    for name, value in collect().items():
+        if isinstance(value, (list, tuple)):
+            log.info(f"{name}:")
+            for v in value:
+                log.info(f"    {v}")
+        else:
+            log.info(f"{name}: {value}")
+
+
+def install(signum=signal.SIGUSR1):
+    """
+    Log all stats when the process receives `signum`
+    """
+    signal.signal(signum, log_stats)
@@ -4,14 +4,35 @@ import threading
 from .errors import *
 import subprocess as sp
 from .cyclic import ipgen
-from .util import autodetect_address_pool, autodetect_interface, sudo_run
+from .affinity import AffinityCache
+from .netlink import discovery
+from .util import (
+    autodetect_address_pool,
+    autodetect_interface,
+    get_blacklist,
+    sudo_run,
+)
 
 log = logging.getLogger("trevorproxy.interface")
 
 
 class SubnetProxy:
-    def __init__(self, subnet=None, interface=None, version=6, pool_netmask=16):
+    def __init__(
+        self,
+        subnet=None,
+        interface=None,
+        version=6,
+        pool_netmask=16,
+        sticky_ttl=0,
+        sticky_size=100000,
+        shard=None,
+        feedback=None,
+    ):
         self.lock = threading.Lock()
+        # (index, count) slice of the address space owned by this node
+        self.shard = shard
+        # optional Feedback, to skip source prefixes that targets have started blocking
+        self.feedback = feedback
 
         pool_netmask = pool_netmask if version == 6 else 128 - pool_netmask
 
@@ -35,27 +56,191 @@ class SubnetProxy:
                 raise SubnetProxyError("Failed to detect interface")
             log.debug(f"Successfully detected interface: {self.interface}")
 
-        self.ipgen = ipgen(self.subnet)
+        self.ipgen = self._ipgen(self.subnet)
+        self.started = False
+        # subnets replaced by reload(), still routed so existing connections keep working
+        self.retired = []
+
+        # never use the address of a neighbor or gateway, or any user-excluded address
+        self.excluded = set()
+        self.blacklist = set()
+        self.refresh_blacklist()
+
+        # pin source addresses to sessions
+        self.affinity = None
+        if sticky_ttl > 0:
+            self.affinity = AffinityCache(maxsize=sticky_size, ttl=sticky_ttl)
+
+    def _ipgen(self, subnet):
+        if self.shard is not None:
+            index, count = self.shard
+            if subnet.num_addresses < count:
+                raise SubnetProxyError(
+                    f"Subnet {subnet} is too small to split into {count} shards"
+                )
+            log.info(f"Using shard {index + 1}/{count} of {subnet}")
+        return ipgen(subnet, shard=self.shard)
+
+    def next_source(self, key=None, destination=None):
+        """
+        Return a random source address from the subnet
+        If `key` is given and session affinity is enabled, the same address is reused for that key until it expires
+        With a Feedback, prefixes quarantined for `destination` ("host:port") are avoided
+        """
+        burned = self._burned(destination)
+        if key is not None and self.affinity is not None:
+            factory = lambda: self._next_address(burned)
+            address = self.affinity.get(key, factory)
+            if burned is None or not self._is_burned(address, burned):
+                return address
+            # the pinned address was burned, pin a new one
+            self.affinity.discard(key)
+            return self.affinity.get(key, factory)
+        return self._next_address(burned)
+
+    def _burned(self, destination):
+        """
+        (netmask, network addresses) as ints for the source prefixes quarantined for
+        `destination`, or None if there's nothing to avoid
+        Looked up once per call, so each candidate only costs a mask and a set lookup
+        """
+        if self.feedback is None:
+            return None
+        burned = self.feedback.burned_sources(destination)
+        if burned is None:
+            return None
+        subnet = self.subnet
+        burned = burned.get(subnet.version, None)
+        # with a single prefix there's nowhere else to go
+        if burned is None or subnet.prefixlen >= burned[0]:
+            return None
+        return burned[1:]
+
+    @staticmethod
+    def _is_burned(address, burned):
+        netmask, networks = burned
+        return int(address) & netmask in networks
+
+    def _next_address(self, burned=None, quarantine_attempts=64):
+        address = self._draw()
+        if burned is None or not self._is_burned(address, burned):
+            return address
+        fallback = address
+        for _ in range(quarantine_attempts):
+            address = self._draw()
+            if not self._is_burned(address, burned):
+                return address
+        # every address we tried is quarantined; better a burned prefix than none
+        return fallback
+
+    def _draw(self):
+        # generators can't be advanced from multiple threads at once
+        with self.lock:
+            blacklist = self.blacklist
+            for _ in range(len(blacklist) + 1):
+                address = next(self.ipgen)
+                if address not in blacklist:
+                    break
+            return address
+
+    def refresh_blacklist(self):
+        while 1:
+            with self.lock:
+                subnet = self.subnet
+                excluded = self.excluded
+            try:
+                blacklist = {ip for ip in get_blacklist() if ip in subnet}
+                blacklist.update(ip for ip in excluded if ip in subnet)
+            except Exception as e:
+                log.warning(f"Failed to refresh blacklist: {e}")
+                return
+            with self.lock:
+                # a reload may have switched subnets while we were dumping neighbors
+                if self.subnet != subnet or self.excluded is not excluded:
+                    continue
+                if blacklist != self.blacklist:
+                    log.debug(f"Excluding {len(blacklist):,} addresses from {subnet}")
+                # swap the whole set so readers never see it half-updated
+                self.blacklist = blacklist
+                return
+
+    def reload(self, subnet=None, blacklist=None):
+        """
+        Switch to a new subnet and/or excluded addresses without interrupting existing connections
+
+        The new subnet is routed before the address generator is swapped, and the old one stays
+        routed until stop(), so connections already using it keep flowing
+        """
+        if blacklist is not None:
+            excluded = {ipaddress.ip_address(str(ip)) for ip in blacklist}
+            with self.lock:
+                self.excluded = excluded
+
+        if subnet is not None:
+            subnet = ipaddress.ip_network(str(subnet), strict=False)
+            if subnet != self.subnet:
+                log.info(f"Switching subnet from {self.subnet} to {subnet}")
+                if self.started:
+                    if subnet in self.retired:
+                        self.retired.remove(subnet)
+                    else:
+                        self._route("add", subnet)
+                with self.lock:
+                    self.retired.append(self.subnet)
+                    self.subnet = subnet
+                    self.ipgen = self._ipgen(subnet)
+                # pinned addresses belong to the old subnet
+                if self.affinity is not None:
+                    self.affinity.clear()
+
+        self.refresh_blacklist()
+
+    def drain_retired(self, registry, timeout=300):
+        """
+        Unroute retired subnets once no relay is using them, waiting at most `timeout` seconds
+        """
+        for subnet in list(self.retired):
+
+            def match(conn, subnet=subnet):
+                return (
+                    conn.source is not None
+                    and ipaddress.ip_address(conn.source) in subnet
+                )
+
+            remaining = registry.drain(timeout, match)
+            if remaining:
+                log.warning(
+                    f"Closing {remaining:,} connections still using retired subnet {subnet}"
+                )
+                registry.close(match)
+
+            with self.lock:
+                # it may have been reinstated by another reload in the meantime
+                if subnet not in self.retired:
+                    continue
+                self.retired.remove(subnet)
+            self._route("del", subnet)
 
     def start(self):
-        cmd = [
-            "ip",
-            "route",
-            "add",
-            "local",
-            str(self.subnet),
-            "dev",
-            str(self.interface),
-        ]
-        sudo_run(cmd)
+        self._route("add", self.subnet)
+        self.started = True
+        # keep the blacklist current as neighbors and routes change
+        discovery.subscribe(self.refresh_blacklist)
 
     def stop(self):
+        discovery.unsubscribe(self.refresh_blacklist)
+        for subnet in [self.subnet] + self.retired:
+            self._route("del", subnet)
+        self.retired = []
+        self.started = False
+
+    def _route(self, action, subnet):
         cmd = [
             "ip",
             "route",
-            "del",
+            action,
             "local",
-            str(self.subnet),
+            str(subnet),
             "dev",
             str(self.interface),
         ]
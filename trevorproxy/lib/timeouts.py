@@ -0,0 +1,128 @@
+import time
+import socket
+import logging
+
+from .timer import wheel
+
+log = logging.getLogger("trevorproxy.timeouts")
+
+
+class Timeouts:
+    """
+    Handshake, idle and total-lifetime timeouts for relays, plus TCP keepalive settings
+
+    All timeouts are enforced by the shared timer wheel rather than per-socket timers.
+    When one fires, the relay's sockets are shut down, which wakes its thread so it can clean up.
+    A value of 0 disables that timeout.
+    """
+
+    def __init__(
+        self,
+        handshake=30,
+        idle=0,
+        lifetime=0,
+        keepalive=60,
+        keepalive_interval=10,
+        keepalive_count=5,
+        user_timeout=0,
+    ):
+        self.handshake = float(handshake)
+        self.idle = float(idle)
+        self.lifetime = float(lifetime)
+        self.keepalive = int(keepalive)
+        self.keepalive_interval = int(keepalive_interval)
+        self.keepalive_count = int(keepalive_count)
+        self.user_timeout = int(user_timeout)
+
+        self.handshake_timeouts = 0
+        self.idle_timeouts = 0
+        self.lifetime_timeouts = 0
+
+        self.sockopts = self._sockopts()
+
+    def _sockopts(self):
+        opts = []
+        if self.keepalive > 0:
+            opts += [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepalive_interval),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.keepalive_count),
+            ]
+        if self.user_timeout > 0 and hasattr(socket, "TCP_USER_TIMEOUT"):
+            # milliseconds
+            opts.append(
+                (socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, self.user_timeout * 1000)
+            )
+        return opts
+
+    def apply(self, sock):
+        """
+        Apply keepalive options to a TCP socket
+        """
+        for level, option, value in self.sockopts:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                log.debug(f"Failed to set socket option {option}: {e}")
+
+    def watch_handshake(self, sock):
+        """
+        Shut down `sock` if the handshake isn't finished in time
+        Returns a timer to cancel once it is, or None
+        """
+        if self.handshake <= 0:
+            return None
+
+        def expire():
+            self.handshake_timeouts += 1
+            log.debug("Handshake timed out")
+            _shutdown(sock)
+
+        return wheel.schedule(self.handshake, expire)
+
+    def watch_relay(self, conn):
+        """
+        Enforce idle and lifetime timeouts on a registered relay
+        `conn.last_active` must be updated as data flows
+        Returns a list of timers to cancel when the relay ends
+        """
+        timers = []
+
+        if self.idle > 0:
+
+            def check_idle():
+                idle = time.monotonic() - conn.last_active
+                if idle >= self.idle:
+                    self.idle_timeouts += 1
+                    log.debug(f"Closing idle connection {conn}")
+                    conn.close()
+                else:
+                    # reschedule for when it could next expire
+                    timers[0] = wheel.schedule(self.idle - idle, check_idle)
+
+            timers.append(wheel.schedule(self.idle, check_idle))
+
+        if self.lifetime > 0:
+
+            def expire():
+                self.lifetime_timeouts += 1
+                log.debug(f"Closing connection {conn} after max lifetime")
+                conn.close()
+
+            timers.append(wheel.schedule(self.lifetime, expire))
+
+        return timers
+
+    def summary(self):
+        return (
+            f"{self.handshake_timeouts:,} handshake, {self.idle_timeouts:,} idle, "
+            f"{self.lifetime_timeouts:,} lifetime"
+        )
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+
+log = logging.getLogger("trevorproxy.timer")
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel driven by a single background thread
+
+    Scheduling and cancelling are O(1); timers further out than one rotation stay
+    in their slot until their deadline comes around. Callbacks run on the wheel
+    thread, so they should be quick (set an event, shut down a socket, etc.)
+    """
+
+    def __init__(self, resolution=0.1, slots=512):
+        self.resolution = float(resolution)
+        self.slots = int(slots)
+        self._wheel = [[] for _ in range(self.slots)]
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_time = time.monotonic()
+        self._tick = 0
+
+    def schedule(self, delay, callback):
+        """
+        Call `callback()` after `delay` seconds
+        Returns a Timer which can be cancelled
+        """
+        deadline = time.monotonic() + max(0, delay)
+        timer = Timer(deadline, callback)
+        with self._lock:
+            tick = max(self._tick_for(deadline), self._tick + 1)
+            self._wheel[tick % self.slots].append(timer)
+        self.start()
+        return timer
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _tick_for(self, t):
+        return int((t - self._start_time) / self.resolution) + 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                current = self._tick_for(now) - 1
+                while self._tick < current:
+                    self._tick += 1
+                    slot = self._wheel[self._tick % self.slots]
+                    keep = []
+                    for timer in slot:
+                        if timer.cancelled:
+                            continue
+                        if timer.deadline <= now:
+                            due.append(timer)
+                        else:
+                            keep.append(timer)
+                    slot[:] = keep
+
+            for timer in due:
+                try:
+                    timer.callback()
+                except Exception as e:
+                    log.error(f"Error in timer callback: {e}")
+
+            self._stop.wait(self.resolution)
+
+    def __len__(self):
+        return sum(len(s) for s in self._wheel)
+
+
+# shared by everything that needs timeouts or delayed wakeups
+wheel = TimerWheel()
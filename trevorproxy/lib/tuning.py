@@ -0,0 +1,134 @@
+import socket
+import logging
+
+log = logging.getLogger("trevorproxy.tuning")
+
+# not exported by the socket module on every Python version
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, "IP_BIND_ADDRESS_NO_PORT", 24)
+TCP_FASTOPEN = getattr(socket, "TCP_FASTOPEN", 23)
+
+
+class SocketTuning:
+    """
+    Socket options for the listener, accepted client connections and outgoing (egress) connections
+
+    Options are built once and applied with a plain loop per socket. Anything the kernel
+    refuses is logged once and then skipped.
+
+        nodelay         TCP_NODELAY on both legs, so small requests (logins) go out immediately
+        bind_no_port    IP_BIND_ADDRESS_NO_PORT on egress, so binding a source address doesn't
+                        reserve an ephemeral port until connect(); each source can then reuse
+                        ports across destinations
+        linger          SO_LINGER 0 on egress: close with RST instead of sitting in TIME_WAIT.
+                        The relay closes the egress leg as soon as the client is done, so
+                        anything still unsent to the destination is dropped; not in any preset
+        fastopen        TCP_FASTOPEN queue length on the listener (0 to disable)
+        buffer          SO_SNDBUF/SO_RCVBUF in bytes on both legs (0 for kernel autotuning)
+        backlog         listen() backlog
+        relay_buffer    bytes read per recv() while relaying
+    """
+
+    def __init__(
+        self,
+        nodelay=False,
+        bind_no_port=False,
+        linger=False,
+        fastopen=0,
+        buffer=0,
+        backlog=socket.SOMAXCONN,
+        relay_buffer=4096,
+    ):
+        self.nodelay = bool(nodelay)
+        self.bind_no_port = bool(bind_no_port)
+        self.linger = bool(linger)
+        self.fastopen = int(fastopen)
+        self.buffer = int(buffer)
+        self.backlog = int(backlog)
+        self.relay_buffer = int(relay_buffer)
+
+        self.listener_opts = []
+        self.client_opts = []
+        self.egress_opts = []
+        if self.buffer > 0:
+            buffers = [
+                (socket.SOL_SOCKET, socket.SO_SNDBUF, self.buffer),
+                (socket.SOL_SOCKET, socket.SO_RCVBUF, self.buffer),
+            ]
+            # accepted sockets inherit the listener's buffers
+            self.listener_opts += buffers
+            self.egress_opts += buffers
+        if self.fastopen > 0:
+            self.listener_opts.append((socket.IPPROTO_TCP, TCP_FASTOPEN, self.fastopen))
+        if self.nodelay:
+            self.client_opts.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+            self.egress_opts.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if self.bind_no_port:
+            self.egress_opts.append((socket.SOL_IP, IP_BIND_ADDRESS_NO_PORT, 1))
+        if self.linger:
+            self.egress_opts.append(
+                (socket.SOL_SOCKET, socket.SO_LINGER, b"\x01\x00\x00\x00\x00\x00\x00\x00")
+            )
+
+        self._failed = set()
+
+    def apply_listener(self, sock):
+        self._apply(sock, self.listener_opts)
+
+    def apply_client(self, sock):
+        self._apply(sock, self.client_opts)
+
+    def apply_egress(self, sock):
+        """
+        Call before bind() so IP_BIND_ADDRESS_NO_PORT takes effect
+        """
+        self._apply(sock, self.egress_opts)
+
+    def _apply(self, sock, opts):
+        for opt in opts:
+            if opt in self._failed:
+                continue
+            try:
+                sock.setsockopt(*opt)
+            except OSError as e:
+                # IPv6 sockets reject some SOL_IP options on older kernels; don't retry forever
+                log.debug(f"Failed to set socket option {opt[1]}: {e}")
+                self._failed.add(opt)
+
+    def __str__(self):
+        enabled = [
+            name
+            for name in ("nodelay", "bind_no_port", "linger")
+            if getattr(self, name)
+        ]
+        if self.fastopen:
+            enabled.append(f"fastopen={self.fastopen}")
+        if self.buffer:
+            enabled.append(f"buffer={self.buffer:,}")
+        enabled.append(f"backlog={self.backlog}")
+        enabled.append(f"relay_buffer={self.relay_buffer:,}")
+        return ", ".join(enabled)
+
+
+presets = {
+    # kernel defaults
+    "default": dict(),
+    # many short-lived connections with small payloads (password spraying, scanning)
+    "spray": dict(
+        nodelay=True,
+        bind_no_port=True,
+        fastopen=256,
+        buffer=64 * 1024,
+        backlog=4096,
+        relay_buffer=4096,
+    ),
+    # fewer, longer connections moving lots of data
+    "bulk": dict(
+        bind_no_port=True,
+        backlog=1024,
+        relay_buffer=64 * 1024,
+    ),
+}
+
+
+def get_preset(name):
+    return SocketTuning(**presets[name])
@@ -0,0 +1,243 @@
+import time
+import select
+import socket
+import struct
+import logging
+
+from . import reply as socks_reply
+from .destination import DestinationCache
+
+log = logging.getLogger("trevorproxy.udp")
+
+# max datagrams drained from a socket per wakeup
+BATCH_SIZE = 64
+# max UDP payload
+BUFFER_SIZE = 65535
+
+
+class UDPAssociation:
+    """
+    Relays the datagrams of one SOCKS5 UDP ASSOCIATE request
+
+    The client side is bound on the address the client connected to, and the remote side is bound
+    to a single source address from the subnet, so every datagram of the association leaves from it.
+    The association lasts until the controlling TCP connection closes or it goes idle.
+    Hostnames are resolved through `destinations`, normally the server's shared DestinationCache.
+    """
+
+    def __init__(
+        self,
+        client_host,
+        bind_host,
+        source_address=None,
+        family=None,
+        idle_timeout=60,
+        destinations=None,
+    ):
+        self.client_host = str(client_host)
+        self.client_address = None
+        self.idle_timeout = float(idle_timeout)
+
+        bind_family = socket.AF_INET6 if ":" in bind_host else socket.AF_INET
+        self.client = socket.socket(bind_family, socket.SOCK_DGRAM)
+        self.client.bind((bind_host, 0))
+
+        if family is None:
+            family = bind_family
+        self.family = family
+        self.remote = socket.socket(family, socket.SOCK_DGRAM)
+        if source_address is not None:
+            # special case for IPv6
+            if family == socket.AF_INET6:
+                self.remote.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
+            self.remote.bind((str(source_address), 0))
+        self.source_address = source_address
+
+        self.packets_out = 0
+        self.packets_in = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # datagrams that couldn't be relayed
+        self.dropped = 0
+        self.created = time.monotonic()
+
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self.destinations = destinations
+        if self.destinations is None:
+            self.destinations = DestinationCache()
+
+    def reply(self):
+        """
+        SOCKS5 reply containing the relay address the client should send its datagrams to
+        """
+        return socks_reply.success(self.client.getsockname())
+
+    def run(self, control, conn=None):
+        """
+        Relay datagrams until `control` (the client's TCP connection) closes or the association goes idle
+        Byte counts are mirrored into `conn`, the association's entry in the connection registry
+        """
+        last_active = time.monotonic()
+        sockets = [self.client, self.remote, control]
+        try:
+            while 1:
+                r, _, _ = select.select(sockets, [], [], self.idle_timeout)
+                if not r:
+                    if time.monotonic() - last_active >= self.idle_timeout:
+                        log.debug(f"UDP association {self} timed out")
+                        break
+                    continue
+
+                last_active = time.monotonic()
+                if control in r:
+                    # any data (or EOF) on the control connection ends the association
+                    if not control.recv(1):
+                        break
+                if self.client in r:
+                    self._relay_outbound()
+                if self.remote in r:
+                    self._relay_inbound()
+                if conn is not None:
+                    conn.bytes_out = self.bytes_out
+                    conn.bytes_in = self.bytes_in
+                    conn.last_active = last_active
+        except Exception as e:
+            log.error(f"Error in UDP relay: {e}")
+        finally:
+            self.close()
+
+    def _relay_outbound(self):
+        for _ in range(BATCH_SIZE):
+            try:
+                n, sender = self.client.recvfrom_into(self._buffer, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # a pending socket error (e.g. ICMP unreachable) is reported once and cleared
+                log.debug(f"Error receiving UDP datagram on {self}: {e}")
+                continue
+
+            # only accept datagrams from the client that requested the association
+            if sender[0] != self.client_host:
+                continue
+            self.client_address = sender
+
+            try:
+                destination, offset = self._parse_header(n)
+            except Exception as e:
+                log.debug(f"Dropping malformed UDP datagram from {sender[0]}: {e}")
+                self.dropped += 1
+                continue
+            if destination is None:
+                self.dropped += 1
+                continue
+
+            try:
+                self.remote.sendto(self._view[offset:n], destination)
+            except OSError as e:
+                # e.g. ICMP unreachable from an earlier datagram, or no route
+                log.debug(f"Dropping UDP datagram to {destination[0]}:{destination[1]}: {e}")
+                self.dropped += 1
+                continue
+            self.packets_out += 1
+            self.bytes_out += n - offset
+
+    def _relay_inbound(self):
+        for _ in range(BATCH_SIZE):
+            try:
+                n, sender = self.remote.recvfrom_into(self._buffer, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                log.debug(f"Error receiving UDP datagram on {self}: {e}")
+                continue
+
+            if self.client_address is None:
+                continue
+
+            header = self._build_header(sender)
+            # scatter-gather avoids copying the payload into a new buffer
+            try:
+                self.client.sendmsg([header, self._view[:n]], [], 0, self.client_address)
+            except OSError as e:
+                log.debug(f"Dropping UDP datagram from {sender[0]}:{sender[1]}: {e}")
+                self.dropped += 1
+                continue
+            self.packets_in += 1
+            self.bytes_in += n
+
+    def _parse_header(self, n):
+        """
+        Parse the SOCKS5 UDP request header, returning (destination, payload offset)
+        Destination is None if the datagram can't be relayed
+        """
+        buf = self._buffer
+        frag, address_type = buf[2], buf[3]
+        # fragmentation is not supported
+        if frag != 0:
+            return None, 0
+
+        if address_type == 1:  # IPv4
+            address = socket.inet_ntop(socket.AF_INET, buf[4:8])
+            offset = 8
+        elif address_type == 4:  # IPv6
+            address = socket.inet_ntop(socket.AF_INET6, buf[4:20])
+            offset = 20
+        elif address_type == 3:  # Domain name
+            domain_length = buf[4]
+            domain = bytes(buf[5 : 5 + domain_length])
+            offset = 5 + domain_length
+            address = self._resolve(domain)
+        else:
+            raise ValueError(f"Unknown address type {address_type}")
+
+        if offset + 2 > n:
+            raise ValueError("Truncated header")
+        port = struct.unpack_from("!H", buf, offset)[0]
+
+        if address is None:
+            return None, 0
+        if (":" in address) != (self.family == socket.AF_INET6):
+            log.debug(f"Dropping UDP datagram to {address}: address family mismatch")
+            return None, 0
+        return (address, port), offset + 2
+
+    def _resolve(self, domain):
+        result = self.destinations.resolve(domain, self.family)
+        if result is None:
+            log.debug(f"Failed to resolve {domain}")
+            return None
+        # an address of the other family is dropped by the caller
+        return result[1]
+
+    def _build_header(self, sender):
+        address, port = sender[:2]
+        if ":" in address:
+            return (
+                b"\x00\x00\x00\x04"
+                + socket.inet_pton(socket.AF_INET6, address)
+                + struct.pack("!H", port)
+            )
+        return (
+            b"\x00\x00\x00\x01"
+            + socket.inet_pton(socket.AF_INET, address)
+            + struct.pack("!H", port)
+        )
+
+    def close(self):
+        for sock in (self.client, self.remote):
+            try:
+                sock.close()
+            except Exception:
+                pass
+        log.debug(
+            f"UDP association {self} closed after {time.monotonic() - self.created:.1f}s: "
+            f"{self.packets_out:,} packets/{self.bytes_out:,} bytes out, "
+            f"{self.packets_in:,} packets/{self.bytes_in:,} bytes in, "
+            f"{self.dropped:,} dropped"
+        )
+
+    def __str__(self):
+        source = self.source_address if self.source_address is not None else "*"
+        return f"{self.client_host}<->{source}"
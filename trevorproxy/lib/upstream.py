@@ -0,0 +1,574 @@
+import time
+import socket
+import base64
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from .socks import SocksProxy
+from .http import HTTPProxy, AutoProxy
+from .destination import DestinationCache
+from .pool import SocksPool, SocksReplyError, recv_exact, socks5_greeting, socks5_connect
+from .errors import UpstreamError
+
+log = logging.getLogger("trevorproxy.upstream")
+
+
+class Upstream:
+    """
+    One way out: local subnet egress, an SSH tunnel, or an external proxy
+
+    Tracks active connections against an optional limit, and health: after `max_failures`
+    consecutive failures to reach the upstream itself, it is skipped for `retry_after`
+    seconds, then given one connection to prove itself again
+    """
+
+    def __init__(self, max_connections=0, max_failures=3, retry_after=30, tuning=None):
+        self.max_connections = int(max_connections)
+        # optional SocketTuning for outgoing sockets
+        self.tuning = tuning
+        self.max_failures = int(max_failures)
+        self.retry_after = float(retry_after)
+
+        self.active = 0
+        self.connections = 0
+        self.failures = 0
+        self.total_failures = 0
+        self.down_until = 0
+
+    def connect(self, address, port, key=None, before_connect=None):
+        """
+        Open a connection to (address, port), which may be a hostname
+        `before_connect(sock, source)` is called right before connecting, for socket options and rate shaping
+        Returns (socket, source address or None, bind address or None): the bind address is the
+        (address, port) an upstream proxy reports for the connection, None for local egress
+        Raises UpstreamError if the upstream itself couldn't be reached or dropped us mid-handshake;
+        any other error comes from the destination (e.g. a SOCKS or HTTP error reply)
+        """
+        raise NotImplementedError
+
+    def open_connection(self, host, port, timeout=10):
+        """
+        Like socket.create_connection(), but applies egress tuning before connecting
+        """
+        error = None
+        for family, type, proto, _, address in socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM
+        ):
+            sock = socket.socket(family, type, proto)
+            try:
+                if self.tuning is not None:
+                    self.tuning.apply_egress(sock)
+                sock.settimeout(timeout)
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        if error is None:
+            error = OSError(f"getaddrinfo returned no addresses for {host}")
+        raise error
+
+    def is_healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def is_available(self):
+        if self.max_connections and self.active >= self.max_connections:
+            return False
+        return self.is_healthy()
+
+    def succeeded(self):
+        self.failures = 0
+        self.down_until = 0
+
+    def failed(self):
+        self.failures += 1
+        self.total_failures += 1
+        if self.failures >= self.max_failures:
+            if self.is_healthy():
+                log.warning(
+                    f"Upstream {self} failed {self.failures:,} times, skipping it for {self.retry_after:.0f}s"
+                )
+            self.down_until = time.monotonic() + self.retry_after
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def summary(self):
+        state = "up" if self.is_healthy() else "down"
+        limit = f"/{self.max_connections:,}" if self.max_connections else ""
+        return (
+            f"{self} ({state}): {self.active:,}{limit} active, "
+            f"{self.connections:,} total, {self.total_failures:,} failures"
+        )
+
+    def __repr__(self):
+        return str(self)
+
+
+class LocalUpstream(Upstream):
+    """
+    Egress straight from this host, with a random source address from a SubnetProxy
+    """
+
+    def __init__(self, subnet_proxy, destinations=None, **kwargs):
+        super().__init__(**kwargs)
+        self.subnet_proxy = subnet_proxy
+        self.destinations = destinations
+        if self.destinations is None:
+            self.destinations = DestinationCache()
+        self.family = (
+            socket.AF_INET6 if subnet_proxy.subnet.version == 6 else socket.AF_INET
+        )
+
+    def connect(self, address, port, key=None, before_connect=None):
+        destination = f"{address}:{port}"
+        address, family = self.resolve(address)
+        remote, source = self.bind(family, key, destination)
+        try:
+            if before_connect is not None:
+                before_connect(remote, source)
+            remote.connect((address, port))
+        except Exception:
+            remote.close()
+            raise
+        return remote, source, None
+
+    def bind(self, family, key=None, destination=None):
+        """
+        New unconnected socket, bound to a random source address if `family` matches the subnet
+        `destination` ("host:port") lets the SubnetProxy avoid prefixes quarantined for it
+        Returns (socket, source address or None)
+        """
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        source = None
+        try:
+            if self.tuning is not None:
+                self.tuning.apply_egress(sock)
+            # only randomize the source address if the families match
+            if family == self.family:
+                source = str(self.subnet_proxy.next_source(key, destination))
+                log.info(f"Using random source address: {source}")
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
+                sock.bind((source, 0))
+        except Exception:
+            sock.close()
+            raise
+        return sock, source
+
+    def resolve(self, address):
+        """
+        Returns (address, family), preferring the family of the subnet for hostnames
+        """
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, address)
+                return address, family
+            except OSError:
+                continue
+        result = self.destinations.resolve(address, self.family)
+        if result is None:
+            # a gaierror, so Feedback doesn't blame the source prefix
+            raise socket.gaierror(f"Could not resolve hostname {address}")
+        family, address = result
+        return address, family
+
+    def start(self):
+        self.subnet_proxy.start()
+
+    def stop(self):
+        self.subnet_proxy.stop()
+
+    def __str__(self):
+        return f"local://{self.subnet_proxy.subnet}"
+
+
+class SocksUpstream(Upstream):
+    """
+    External SOCKS5 proxy, optionally with username/password authentication
+    Hostnames are resolved by the proxy
+    """
+
+    def __init__(self, host, port, username=None, password=None, prewarm=0, **kwargs):
+        super().__init__(**kwargs)
+        self.host = str(host)
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.pool = None
+        if prewarm > 0:
+            self.pool = SocksPool(
+                self.host, self.port, size=prewarm, username=username, password=password
+            )
+
+    def connect(self, address, port, key=None, before_connect=None):
+        sock = self.open()
+        try:
+            if before_connect is not None:
+                before_connect(sock, None)
+            try:
+                bound = socks5_connect(sock, address, port)
+            except SocksReplyError:
+                raise
+            except OSError as e:
+                raise UpstreamError(f"Lost {self} during CONNECT: {e}")
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock, None, bound
+
+    def open(self):
+        """
+        A socket that has finished the SOCKS greeting, still with its connect timeout
+        """
+        try:
+            if self.pool is not None:
+                sock = self.pool.get()
+                # pooled sessions are already connected, so this is the earliest we can
+                if self.tuning is not None:
+                    self.tuning.apply_egress(sock)
+                return sock
+            sock = self.open_connection(self.host, self.port)
+            try:
+                socks5_greeting(sock, self.username, self.password)
+            except Exception:
+                sock.close()
+                raise
+            return sock
+        except Exception as e:
+            raise UpstreamError(f"Failed to reach {self}: {e}")
+
+    def start(self):
+        if self.pool is not None:
+            self.pool.start()
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+
+    def __str__(self):
+        return f"socks5://{self.host}:{self.port}"
+
+
+class SSHUpstream(SocksUpstream):
+    """
+    `ssh -D` tunnel spawned and kept alive by TREVORproxy
+    """
+
+    def __init__(self, ssh_proxy, **kwargs):
+        super().__init__("127.0.0.1", ssh_proxy.proxy_port, **kwargs)
+        self.ssh_proxy = ssh_proxy
+        # the SSHProxy keeps its own pool
+        self.pool = ssh_proxy.pool
+
+    def is_healthy(self):
+        return self.ssh_proxy.running and super().is_healthy()
+
+    def start(self):
+        self.ssh_proxy.start(wait=False)
+
+    def stop(self):
+        self.ssh_proxy.stop()
+
+    def __str__(self):
+        return f"ssh://{self.ssh_proxy.host}"
+
+
+class HTTPReplyError(ConnectionError):
+    """
+    Upstream HTTP proxy answered our CONNECT with a non-2xx status
+    """
+
+    def __init__(self, status):
+        self.status = status
+        super().__init__(f"Upstream HTTP proxy returned {status}")
+
+
+class HTTPUpstream(Upstream):
+    """
+    External HTTP proxy, tunnelled through with CONNECT
+    """
+
+    def __init__(self, host, port, username=None, password=None, **kwargs):
+        super().__init__(**kwargs)
+        self.host = str(host)
+        self.port = int(port)
+        self.auth = None
+        if username is not None:
+            credentials = f"{username}:{password or ''}".encode()
+            self.auth = b"Basic " + base64.b64encode(credentials)
+
+    def connect(self, address, port, key=None, before_connect=None):
+        try:
+            sock = self.open_connection(self.host, self.port)
+        except Exception as e:
+            raise UpstreamError(f"Failed to reach {self}: {e}")
+        try:
+            if before_connect is not None:
+                before_connect(sock, None)
+            target = f"[{address}]:{port}" if ":" in address else f"{address}:{port}"
+            request = [
+                f"CONNECT {target} HTTP/1.1".encode(),
+                f"Host: {target}".encode(),
+            ]
+            if self.auth is not None:
+                request.append(b"Proxy-Authorization: " + self.auth)
+            try:
+                sock.sendall(b"\r\n".join(request) + b"\r\n\r\n")
+                status = self.read_status(sock)
+            except OSError as e:
+                raise UpstreamError(f"Lost {self} during CONNECT: {e}")
+            if status == 407:
+                raise UpstreamError(f"{self} rejected our credentials")
+            elif not 200 <= status < 300:
+                raise HTTPReplyError(status)
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        # HTTP CONNECT doesn't say which address the proxy connected from
+        return sock, None, ("0.0.0.0", 0)
+
+    @staticmethod
+    def read_status(sock):
+        # read one byte at a time so nothing past the header is consumed
+        head = b""
+        while not head.endswith(b"\r\n\r\n"):
+            head += recv_exact(sock, 1)
+            if len(head) > 65536:
+                raise ConnectionError("HTTP proxy response header too large")
+        try:
+            return int(head.split(b" ", 2)[1])
+        except (IndexError, ValueError):
+            raise UpstreamError(f"Invalid HTTP proxy response: {head[:100]}")
+
+    def __str__(self):
+        return f"http://{self.host}:{self.port}"
+
+
+def parse_upstream(url, prewarm=0, **kwargs):
+    """
+    socks5://[user:pass@]host:port or http://[user:pass@]host:port
+    A "max_connections" query parameter overrides the default limit, e.g. socks5://1.2.3.4:1080?max_connections=50
+    """
+    parsed = urlsplit(url)
+    scheme = parsed.scheme.lower()
+    try:
+        port = parsed.port
+    except ValueError:
+        raise UpstreamError(f"Invalid port in upstream URL {url}")
+    if not parsed.hostname:
+        raise UpstreamError(f"No host in upstream URL {url}")
+    username = None if parsed.username is None else unquote(parsed.username)
+    password = None if parsed.password is None else unquote(parsed.password)
+    query = parse_qs(parsed.query)
+    if "max_connections" in query:
+        kwargs["max_connections"] = int(query["max_connections"][-1])
+
+    if scheme in ("socks5", "socks5h", "socks"):
+        return SocksUpstream(
+            parsed.hostname,
+            port or 1080,
+            username=username,
+            password=password,
+            prewarm=prewarm,
+            **kwargs,
+        )
+    elif scheme == "http":
+        return HTTPUpstream(
+            parsed.hostname, port or 8080, username=username, password=password, **kwargs
+        )
+    raise UpstreamError(f'Unsupported upstream "{url}" (use socks5:// or http://)')
+
+
+class UpstreamBalancer:
+    """
+    Round-robins connections over a mix of upstreams, skipping ones that are down or at their limit
+
+    If an upstream can't be reached, the connection is retried on the next one.
+    Errors from the destination itself (refused, unreachable) are passed straight back.
+    With a Feedback, upstreams whose egress keeps getting refused or reset are skipped too.
+    """
+
+    def __init__(self, upstreams, feedback=None):
+        self.upstreams = list(upstreams)
+        if not self.upstreams:
+            raise UpstreamError("At least one upstream is required")
+        self.feedback = feedback
+        self.lock = threading.Lock()
+        self.round_robin_counter = 0
+
+    def __next__(self):
+        return self.next_upstream()
+
+    def next_upstream(self, destination=None):
+        """
+        Next available upstream, with a connection slot reserved
+        Falls back to an upstream quarantined for `destination`, then to an unhealthy one, when
+        nothing better is left, rather than failing outright
+        """
+        feedback = self.feedback
+        if feedback is not None and not feedback.upstreams.quarantines:
+            feedback = None
+        with self.lock:
+            n = len(self.upstreams)
+            quarantined = None
+            unhealthy = None
+            for _ in range(n):
+                upstream = self.upstreams[self.round_robin_counter % n]
+                self.round_robin_counter += 1
+                if upstream.is_available():
+                    if feedback is None or feedback.upstream_ok(upstream, destination):
+                        break
+                    if quarantined is None:
+                        quarantined = upstream
+                elif unhealthy is None and not (
+                    upstream.max_connections and upstream.active >= upstream.max_connections
+                ):
+                    unhealthy = upstream
+            else:
+                upstream = quarantined or unhealthy
+                if upstream is None:
+                    raise UpstreamError("All upstreams are at their connection limit")
+            upstream.active += 1
+            upstream.connections += 1
+            return upstream
+
+    def release(self, upstream):
+        with self.lock:
+            upstream.active -= 1
+
+    def connect(self, address, port, key=None, before_connect=None, on_failure=None):
+        """
+        `before_connect(upstream, sock, source)` is called right before each attempt connects
+        `on_failure(upstream, error)` is called for each attempt that fails, including ones
+        that never reached the upstream
+        Returns (upstream, socket, source address or None, bind address or None)
+        The caller must release() the upstream once the connection ends
+        """
+        destination = f"{address}:{port}"
+        attempts = len(self.upstreams)
+        while 1:
+            upstream = self.next_upstream(destination)
+            hook = None
+            if before_connect is not None:
+                hook = lambda sock, source, upstream=upstream: before_connect(
+                    upstream, sock, source
+                )
+            try:
+                sock, source, bound = upstream.connect(
+                    address, port, key=key, before_connect=hook
+                )
+            except UpstreamError as e:
+                self.release(upstream)
+                upstream.failed()
+                if self.feedback is not None:
+                    self.feedback.connect_failed(upstream=upstream, error=e)
+                if on_failure is not None:
+                    on_failure(upstream, e)
+                attempts -= 1
+                if attempts <= 0:
+                    raise
+                log.warning(f"{e}, trying another upstream")
+                continue
+            except Exception as e:
+                self.release(upstream)
+                # an error reply from the upstream (or a local connect error): the destination
+                # failed, not the upstream
+                upstream.succeeded()
+                # ...which may still mean the destination is blocking this upstream
+                if self.feedback is not None:
+                    self.feedback.connect_failed(
+                        upstream=upstream, error=e, destination=destination
+                    )
+                if on_failure is not None:
+                    on_failure(upstream, e)
+                raise
+            upstream.succeeded()
+            return upstream, sock, source, bound
+
+    def start(self):
+        for upstream in self.upstreams:
+            upstream.start()
+
+    def stop(self):
+        for upstream in self.upstreams:
+            try:
+                upstream.stop()
+            except Exception as e:
+                log.warning(f"Error stopping {upstream}: {e}")
+
+    def summary(self):
+        return [u.summary() for u in self.upstreams]
+
+
+class UpstreamMixin:
+    """
+    Makes a SocksProxy/HTTPProxy handler connect through the server's UpstreamBalancer
+    Hostnames are passed to the upstream unresolved, so external proxies do their own DNS
+    """
+
+    udp = False
+
+    def default_family(self):
+        return socket.AF_INET
+
+    def resolve(self, domain):
+        if isinstance(domain, bytes):
+            domain = domain.decode("utf-8", errors="ignore")
+        return domain
+
+    def connect_remote(self, address, port, destination=None):
+        def before_connect(upstream, sock, source):
+            self.source_address = source
+            self.server.timeouts.apply(sock)
+            # wait our turn if the destination, source prefix or upstream is over its limits
+            if self.server.scheduler:
+                # a previous attempt may have failed over to this upstream
+                if self.ticket is not None:
+                    self.ticket.release()
+                self.ticket = self.server.scheduler.acquire(
+                    destination=destination or address,
+                    source=source,
+                    upstream=str(upstream),
+                )
+
+        def on_failure(upstream, error):
+            # self.upstream is only set once an attempt succeeds, so account() can't see these
+            if self.server.accounting is not None:
+                self.server.accounting.record(upstream=upstream, failed=True)
+
+        self.upstream, remote, _, self.bound = self.server.proxy.connect(
+            address,
+            port,
+            key=self.affinity_key(destination),
+            before_connect=before_connect,
+            on_failure=on_failure,
+        )
+        log.info(f"Using upstream {self.upstream}")
+        return remote
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            if self.upstream is not None:
+                self.server.proxy.release(self.upstream)
+                self.upstream = None
+
+
+class UpstreamSocksProxy(UpstreamMixin, SocksProxy):
+    pass
+
+
+class UpstreamHTTPProxy(UpstreamMixin, HTTPProxy):
+    pass
+
+
+class UpstreamAutoProxy(UpstreamMixin, AutoProxy):
+    pass